@@ -1,21 +1,246 @@
-from fastapi import FastAPI, APIRouter, HTTPException, File, UploadFile
+from fastapi import FastAPI, APIRouter, HTTPException, File, UploadFile, Query, Header, Request, Response
+from fastapi.responses import StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from dotenv import load_dotenv
+import orjson
 from starlette.middleware.cors import CORSMiddleware
+from starlette.middleware.gzip import GZipMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne, ReplaceOne, ReturnDocument, monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+import pandas as pd
+import numpy as np
 import os
+import io
+import re
+import csv
+import gzip
+from itertools import islice
+import time
+import threading
+import hashlib
+import asyncio
+import typer
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field
-from typing import List, Optional
+from pydantic import BaseModel, Field, ValidationError
+from typing import List, Literal, Optional, Generic, TypeVar
 import uuid
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from email.utils import format_datetime, parsedate_to_datetime
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# Monitoreo del pool de conexiones de Motor
+class MonitorPool(monitoring.ConnectionPoolListener):
+    # Los eventos llegan desde los hilos de Motor; el inicio del checkout se guarda por hilo
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.abiertas = 0
+        self.en_uso = 0
+        self.max_en_uso = 0
+        self.esperando = 0
+        self.checkouts = 0
+        self.checkouts_fallidos = 0
+        self.esperas_ms = deque(maxlen=1024)
+
+    def connection_check_out_started(self, event):
+        self.local.inicio = time.perf_counter()
+        with self.lock:
+            self.esperando += 1
+
+    def connection_checked_out(self, event):
+        espera = (time.perf_counter() - getattr(self.local, "inicio", time.perf_counter())) * 1000
+        with self.lock:
+            self.esperando -= 1
+            self.en_uso += 1
+            self.max_en_uso = max(self.max_en_uso, self.en_uso)
+            self.checkouts += 1
+            self.esperas_ms.append(espera)
+
+    def connection_check_out_failed(self, event):
+        with self.lock:
+            self.esperando -= 1
+            self.checkouts_fallidos += 1
+
+    def connection_checked_in(self, event):
+        with self.lock:
+            self.en_uso -= 1
+
+    def connection_created(self, event):
+        with self.lock:
+            self.abiertas += 1
+
+    def connection_closed(self, event):
+        with self.lock:
+            self.abiertas -= 1
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def estadisticas(self):
+        with self.lock:
+            esperas = sorted(self.esperas_ms)
+            return {
+                "conexiones_abiertas": self.abiertas,
+                "conexiones_en_uso": self.en_uso,
+                "max_en_uso": self.max_en_uso,
+                "esperando_conexion": self.esperando,
+                "checkouts": self.checkouts,
+                "checkouts_fallidos": self.checkouts_fallidos,
+                "espera_ms_p50": round(esperas[len(esperas) // 2], 3) if esperas else 0,
+                "espera_ms_p99": round(esperas[int(len(esperas) * 0.99)], 3) if esperas else 0,
+                "espera_ms_max": round(esperas[-1], 3) if esperas else 0
+            }
+
+# Métricas en formato de exposición de Prometheus
+class Histograma:
+    def __init__(self, nombre, ayuda, etiquetas, limites):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = etiquetas
+        self.limites = limites
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def observar(self, valores, segundos):
+        with self.lock:
+            serie = self.series.get(valores)
+            if serie is None:
+                serie = self.series[valores] = {"buckets": [0] * len(self.limites), "suma": 0.0, "cuenta": 0}
+            for posicion, limite in enumerate(self.limites):
+                if segundos <= limite:
+                    serie["buckets"][posicion] += 1
+                    break
+            serie["suma"] += segundos
+            serie["cuenta"] += 1
+
+    def exponer(self):
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} histogram"]
+        with self.lock:
+            series = [(valores, dict(serie, buckets=list(serie["buckets"]))) for valores, serie in self.series.items()]
+        for valores, serie in sorted(series):
+            etiquetas = ",".join(f'{nombre}="{valor}"' for nombre, valor in zip(self.etiquetas, valores))
+            acumulado = 0
+            for limite, cantidad in zip(self.limites, serie["buckets"]):
+                acumulado += cantidad
+                lineas.append(f'{self.nombre}_bucket{{{etiquetas},le="{limite}"}} {acumulado}')
+            lineas.append(f'{self.nombre}_bucket{{{etiquetas},le="+Inf"}} {serie["cuenta"]}')
+            lineas.append(f"{self.nombre}_sum{{{etiquetas}}} {serie['suma']:.6f}")
+            lineas.append(f"{self.nombre}_count{{{etiquetas}}} {serie['cuenta']}")
+        return lineas
+
+class Contador:
+    def __init__(self, nombre, ayuda, etiquetas):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = etiquetas
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def incrementar(self, valores, cantidad=1):
+        with self.lock:
+            self.series[valores] = self.series.get(valores, 0) + cantidad
+
+    def exponer(self):
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} counter"]
+        with self.lock:
+            series = sorted(self.series.items())
+        for valores, cantidad in series:
+            etiquetas = ",".join(f'{nombre}="{valor}"' for nombre, valor in zip(self.etiquetas, valores))
+            lineas.append(f"{self.nombre}{{{etiquetas}}} {cantidad}")
+        return lineas
+
+def metrica_simple(nombre, tipo, ayuda, valor):
+    return [f"# HELP {nombre} {ayuda}", f"# TYPE {nombre} {tipo}", f"{nombre} {valor}"]
+
+LIMITES_HTTP = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LIMITES_MONGO = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+duracion_http = Histograma(
+    "http_request_duration_seconds", "Latencia de las peticiones HTTP por ruta",
+    ("method", "route", "status"), LIMITES_HTTP
+)
+peticiones_http = Contador("http_requests_total", "Peticiones HTTP atendidas", ("method", "route", "status"))
+duracion_mongo = Histograma(
+    "mongodb_command_duration_seconds", "Duración de los comandos de MongoDB por colección y operación",
+    ("collection", "command"), LIMITES_MONGO
+)
+errores_mongo = Contador("mongodb_command_errors_total", "Comandos de MongoDB fallidos", ("collection", "command"))
+
+# Comandos internos del driver que no corresponden a consultas de la aplicación
+COMANDOS_IGNORADOS = {"hello", "ismaster", "isMaster", "ping", "saslStart", "saslContinue", "endSessions", "buildInfo"}
+
+class MonitorComandos(monitoring.CommandListener):
+    # started y succeeded/failed se emparejan por request_id y connection_id
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pendientes = {}
+
+    def started(self, event):
+        if event.command_name in COMANDOS_IGNORADOS:
+            return
+        coleccion = event.command.get("collection") if event.command_name == "getMore" else event.command.get(event.command_name)
+        if not isinstance(coleccion, str):
+            coleccion = event.database_name
+        with self.lock:
+            self.pendientes[(event.request_id, event.connection_id)] = (coleccion, event.command_name)
+
+    def _terminar(self, event):
+        with self.lock:
+            return self.pendientes.pop((event.request_id, event.connection_id), None)
+
+    def succeeded(self, event):
+        etiquetas = self._terminar(event)
+        if etiquetas:
+            duracion_mongo.observar(etiquetas, event.duration_micros / 1_000_000)
+
+    def failed(self, event):
+        etiquetas = self._terminar(event)
+        if etiquetas:
+            duracion_mongo.observar(etiquetas, event.duration_micros / 1_000_000)
+            errores_mongo.incrementar(etiquetas)
+
+def opciones_pool():
+    # Solo se pasan las opciones definidas en el entorno; el resto usa los valores de Motor
+    variables = {
+        "maxPoolSize": ("MONGO_MAX_POOL_SIZE", int),
+        "minPoolSize": ("MONGO_MIN_POOL_SIZE", int),
+        "waitQueueTimeoutMS": ("MONGO_WAIT_QUEUE_TIMEOUT_MS", int),
+        "serverSelectionTimeoutMS": ("MONGO_SERVER_SELECTION_TIMEOUT_MS", int),
+        "maxIdleTimeMS": ("MONGO_MAX_IDLE_TIME_MS", int),
+        "compressors": ("MONGO_COMPRESSORS", str)
+    }
+    return {
+        opcion: tipo(os.environ[variable])
+        for opcion, (variable, tipo) in variables.items()
+        if os.environ.get(variable)
+    }
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+monitor_pool = MonitorPool()
+monitor_comandos = MonitorComandos()
+# tz_aware: las fechas BSON se leen como datetime UTC con zona horaria
+client = AsyncIOMotorClient(
+    mongo_url, tz_aware=True, event_listeners=[monitor_pool, monitor_comandos], **opciones_pool()
+)
 db = client[os.environ['DB_NAME']]
 
 # Create the main app without a prefix
@@ -25,22 +250,905 @@ app = FastAPI()
 api_router = APIRouter(prefix="/api")
 
 # Helper functions
-def prepare_for_mongo(data):
-    if isinstance(data, dict):
-        for key, value in data.items():
-            if isinstance(value, datetime):
-                data[key] = value.isoformat()
-    return data
-
-def parse_from_mongo(item):
-    if isinstance(item, dict):
-        for key, value in item.items():
-            if isinstance(value, str) and 'T' in value:
-                try:
-                    item[key] = datetime.fromisoformat(value.replace('Z', '+00:00'))
-                except:
-                    pass
-    return item
+def campos_fecha(modelo):
+    # Campos datetime declarados en el modelo; son los únicos que se migran
+    return [nombre for nombre, campo in modelo.model_fields.items() if campo.annotation is datetime]
+
+FORMATOS_PERIODO = {
+    "dia": "%Y-%m-%d",
+    "semana": "%G-W%V",
+    "mes": "%Y-%m"
+}
+
+def fecha_utc(valor):
+    # Fechas sin zona horaria se interpretan como UTC
+    if valor.tzinfo is None:
+        return valor.replace(tzinfo=timezone.utc)
+    return valor.astimezone(timezone.utc)
+
+# Caché en proceso (LRU con expiración) para lecturas frecuentes
+class CacheTTL:
+    def __init__(self, maximo=256, ttl=30):
+        self.maximo = maximo
+        self.ttl = ttl
+        self.entradas = OrderedDict()
+        self.generacion = 0
+        self.aciertos = 0
+        self.fallos = 0
+        self.invalidaciones = 0
+
+    def obtener(self, clave):
+        entrada = self.entradas.get(clave)
+        if entrada is not None and entrada[0] > time.monotonic():
+            self.entradas.move_to_end(clave)
+            self.aciertos += 1
+            return entrada[1]
+        self.entradas.pop(clave, None)
+        self.fallos += 1
+        return None
+
+    def guardar(self, clave, valor, generacion):
+        # Una lectura iniciada antes de una escritura no debe repoblar la caché
+        if generacion != self.generacion:
+            return
+        self.entradas[clave] = (time.monotonic() + self.ttl, valor)
+        self.entradas.move_to_end(clave)
+        while len(self.entradas) > self.maximo:
+            self.entradas.popitem(last=False)
+
+    def invalidar(self):
+        self.entradas.clear()
+        self.generacion += 1
+        self.invalidaciones += 1
+
+    def estadisticas(self):
+        consultas = self.aciertos + self.fallos
+        return {
+            "entradas": len(self.entradas),
+            "aciertos": self.aciertos,
+            "fallos": self.fallos,
+            "tasa_aciertos": round(self.aciertos / consultas, 4) if consultas else 0,
+            "invalidaciones": self.invalidaciones
+        }
+
+cache_productos = CacheTTL(
+    maximo=int(os.environ.get('CACHE_PRODUCTOS_MAXIMO', 256)),
+    ttl=float(os.environ.get('CACHE_PRODUCTOS_TTL', 30))
+)
+
+# Sugerencias de reabastecimiento; la clave lleva las versiones de ventas, compras y productos
+# y el TTL solo acota cuánto vive una entrada que ya nadie pide
+cache_reabastecimiento = CacheTTL(
+    maximo=int(os.environ.get('CACHE_REABASTECIMIENTO_MAXIMO', 32)),
+    ttl=float(os.environ.get('CACHE_REABASTECIMIENTO_TTL', 3600))
+)
+
+# Versiones por colección para ETag / Last-Modified
+async def registrar_cambios(*colecciones, session=None):
+    # Lo llaman los handlers de escritura dentro de su transacción: si el proceso cae
+    # a mitad de camino, los datos y los validadores cambian juntos o no cambian
+    if "productos" in colecciones:
+        cache_productos.invalidar()
+    if {"productos", "ventas", "compras"} & set(colecciones):
+        cache_reabastecimiento.invalidar()
+    ahora = datetime.now(timezone.utc)
+    await db.versiones.bulk_write([
+        UpdateOne({"_id": coleccion}, {"$inc": {"version": 1}, "$set": {"actualizado": ahora}}, upsert=True)
+        for coleccion in colecciones
+    ], ordered=False, session=session)
+
+async def respuesta_condicional(request, response, *colecciones):
+    # Devuelve un 304 si el cliente ya tiene la versión actual; si no, fija los validadores
+    versiones = await db.versiones.find({"_id": {"$in": list(colecciones)}}).to_list(None)
+    por_coleccion = {version["_id"]: version for version in versiones}
+    firma = ";".join(f"{coleccion}:{por_coleccion.get(coleccion, {}).get('version', 0)}" for coleccion in colecciones)
+    etag = 'W/"' + hashlib.md5(f"{request.url.path}?{request.url.query}|{firma}".encode()).hexdigest() + '"'
+    
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    fechas = [version["actualizado"] for version in versiones if version.get("actualizado")]
+    modificado = None
+    if fechas:
+        # HTTP-date tiene resolución de segundos: se redondea hacia arriba y solo se anuncia
+        # cuando ese segundo ya pasó, así una escritura posterior siempre queda más adelante
+        ultimo = max(fecha_utc(fecha) for fecha in fechas)
+        modificado = ultimo.replace(microsecond=0)
+        if modificado < ultimo:
+            modificado += timedelta(seconds=1)
+        if modificado <= datetime.now(timezone.utc):
+            headers["Last-Modified"] = format_datetime(modificado, usegmt=True)
+    
+    if_none_match = request.headers.get("if-none-match")
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_none_match:
+        vigente = etag in [valor.strip() for valor in if_none_match.split(",")] or if_none_match.strip() == "*"
+    elif if_modified_since and modificado:
+        try:
+            vigente = modificado <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            vigente = False
+    else:
+        vigente = False
+    
+    if vigente:
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return None
+
+# Retención de lápidas de /sync y de versiones pendientes abandonadas
+SYNC_PENDIENTE_TTL = int(os.environ.get('SYNC_PENDIENTE_TTL', 300))
+SYNC_ELIMINADOS_TTL = int(os.environ.get('SYNC_ELIMINADOS_TTL', 30 * 86400))
+
+# Segundos que se recuerda una Idempotency-Key
+IDEMPOTENCIA_TTL = int(os.environ.get('IDEMPOTENCIA_TTL', 86400))
+# Segundos que una solicitud en curso retiene su clave; vencido, un reintento la retoma
+IDEMPOTENCIA_RESERVA = float(os.environ.get('IDEMPOTENCIA_RESERVA', 60))
+
+# Índices que usan las consultas de la API
+INDICES = [
+    ("clientes", [("id", 1)], {"unique": True}),
+    ("clientes", [("ruc", 1)], {"unique": True}),
+    ("proveedores", [("id", 1)], {"unique": True}),
+    ("proveedores", [("ruc", 1)], {"unique": True}),
+    ("productos", [("id", 1)], {"unique": True}),
+    ("productos", [("nombre", 1)], {}),
+    # Índices de texto para /buscar (uno por colección)
+    ("productos", [("nombre", "text"), ("descripcion", "text"), ("categoria", "text")], {"name": "busqueda_texto", "default_language": "spanish"}),
+    ("clientes", [("nombre_completo", "text"), ("ruc", "text")], {"name": "busqueda_texto", "default_language": "spanish"}),
+    ("proveedores", [("nombre_completo", "text"), ("ruc", "text")], {"name": "busqueda_texto", "default_language": "spanish"}),
+    ("ventas", [("id", 1)], {"unique": True}),
+    # Compuestos para filtrar por cliente/proveedor y paginar por (fecha, id); también
+    # sirven, recorridos al revés, para la última venta/compra al recalcular un historial
+    ("ventas", [("cliente_id", 1), ("fecha", 1), ("id", 1)], {}),
+    ("ventas", [("fecha", 1), ("id", 1)], {}),
+    ("ventas", [("productos.producto_id", 1)], {}),
+    ("compras", [("id", 1)], {"unique": True}),
+    ("compras", [("proveedor_id", 1), ("fecha", 1), ("id", 1)], {}),
+    ("compras", [("fecha", 1), ("id", 1)], {}),
+    ("compras", [("productos.producto_id", 1)], {}),
+    # Las claves de idempotencia expiran solas
+    ("idempotencia", [("creado", 1)], {"expireAfterSeconds": IDEMPOTENCIA_TTL}),
+    # Los eventos solo se leen en vivo desde el change stream
+    ("eventos", [("fecha", 1)], {"expireAfterSeconds": 3600}),
+    # /sync lee por _version; las lápidas y las versiones abandonadas expiran
+    ("clientes", [("_version", 1)], {}),
+    ("proveedores", [("_version", 1)], {}),
+    ("productos", [("_version", 1)], {}),
+    ("ventas", [("_version", 1)], {}),
+    ("compras", [("_version", 1)], {}),
+    ("eliminados", [("_version", 1)], {}),
+    # Las lápidas las poda /sync (no un TTL) para registrar hasta qué versión se perdieron
+    ("eliminados", [("fecha", 1)], {}),
+    ("versiones_pendientes", [("minimo", 1)], {}),
+    ("versiones_pendientes", [("creado", 1)], {"expireAfterSeconds": SYNC_PENDIENTE_TTL}),
+    # Kardex: rango de movimientos por producto y fecha, snapshots por corte
+    ("movimientos", [("producto_id", 1), ("fecha", 1)], {}),
+    ("movimientos", [("fecha", 1)], {}),
+    ("inventario_snapshots", [("fecha", 1), ("producto_id", 1)], {})
+]
+
+async def asegurar_indices():
+    # create_index es idempotente; se compara con los existentes para el reporte
+    reporte = []
+    existentes = {}
+    for coleccion, claves, opciones in INDICES:
+        if coleccion not in existentes:
+            existentes[coleccion] = await db[coleccion].index_information()
+        inicio = time.perf_counter()
+        try:
+            nombre = await db[coleccion].create_index(claves, **opciones)
+            estado = "existente" if nombre in existentes[coleccion] else "creado"
+        except OperationFailure as e:
+            nombre = "_".join(f"{campo}_{orden}" for campo, orden in claves)
+            estado = f"error: {e}"
+        reporte.append({
+            "coleccion": coleccion,
+            "indice": nombre,
+            "estado": estado,
+            "segundos": round(time.perf_counter() - inicio, 4)
+        })
+    return reporte
+
+# Transacciones y actualización de stock
+_transacciones_disponibles = None
+
+async def soporta_transacciones():
+    # Solo réplicas y mongos admiten transacciones multi-documento
+    global _transacciones_disponibles
+    if _transacciones_disponibles is None:
+        hello = await client.admin.command("hello")
+        _transacciones_disponibles = "setName" in hello or hello.get("msg") == "isdbgrid"
+        if not _transacciones_disponibles:
+            logger.warning("MongoDB standalone: ventas y compras se escriben sin transacción")
+    return _transacciones_disponibles
+
+async def en_transaccion(operacion):
+    # Ejecuta operacion(session); with_transaction reintenta errores transitorios
+    if not await soporta_transacciones():
+        return await operacion(None)
+    async with await client.start_session() as session:
+        return await session.with_transaction(operacion)
+
+def cantidades_por_producto(lineas):
+    # Agrupa líneas repetidas del mismo producto en una sola operación
+    cantidades = {}
+    for linea in lineas:
+        cantidades[linea["producto_id"]] = cantidades.get(linea["producto_id"], 0) + linea["cantidad"]
+    return cantidades
+
+async def cargar_productos(lineas):
+    # Una sola consulta $in para todas las líneas de la factura
+    ids = list(dict.fromkeys(linea.producto_id for linea in lineas))
+    productos = await db.productos.find(
+        {"id": {"$in": ids}}, {"_id": 0, "id": 1, "nombre": 1, "precio": 1, "costo_promedio": 1}
+    ).to_list(None)
+    catalogo = {producto["id"]: producto for producto in productos}
+    faltantes = [producto_id for producto_id in ids if producto_id not in catalogo]
+    if faltantes:
+        raise HTTPException(status_code=404, detail={"mensaje": "Productos no encontrados", "productos": faltantes})
+    return catalogo
+
+class StockInsuficiente(Exception):
+    def __init__(self, cantidades, candidatos):
+        super().__init__("Stock insuficiente")
+        self.cantidades = cantidades
+        self.candidatos = candidatos
+
+def entradas_por_producto(lineas):
+    # producto_id -> (unidades, valor al costo de cada línea)
+    entradas = {}
+    for linea in lineas:
+        cantidad, valor = entradas.get(linea["producto_id"], (0, 0))
+        entradas[linea["producto_id"]] = (cantidad + linea["cantidad"], valor + linea["cantidad"] * linea["costo"])
+    return entradas
+
+def cambios_stock(cantidad, version):
+    cambios = {"$inc": {"stock": cantidad}}
+    if version is not None:
+        cambios["$set"] = {"_version": version}
+    return cambios
+
+def cambios_salida_costeada(cantidad, valor, version):
+    # Inverso del promedio de ingresar_stock: saca las unidades con el valor al que entraron.
+    # Si no queda stock, o las ventas intermedias dejan un valor negativo, el promedio se conserva
+    restante = {"$subtract": ["$stock", cantidad]}
+    valor_restante = {"$subtract": [{"$multiply": ["$stock", "$costo_promedio"]}, valor]}
+    cambios = {
+        "stock": restante,
+        "costo_promedio": {"$cond": [
+            {"$and": [{"$gt": [restante, 0]}, {"$gte": [valor_restante, 0]}]},
+            {"$divide": [valor_restante, restante]},
+            "$costo_promedio"
+        ]}
+    }
+    if version is not None:
+        cambios["_version"] = {"$literal": version}
+    return [{"$set": cambios}]
+
+async def descontar_stock(lineas, session=None, version=None, costeado=False):
+    # Descuento condicional: solo aplica si queda stock suficiente.
+    # costeado: las líneas traen su costo (anular una compra) y se deshace su aporte al promedio
+    cantidades = cantidades_por_producto(lineas)
+    entradas = entradas_por_producto(lineas) if costeado else {}
+    
+    def cambios(producto_id, cantidad):
+        if costeado:
+            return cambios_salida_costeada(cantidad, entradas[producto_id][1], version)
+        return cambios_stock(-cantidad, version)
+    
+    if session is not None:
+        resultado = await db.productos.bulk_write([
+            UpdateOne({"id": producto_id, "stock": {"$gte": cantidad}}, cambios(producto_id, cantidad))
+            for producto_id, cantidad in cantidades.items()
+        ], ordered=False, session=session)
+        # Abortar la transacción deshace las líneas ya aplicadas
+        if resultado.matched_count < len(cantidades):
+            raise StockInsuficiente(cantidades, list(cantidades))
+        return
+    
+    # Sin transacción cada línea va por separado para saber cuáles revertir
+    resultados = await asyncio.gather(*[
+        db.productos.update_one({"id": producto_id, "stock": {"$gte": cantidad}}, cambios(producto_id, cantidad))
+        for producto_id, cantidad in cantidades.items()
+    ])
+    fallidos = [
+        producto_id
+        for producto_id, resultado in zip(cantidades, resultados)
+        if resultado.matched_count == 0
+    ]
+    if fallidos:
+        aplicadas = [linea for linea in lineas if linea["producto_id"] not in fallidos]
+        if costeado:
+            await ingresar_stock(aplicadas, version=version)
+        else:
+            await ajustar_stock(aplicadas, 1, version=version)
+        raise StockInsuficiente(cantidades, fallidos)
+
+async def conflicto_stock(error):
+    # 409 con el stock disponible de cada producto que no alcanzó
+    productos = await db.productos.find(
+        {"id": {"$in": error.candidatos}}, {"_id": 0, "id": 1, "nombre": 1, "stock": 1}
+    ).to_list(None)
+    disponibles = {producto["id"]: producto for producto in productos}
+    detalle = []
+    for producto_id in error.candidatos:
+        producto = disponibles.get(producto_id, {})
+        disponible = producto.get("stock", 0)
+        if disponible < error.cantidades[producto_id]:
+            detalle.append({
+                "producto_id": producto_id,
+                "nombre": producto.get("nombre"),
+                "solicitado": error.cantidades[producto_id],
+                "disponible": disponible
+            })
+    return HTTPException(status_code=409, detail={"mensaje": "Stock insuficiente", "productos": detalle})
+
+async def ingresar_stock(lineas, session=None, version=None):
+    # Entrada con costo: stock y costo promedio ponderado en la misma actualización,
+    # ambos calculados sobre los valores previos del documento
+    operaciones = []
+    for producto_id, (cantidad, valor) in entradas_por_producto(lineas).items():
+        # El stock negativo no aporta al promedio; sin costo previo vale el de la entrada
+        existente = {"$max": ["$stock", 0]}
+        costo_previo = {"$ifNull": ["$costo_promedio", valor / cantidad]}
+        cambios = {
+            "stock": {"$add": ["$stock", cantidad]},
+            "costo_promedio": {"$divide": [
+                {"$add": [{"$multiply": [existente, costo_previo]}, valor]},
+                {"$add": [existente, cantidad]}
+            ]}
+        }
+        if version is not None:
+            cambios["_version"] = {"$literal": version}
+        operaciones.append(UpdateOne({"id": producto_id}, [{"$set": cambios}]))
+    if operaciones:
+        await db.productos.bulk_write(operaciones, ordered=False, session=session)
+
+async def ajustar_stock(lineas, signo, session=None, version=None):
+    operaciones = [
+        UpdateOne({"id": producto_id}, cambios_stock(signo * cantidad, version))
+        for producto_id, cantidad in cantidades_por_producto(lineas).items()
+    ]
+    if operaciones:
+        await db.productos.bulk_write(operaciones, ordered=False, session=session)
+
+# Kardex: movimientos de stock y snapshots periódicos
+# Cada cambio de stock deja un movimiento con su delta en la misma transacción;
+# el stock a una fecha es el último snapshot más los movimientos posteriores.
+SNAPSHOT_HORAS = float(os.environ.get('SNAPSHOT_HORAS', 24))
+# Los movimientos con fecha cercana al corte pueden seguir escribiéndose
+SNAPSHOT_MARGEN = int(os.environ.get('SNAPSHOT_MARGEN', 60))
+
+async def registrar_movimientos(lineas, signo, tipo, referencia, fecha, session=None):
+    # Se llama después de actualizar el stock: cada movimiento guarda el costo promedio con
+    # que quedó el producto, el mismo con el que se costean las ventas
+    if not lineas:
+        return
+    costos = {
+        producto["id"]: producto.get("costo_promedio")
+        async for producto in db.productos.find(
+            {"id": {"$in": list({linea["producto_id"] for linea in lineas})}},
+            {"_id": 0, "id": 1, "costo_promedio": 1},
+            session=session
+        )
+    }
+    movimientos = []
+    for linea in lineas:
+        movimiento = {
+            "id": str(uuid.uuid4()),
+            "producto_id": linea["producto_id"],
+            "cantidad": signo * linea["cantidad"],
+            "tipo": tipo,
+            "referencia": referencia,
+            "fecha": fecha,
+            "costo_promedio": costos.get(linea["producto_id"])
+        }
+        if tipo == "compra":
+            movimiento["costo_unitario"] = linea["precio_unitario"]
+        movimientos.append(movimiento)
+    await db.movimientos.insert_many(movimientos, session=session)
+
+async def stock_a_fecha(fecha, producto_id=None):
+    # producto_id -> {"stock", "costo"} desde el último snapshot anterior a fecha;
+    # el costo es el promedio ponderado vigente a esa fecha
+    filtro = {"producto_id": producto_id} if producto_id else {}
+    estado = {}
+    rango = {"$lte": fecha}
+    ultimo = await db.inventario_snapshots.find_one({"fecha": {"$lte": fecha}}, sort=[("fecha", -1)])
+    if ultimo:
+        rango["$gt"] = ultimo["fecha"]
+        async for snapshot in db.inventario_snapshots.find({**filtro, "fecha": ultimo["fecha"]}):
+            estado[snapshot["producto_id"]] = {"stock": snapshot["stock"], "costo": snapshot.get("costo_promedio")}
+    
+    deltas = db.movimientos.aggregate([
+        {"$match": {**filtro, "fecha": rango}},
+        {"$group": {"_id": "$producto_id", "cantidad": {"$sum": "$cantidad"}}}
+    ])
+    async for delta in deltas:
+        estado.setdefault(delta["_id"], {"stock": 0, "costo": None})["stock"] += delta["cantidad"]
+    # La baja de un producto eliminado no tiene costo: vale el del movimiento anterior
+    costos = db.movimientos.aggregate([
+        {"$match": {**filtro, "fecha": rango, "costo_promedio": {"$ne": None}}},
+        {"$sort": {"fecha": 1}},
+        {"$group": {"_id": "$producto_id", "costo": {"$last": "$costo_promedio"}}}
+    ])
+    async for costo in costos:
+        estado.setdefault(costo["_id"], {"stock": 0, "costo": None})["costo"] = costo["costo"]
+    return estado
+
+async def tomar_snapshot():
+    corte = datetime.now(timezone.utc)
+    if await db.inventario_snapshots.find_one({}, {"_id": 1}):
+        corte -= timedelta(seconds=SNAPSHOT_MARGEN)
+        estado = await stock_a_fecha(corte)
+    else:
+        # Primer snapshot: el stock y el costo promedio actuales son la base del kardex
+        estado = {
+            producto["id"]: {"stock": producto["stock"], "costo": producto.get("costo_promedio")}
+            async for producto in db.productos.find({}, {"_id": 0, "id": 1, "stock": 1, "costo_promedio": 1})
+        }
+    # Los productos dados de baja sin stock dejan de arrastrarse entre snapshots
+    vigentes = set(await db.productos.distinct("id"))
+    estado = {
+        producto_id: valores for producto_id, valores in estado.items()
+        if valores["stock"] or producto_id in vigentes
+    }
+    if estado:
+        await db.inventario_snapshots.insert_many([
+            {"producto_id": producto_id, "fecha": corte, "stock": valores["stock"], "costo_promedio": valores["costo"]}
+            for producto_id, valores in estado.items()
+        ])
+    return {"fecha": corte, "productos": len(estado)}
+
+async def snapshots_periodicos():
+    while True:
+        await asyncio.sleep(SNAPSHOT_HORAS * 3600)
+        try:
+            resultado = await tomar_snapshot()
+            logger.info("Snapshot de inventario: %d productos", resultado["productos"])
+        except Exception as error:
+            logger.warning("Snapshot de inventario fallido: %s", error)
+
+# Serialización directa con orjson para lecturas
+# Los GET devuelven los documentos de Mongo sin reconstruir ni revalidar modelos;
+# response_model queda solo para la documentación de OpenAPI.
+OPCIONES_JSON = orjson.OPT_UTC_Z | orjson.OPT_NAIVE_UTC
+
+def a_json(contenido):
+    return orjson.dumps(contenido, option=OPCIONES_JSON)
+
+class RespuestaJSON(Response):
+    media_type = "application/json"
+
+    def render(self, content):
+        # Acepta cuerpos ya serializados (p. ej. desde la caché)
+        if isinstance(content, bytes):
+            return content
+        return a_json(content)
+
+# Paginación por cursor (keyset sobre el campo id, o sobre fecha e id)
+LIMITE_POR_DEFECTO = 100
+LIMITE_MAXIMO = 1000
+
+# Ventas y compras se listan en orden cronológico: keyset sobre (fecha, id)
+CAMPO_ORDEN = {"ventas": "fecha", "compras": "fecha"}
+EPOCA = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def campos_cursor(nombre):
+    return [campo for campo in (CAMPO_ORDEN.get(nombre), "id") if campo]
+
+def codificar_cursor(coleccion, documento):
+    campo = CAMPO_ORDEN.get(coleccion.name)
+    if not campo:
+        return documento["id"]
+    # Milisegundos enteros: la misma precisión con la que Mongo guarda las fechas
+    milisegundos = (fecha_utc(documento[campo]) - EPOCA) // timedelta(milliseconds=1)
+    return f"{milisegundos}_{documento['id']}"
+
+def filtro_cursor(coleccion, after):
+    campo = CAMPO_ORDEN.get(coleccion.name)
+    if not campo:
+        return {"id": {"$gt": after}}
+    milisegundos, _, ultimo_id = after.partition("_")
+    try:
+        valor = EPOCA + timedelta(milliseconds=int(milisegundos))
+    except (ValueError, OverflowError):
+        raise HTTPException(status_code=400, detail="Cursor no válido")
+    if not ultimo_id:
+        raise HTTPException(status_code=400, detail="Cursor no válido")
+    return {"$or": [{campo: {"$gt": valor}}, {campo: valor, "id": {"$gt": ultimo_id}}]}
+
+T = TypeVar("T")
+
+class Pagina(BaseModel, Generic[T]):
+    items: List[T]
+    next_cursor: Optional[str] = None
+
+async def leer_pagina(coleccion, filtro=None, after=None, limit=LIMITE_POR_DEFECTO, proyeccion=None):
+    consulta = dict(filtro or {})
+    if after:
+        consulta.update(filtro_cursor(coleccion, after))
+    orden = [(campo, 1) for campo in campos_cursor(coleccion.name)]
+    # Se pide un documento extra para saber si hay una página siguiente
+    documentos = await coleccion.find(consulta, proyeccion or {"_id": 0}).sort(orden).limit(limit + 1).to_list(None)
+    next_cursor = None
+    if len(documentos) > limit:
+        documentos = documentos[:limit]
+        next_cursor = codificar_cursor(coleccion, documentos[-1])
+    return documentos, next_cursor
+
+def proyeccion(modelo):
+    # Solo los campos del modelo: los documentos escritos por la API ya son válidos
+    return {"_id": 0, **{campo: 1 for campo in modelo.model_fields}}
+
+async def paginar(coleccion, modelo, filtro=None, after=None, limit=LIMITE_POR_DEFECTO):
+    documentos, next_cursor = await leer_pagina(coleccion, filtro, after, limit, proyeccion(modelo))
+    return {"items": documentos, "next_cursor": next_cursor}
+
+def transmitir_ndjson(coleccion, modelo, filtro=None, after=None, headers=None):
+    consulta = dict(filtro or {})
+    if after:
+        consulta.update(filtro_cursor(coleccion, after))
+    orden = [(campo, 1) for campo in campos_cursor(coleccion.name)]
+
+    async def generar():
+        # Un documento por línea directamente desde el cursor, memoria constante
+        async for documento in coleccion.find(consulta, proyeccion(modelo)).sort(orden):
+            yield a_json(documento) + b"\n"
+
+    return StreamingResponse(generar(), media_type="application/x-ndjson", headers=headers)
+
+async def listar(coleccion, modelo, response, filtro=None, after=None, limit=LIMITE_POR_DEFECTO, formato="json"):
+    if formato == "ndjson":
+        return transmitir_ndjson(coleccion, modelo, filtro, after, response.headers)
+    return RespuestaJSON(await paginar(coleccion, modelo, filtro, after, limit), headers=response.headers)
+
+# Resumen materializado de comparativas
+RESUMEN_COMPARATIVAS_ID = "comparativas"
+
+def resumen_vacio():
+    return {
+        "_id": RESUMEN_COMPARATIVAS_ID,
+        "total_ventas": 0,
+        "total_compras": 0,
+        "costo_ventas": 0,
+        "ingresos_costeados": 0,
+        "cantidad_ventas": 0,
+        "cantidad_compras": 0,
+        "ventas_por_metodo": {},
+        "compras_por_metodo": {}
+    }
+
+def ingresos_costeados(lineas):
+    # Ingresos de las líneas vendidas con costo conocido; solo sobre ellas hay margen
+    return sum(linea["subtotal"] for linea in lineas if linea.get("costo_unitario") is not None)
+
+async def actualizar_resumen(tipo, total, metodo_pago, signo=1, session=None, costo=0, costeado=0):
+    # tipo es "ventas" o "compras"; signo -1 al eliminar; costo y costeado solo aplican a ventas
+    incrementos = {
+        f"total_{tipo}": signo * total,
+        f"cantidad_{tipo}": signo,
+        f"{tipo}_por_metodo.{metodo_pago}": signo * total
+    }
+    if tipo == "ventas":
+        incrementos["costo_ventas"] = signo * costo
+        incrementos["ingresos_costeados"] = signo * costeado
+    await db.resumenes.update_one(
+        {"_id": RESUMEN_COMPARATIVAS_ID},
+        {"$inc": incrementos},
+        upsert=True,
+        session=session
+    )
+
+async def reconstruir_comparativas():
+    # Recalcula el resumen desde cero agrupando en MongoDB
+    resumen = resumen_vacio()
+    for tipo in ("ventas", "compras"):
+        pipeline = [{"$group": {
+            "_id": "$metodo_pago",
+            "total": {"$sum": "$total"},
+            "costo": {"$sum": {"$ifNull": ["$costo_total", 0]}},
+            "cantidad": {"$sum": 1}
+        }}]
+        async for grupo in db[tipo].aggregate(pipeline):
+            if tipo == "ventas":
+                resumen["costo_ventas"] += grupo["costo"]
+            resumen[f"total_{tipo}"] += grupo["total"]
+            resumen[f"cantidad_{tipo}"] += grupo["cantidad"]
+            resumen[f"{tipo}_por_metodo"][grupo["_id"]] = grupo["total"]
+    costeados = db.ventas.aggregate([
+        {"$unwind": "$productos"},
+        {"$match": {"productos.costo_unitario": {"$ne": None}}},
+        {"$group": {"_id": None, "ingresos": {"$sum": "$productos.subtotal"}}}
+    ])
+    async for grupo in costeados:
+        resumen["ingresos_costeados"] += grupo["ingresos"]
+    # Lo archivado ya no está en ventas/compras pero sigue contando en los totales
+    async for periodo in db.periodos.find():
+        tipo = periodo["tipo"]
+        resumen[f"total_{tipo}"] += periodo["total"]
+        resumen[f"cantidad_{tipo}"] += periodo["cantidad"]
+        if tipo == "ventas":
+            resumen["costo_ventas"] += periodo.get("costo", 0)
+            resumen["ingresos_costeados"] += periodo.get("ingresos_costeados", 0)
+        for metodo, total in periodo["por_metodo"].items():
+            resumen[f"{tipo}_por_metodo"][metodo] = resumen[f"{tipo}_por_metodo"].get(metodo, 0) + total
+    await db.resumenes.replace_one({"_id": RESUMEN_COMPARATIVAS_ID}, resumen, upsert=True)
+    return resumen
+
+# Historial resumido por cliente y por proveedor
+# tipo -> (colección del resumen, colección de movimientos, campo de la entidad)
+HISTORIALES = {
+    "clientes": ("resumen_clientes", "ventas", "cliente_id"),
+    "proveedores": ("resumen_proveedores", "compras", "proveedor_id")
+}
+
+async def actualizar_historial(tipo, documento, signo=1, session=None):
+    # documento es la venta o compra completa; signo -1 al eliminar
+    coleccion, movimientos, campo = HISTORIALES[tipo]
+    cambios = {"$inc": {"total": signo * documento["total"], "cantidad": signo}}
+    for linea in documento["productos"]:
+        clave = f"productos.{linea['producto_id']}"
+        cambios["$inc"][f"{clave}.unidades"] = cambios["$inc"].get(f"{clave}.unidades", 0) + signo * linea["cantidad"]
+        cambios["$inc"][f"{clave}.monto"] = cambios["$inc"].get(f"{clave}.monto", 0) + signo * linea["subtotal"]
+        cambios.setdefault("$set", {})[f"{clave}.nombre"] = linea["nombre"]
+    if signo > 0:
+        cambios["$max"] = {"ultima_fecha": documento["fecha"]}
+    await db[coleccion].update_one({"_id": documento[campo]}, cambios, upsert=True, session=session)
+    
+    if signo < 0:
+        # $max no se puede deshacer: la última fecha se vuelve a leer de los movimientos
+        ultimo = await db[movimientos].find_one(
+            {campo: documento[campo]}, {"fecha": 1}, sort=[("fecha", -1)], session=session
+        )
+        await db[coleccion].update_one(
+            {"_id": documento[campo]},
+            {"$set": {"ultima_fecha": ultimo["fecha"] if ultimo else None}},
+            session=session
+        )
+
+async def reconstruir_historiales(tipo):
+    # Recalcula los resúmenes de todas las entidades agrupando en MongoDB,
+    # sobre la colección activa y sus colecciones de archivo; lo archivado en
+    # disco se suma lote a lote leyendo sus partes
+    coleccion, movimientos, campo = HISTORIALES[tipo]
+    fuentes = [movimientos, *await colecciones_archivo(movimientos)]
+    resumenes = {}
+    totales = [{"$group": {
+        "_id": f"${campo}",
+        "total": {"$sum": "$total"},
+        "cantidad": {"$sum": 1},
+        "ultima_fecha": {"$max": "$fecha"}
+    }}]
+    por_producto = [
+        {"$unwind": "$productos"},
+        {"$group": {
+            "_id": {"entidad": f"${campo}", "producto_id": "$productos.producto_id"},
+            "nombre": {"$last": "$productos.nombre"},
+            "unidades": {"$sum": "$productos.cantidad"},
+            "monto": {"$sum": "$productos.subtotal"}
+        }}
+    ]
+    
+    def sumar_total(grupo):
+        resumen = resumenes.setdefault(
+            grupo["_id"], {"_id": grupo["_id"], "total": 0, "cantidad": 0, "ultima_fecha": None, "productos": {}}
+        )
+        resumen["total"] += grupo["total"]
+        resumen["cantidad"] += grupo["cantidad"]
+        resumen["ultima_fecha"] = max(filter(None, [resumen["ultima_fecha"], grupo["ultima_fecha"]]), default=None)
+    
+    def sumar_producto(entidad, producto_id, nombre, unidades, monto):
+        producto = resumenes[entidad]["productos"].setdefault(producto_id, {"nombre": nombre, "unidades": 0, "monto": 0})
+        producto["unidades"] += unidades
+        producto["monto"] += monto
+    
+    for fuente in fuentes:
+        async for grupo in db[fuente].aggregate(totales):
+            sumar_total(grupo)
+        async for grupo in db[fuente].aggregate(por_producto):
+            sumar_producto(grupo["_id"]["entidad"], grupo["_id"]["producto_id"], grupo["nombre"], grupo["unidades"], grupo["monto"])
+    async for lote in documentos_ndjson(movimientos):
+        for documento in lote:
+            sumar_total({"_id": documento[campo], "total": documento["total"], "cantidad": 1, "ultima_fecha": documento["fecha"]})
+            for linea in documento["productos"]:
+                sumar_producto(documento[campo], linea["producto_id"], linea["nombre"], linea["cantidad"], linea["subtotal"])
+    await db[coleccion].delete_many({})
+    if resumenes:
+        await db[coleccion].insert_many(list(resumenes.values()))
+    return len(resumenes)
+
+async def leer_historial(tipo, entidad_id, top):
+    coleccion = HISTORIALES[tipo][0]
+    resumen = await db[coleccion].find_one({"_id": entidad_id}) or {}
+    cantidad = resumen.get("cantidad", 0)
+    total = resumen.get("total", 0)
+    productos = [
+        {"producto_id": producto_id, **producto, "monto": round(producto["monto"], 2)}
+        for producto_id, producto in resumen.get("productos", {}).items()
+        if producto["unidades"] > 0
+    ]
+    productos.sort(key=lambda producto: producto["monto"], reverse=True)
+    return {
+        "total": round(total, 2),
+        "cantidad": cantidad,
+        "ticket_promedio": round(total / cantidad, 2) if cantidad else 0,
+        "ultima_fecha": resumen.get("ultima_fecha"),
+        "productos_top": productos[:top]
+    }
+
+# Idempotencia de POST /ventas y /compras
+async def completar_idempotencia(registro_id, respuesta, session=None):
+    await db.idempotencia.update_one(
+        {"_id": registro_id},
+        {"$set": {"estado": "completado", "respuesta": respuesta}},
+        session=session
+    )
+
+async def con_idempotencia(clave, ruta, modelo, cuerpo, operacion):
+    # Sin clave se ejecuta normal; con clave, un reintento devuelve la respuesta guardada.
+    # La reserva fija de antemano el id del documento: si el proceso cae a mitad de camino,
+    # quien retome la clave sabe qué buscar antes de volver a ejecutar.
+    # operacion(documento_id, registro_id) completa la clave en la transacción que escribe
+    if not clave:
+        return RespuestaJSON(a_json((await operacion(None, None)).model_dump()))
+    
+    registro_id = f"{ruta}:{clave}"
+    huella = hashlib.sha256(orjson.dumps(cuerpo.model_dump(), option=orjson.OPT_SORT_KEYS)).hexdigest()
+    while True:
+        ahora = datetime.now(timezone.utc)
+        reserva = {
+            "_id": registro_id,
+            "huella": huella,
+            "estado": "en_curso",
+            "documento_id": str(uuid.uuid4()),
+            "vence": ahora + timedelta(seconds=IDEMPOTENCIA_RESERVA),
+            "creado": ahora
+        }
+        try:
+            await db.idempotencia.insert_one(reserva)
+            documento_id = reserva["documento_id"]
+            break
+        except DuplicateKeyError:
+            registro = await db.idempotencia.find_one({"_id": registro_id})
+            if registro is None:
+                # Expiró entre el insert y la lectura: volver a reservarla
+                continue
+            if registro["huella"] != huella:
+                raise HTTPException(status_code=422, detail="Idempotency-Key ya usada con otro contenido")
+            if registro["estado"] == "completado":
+                return RespuestaJSON(registro["respuesta"], headers={"Idempotent-Replayed": "true"})
+            # Reserva vencida: solo un reintento la retoma
+            registro = await db.idempotencia.find_one_and_update(
+                {"_id": registro_id, "estado": "en_curso", "vence": {"$lte": ahora}},
+                {"$set": {"vence": ahora + timedelta(seconds=IDEMPOTENCIA_RESERVA)}},
+                return_document=ReturnDocument.AFTER
+            )
+            if registro is None:
+                raise HTTPException(status_code=409, detail="Hay una solicitud en curso con esta Idempotency-Key")
+            documento_id = registro["documento_id"]
+            # La ejecución anterior pudo haber escrito el documento antes de caer
+            existente = await db[ruta].find_one({"id": documento_id}, proyeccion(modelo))
+            if existente:
+                respuesta = a_json(existente)
+                await completar_idempotencia(registro_id, respuesta)
+                return RespuestaJSON(respuesta, headers={"Idempotent-Replayed": "true"})
+            break
+    
+    try:
+        resultado = await operacion(documento_id, registro_id)
+    except BaseException as error:
+        # Lo que falla después de escribir (eventos, publicación) no libera la clave:
+        # un reintento volvería a registrar la venta o la compra
+        existente = await db[ruta].find_one({"id": documento_id}, proyeccion(modelo))
+        if not existente:
+            # No quedó nada escrito y el cliente puede reintentar con la misma clave
+            await db.idempotencia.delete_one({"_id": registro_id})
+            raise
+        respuesta = a_json(existente)
+        await completar_idempotencia(registro_id, respuesta)
+        if not isinstance(error, Exception):
+            raise
+        return RespuestaJSON(respuesta, headers={"Idempotent-Replayed": "true"})
+    return RespuestaJSON(a_json(resultado.model_dump()))
+
+# Sincronización incremental (/api/sync)
+# Cada escritura sella sus documentos con _version, tomado de un contador global.
+# Una versión queda pendiente mientras su escritura no termina; el token de /sync
+# nunca pasa de la menor pendiente, así un cliente no salta cambios aún en curso.
+
+@asynccontextmanager
+async def version_sync():
+    # La pendiente se registra antes de incrementar el contador: quien lea el contador
+    # y después las pendientes ve todas las versiones menores que aún no terminaron
+    actual = await db.contadores.find_one({"_id": "sync"})
+    pendiente = await db.versiones_pendientes.insert_one({
+        "minimo": (actual["valor"] if actual else 0) + 1,
+        "creado": datetime.now(timezone.utc)
+    })
+    try:
+        contador = await db.contadores.find_one_and_update(
+            {"_id": "sync"}, {"$inc": {"valor": 1}}, upsert=True, return_document=ReturnDocument.AFTER
+        )
+        yield contador["valor"]
+    finally:
+        await db.versiones_pendientes.delete_one({"_id": pendiente.inserted_id})
+
+async def token_sync():
+    actual = await db.contadores.find_one({"_id": "sync"})
+    token = actual["valor"] if actual else 0
+    pendiente = await db.versiones_pendientes.find_one({}, sort=[("minimo", 1)])
+    if pendiente:
+        token = min(token, pendiente["minimo"] - 1)
+    return token
+
+async def registrar_eliminacion(coleccion, documento_id, version, session=None):
+    await db.eliminados.insert_one({
+        "coleccion": coleccion,
+        "id": documento_id,
+        "_version": version,
+        "fecha": datetime.now(timezone.utc)
+    }, session=session)
+
+# Eventos de cambios para /api/eventos
+# Con EVENTOS_FUENTE=change_stream los eventos pasan por la colección eventos y cada
+# worker los recibe de un change stream; por defecto se reparten en memoria del proceso
+EVENTOS_FUENTE = os.environ.get('EVENTOS_FUENTE', 'memoria')
+EVENTOS_CAPACIDAD = int(os.environ.get('EVENTOS_CAPACIDAD', 256))
+EVENTOS_KEEPALIVE = float(os.environ.get('EVENTOS_KEEPALIVE', 15))
+
+class CanalEventos:
+    def __init__(self, capacidad):
+        self.capacidad = capacidad
+        self.suscriptores = set()
+        self.secuencia = 0
+
+    def suscribir(self):
+        cola = asyncio.Queue(self.capacidad)
+        self.suscriptores.add(cola)
+        return cola
+
+    def cancelar(self, cola):
+        self.suscriptores.discard(cola)
+
+    def difundir(self, evento):
+        self.secuencia += 1
+        for cola in list(self.suscriptores):
+            try:
+                cola.put_nowait((self.secuencia, evento))
+            except asyncio.QueueFull:
+                # Un cliente lento no frena a los demás: se le pide recargar todo
+                while not cola.empty():
+                    cola.get_nowait()
+                cola.put_nowait((self.secuencia, {"tipo": "desbordado"}))
+
+canal_eventos = CanalEventos(EVENTOS_CAPACIDAD)
+
+def delta_stock(lineas, signo):
+    return {producto_id: signo * cantidad for producto_id, cantidad in cantidades_por_producto(lineas).items()}
+
+async def publicar(evento):
+    if EVENTOS_FUENTE == "change_stream":
+        await db.eventos.insert_one({**evento, "fecha": datetime.now(timezone.utc)})
+    else:
+        canal_eventos.difundir(evento)
+
+async def escuchar_eventos():
+    # Reparte a los suscriptores locales lo que insertan todos los workers
+    token = None
+    while True:
+        try:
+            async with db.eventos.watch([{"$match": {"operationType": "insert"}}], resume_after=token) as stream:
+                async for cambio in stream:
+                    token = stream.resume_token
+                    evento = cambio["fullDocument"]
+                    evento.pop("_id", None)
+                    evento.pop("fecha", None)
+                    canal_eventos.difundir(evento)
+        except asyncio.CancelledError:
+            raise
+        except Exception as error:
+            logger.warning("Change stream de eventos interrumpido: %s", error)
+            await asyncio.sleep(1)
 
 # Models
 class Cliente(BaseModel):
@@ -85,6 +1193,8 @@ class Producto(BaseModel):
     precio: float
     stock: int
     imagen_url: str = ""
+    # Costo promedio ponderado, mantenido por las compras; None hasta la primera
+    costo_promedio: Optional[float] = None
     fecha_creacion: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class ProductoCreate(BaseModel):
@@ -101,6 +1211,11 @@ class ProductoVenta(BaseModel):
     cantidad: int
     precio_unitario: float
     subtotal: float
+    # Costo promedio del producto al momento de la venta
+    costo_unitario: Optional[float] = None
+
+# También son claves de los resúmenes (ventas_por_metodo.<método>), así que no se aceptan otros
+MetodoPago = Literal["USD", "Transferencia"]
 
 class Venta(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -108,13 +1223,18 @@ class Venta(BaseModel):
     cliente_nombre: str
     productos: List[ProductoVenta]
     total: float
+    costo_total: float = 0
     metodo_pago: str  # USD o Transferencia
     fecha: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
+class ProductoVentaCreate(BaseModel):
+    producto_id: str
+    cantidad: int = Field(gt=0)
+
 class VentaCreate(BaseModel):
     cliente_id: str
-    productos: List[ProductoVenta]
-    metodo_pago: str
+    productos: List[ProductoVentaCreate] = Field(min_length=1)
+    metodo_pago: MetodoPago
 
 class ProductoCompra(BaseModel):
     producto_id: str
@@ -132,46 +1252,153 @@ class Compra(BaseModel):
     metodo_pago: str  # USD o Transferencia
     fecha: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
+class ProductoCompraCreate(BaseModel):
+    producto_id: str
+    cantidad: int = Field(gt=0)
+    precio_unitario: float = Field(ge=0)  # Costo pactado con el proveedor
+
 class CompraCreate(BaseModel):
     proveedor_id: str
-    productos: List[ProductoCompra]
-    metodo_pago: str
+    productos: List[ProductoCompraCreate] = Field(min_length=1)
+    metodo_pago: MetodoPago
+
+# Costo promedio inicial para productos anteriores al costo ponderado
+async def inicializar_costos():
+    # Promedio simple de todas las compras de cada producto sin costo_promedio
+    pipeline = [
+        {"$unwind": "$productos"},
+        {"$group": {
+            "_id": "$productos.producto_id",
+            "unidades": {"$sum": "$productos.cantidad"},
+            "costo_total": {"$sum": "$productos.subtotal"}
+        }},
+        {"$match": {"unidades": {"$gt": 0}}}
+    ]
+    operaciones = [
+        UpdateOne(
+            {"id": grupo["_id"], "costo_promedio": None},
+            {"$set": {"costo_promedio": round(grupo["costo_total"] / grupo["unidades"], 4)}}
+        )
+        async for grupo in db.compras.aggregate(pipeline)
+    ]
+    if not operaciones:
+        return 0
+    resultado = await db.productos.bulk_write(operaciones, ordered=False)
+    return resultado.modified_count
+
+# Migración de fechas guardadas como texto ISO a fechas BSON
+MODELOS_POR_COLECCION = {
+    "clientes": Cliente,
+    "proveedores": Proveedor,
+    "productos": Producto,
+    "ventas": Venta,
+    "compras": Compra
+}
+
+async def migrar_fechas():
+    reporte = []
+    for coleccion, modelo in MODELOS_POR_COLECCION.items():
+        for campo in campos_fecha(modelo):
+            # Conversión en el servidor con un solo update por campo
+            resultado = await db[coleccion].update_many(
+                {campo: {"$type": "string"}},
+                [{"$set": {campo: {"$toDate": f"${campo}"}}}]
+            )
+            reporte.append({"coleccion": coleccion, "campo": campo, "migrados": resultado.modified_count})
+    return reporte
 
 # Routes for Clientes
 @api_router.post("/clientes", response_model=Cliente)
 async def crear_cliente(cliente: ClienteCreate):
     cliente_dict = cliente.dict()
     cliente_obj = Cliente(**cliente_dict)
-    cliente_mongo = prepare_for_mongo(cliente_obj.dict())
-    await db.clientes.insert_one(cliente_mongo)
+    cliente_mongo = cliente_obj.dict()
+    async def registrar(session):
+        await db.clientes.insert_one({**cliente_mongo, "_version": version}, session=session)
+        await registrar_cambios("clientes", session=session)
+    
+    async with version_sync() as version:
+        try:
+            await en_transaccion(registrar)
+        except DuplicateKeyError:
+            raise HTTPException(status_code=409, detail="Ya existe un cliente con ese RUC")
+    await publicar({"tipo": "cliente_guardado", "cliente": cliente_obj.model_dump()})
     return cliente_obj
 
-@api_router.get("/clientes", response_model=List[Cliente])
-async def obtener_clientes():
-    clientes = await db.clientes.find().to_list(1000)
-    return [Cliente(**parse_from_mongo(cliente)) for cliente in clientes]
+@api_router.get("/clientes", response_model=Pagina[Cliente])
+async def obtener_clientes(
+    request: Request,
+    response: Response,
+    after: Optional[str] = None,
+    limit: int = Query(LIMITE_POR_DEFECTO, ge=1, le=LIMITE_MAXIMO),
+    formato: str = Query("json", pattern="^(json|ndjson)$")
+):
+    no_modificado = await respuesta_condicional(request, response, "clientes")
+    if no_modificado:
+        return no_modificado
+    return await listar(db.clientes, Cliente, response, after=after, limit=limit, formato=formato)
 
 @api_router.get("/clientes/{cliente_id}", response_model=Cliente)
-async def obtener_cliente(cliente_id: str):
-    cliente = await db.clientes.find_one({"id": cliente_id})
+async def obtener_cliente(cliente_id: str, request: Request, response: Response):
+    no_modificado = await respuesta_condicional(request, response, "clientes")
+    if no_modificado:
+        return no_modificado
+    cliente = await db.clientes.find_one({"id": cliente_id}, proyeccion(Cliente))
     if not cliente:
         raise HTTPException(status_code=404, detail="Cliente no encontrado")
-    return Cliente(**parse_from_mongo(cliente))
+    return RespuestaJSON(cliente, headers=response.headers)
+
+@api_router.get("/clientes/{cliente_id}/resumen")
+async def obtener_resumen_cliente(
+    cliente_id: str,
+    request: Request,
+    response: Response,
+    top: int = Query(5, ge=1, le=50)
+):
+    no_modificado = await respuesta_condicional(request, response, "clientes", "ventas")
+    if no_modificado:
+        return no_modificado
+    cliente = await db.clientes.find_one({"id": cliente_id}, {"_id": 0, "id": 1, "nombre_completo": 1})
+    if not cliente:
+        raise HTTPException(status_code=404, detail="Cliente no encontrado")
+    return RespuestaJSON({**cliente, **await leer_historial("clientes", cliente_id, top)}, headers=response.headers)
 
 @api_router.put("/clientes/{cliente_id}", response_model=Cliente)
 async def actualizar_cliente(cliente_id: str, cliente_update: ClienteCreate):
     cliente_dict = cliente_update.dict()
-    await db.clientes.update_one({"id": cliente_id}, {"$set": cliente_dict})
-    cliente_actualizado = await db.clientes.find_one({"id": cliente_id})
-    if not cliente_actualizado:
-        raise HTTPException(status_code=404, detail="Cliente no encontrado")
-    return Cliente(**parse_from_mongo(cliente_actualizado))
+    async def actualizar(session):
+        actualizado = await db.clientes.find_one_and_update(
+            {"id": cliente_id},
+            {"$set": {**cliente_dict, "_version": version}},
+            projection=proyeccion(Cliente),
+            return_document=ReturnDocument.AFTER,
+            session=session
+        )
+        if not actualizado:
+            raise HTTPException(status_code=404, detail="Cliente no encontrado")
+        await registrar_cambios("clientes", session=session)
+        return actualizado
+    
+    async with version_sync() as version:
+        try:
+            cliente_actualizado = await en_transaccion(actualizar)
+        except DuplicateKeyError:
+            raise HTTPException(status_code=409, detail="Ya existe un cliente con ese RUC")
+    await publicar({"tipo": "cliente_guardado", "cliente": Cliente(**cliente_actualizado).model_dump()})
+    return Cliente(**cliente_actualizado)
 
 @api_router.delete("/clientes/{cliente_id}")
 async def eliminar_cliente(cliente_id: str):
-    result = await db.clientes.delete_one({"id": cliente_id})
-    if result.deleted_count == 0:
-        raise HTTPException(status_code=404, detail="Cliente no encontrado")
+    async def eliminar(session):
+        result = await db.clientes.delete_one({"id": cliente_id}, session=session)
+        if result.deleted_count == 0:
+            raise HTTPException(status_code=404, detail="Cliente no encontrado")
+        await registrar_eliminacion("clientes", cliente_id, version, session)
+        await registrar_cambios("clientes", session=session)
+    
+    async with version_sync() as version:
+        await en_transaccion(eliminar)
+    await publicar({"tipo": "cliente_eliminado", "id": cliente_id})
     return {"message": "Cliente eliminado correctamente"}
 
 # Routes for Proveedores
@@ -179,36 +1406,93 @@ async def eliminar_cliente(cliente_id: str):
 async def crear_proveedor(proveedor: ProveedorCreate):
     proveedor_dict = proveedor.dict()
     proveedor_obj = Proveedor(**proveedor_dict)
-    proveedor_mongo = prepare_for_mongo(proveedor_obj.dict())
-    await db.proveedores.insert_one(proveedor_mongo)
+    proveedor_mongo = proveedor_obj.dict()
+    async def registrar(session):
+        await db.proveedores.insert_one({**proveedor_mongo, "_version": version}, session=session)
+        await registrar_cambios("proveedores", session=session)
+    
+    async with version_sync() as version:
+        try:
+            await en_transaccion(registrar)
+        except DuplicateKeyError:
+            raise HTTPException(status_code=409, detail="Ya existe un proveedor con ese RUC")
+    await publicar({"tipo": "proveedor_guardado", "proveedor": proveedor_obj.model_dump()})
     return proveedor_obj
 
-@api_router.get("/proveedores", response_model=List[Proveedor])
-async def obtener_proveedores():
-    proveedores = await db.proveedores.find().to_list(1000)
-    return [Proveedor(**parse_from_mongo(proveedor)) for proveedor in proveedores]
+@api_router.get("/proveedores", response_model=Pagina[Proveedor])
+async def obtener_proveedores(
+    request: Request,
+    response: Response,
+    after: Optional[str] = None,
+    limit: int = Query(LIMITE_POR_DEFECTO, ge=1, le=LIMITE_MAXIMO),
+    formato: str = Query("json", pattern="^(json|ndjson)$")
+):
+    no_modificado = await respuesta_condicional(request, response, "proveedores")
+    if no_modificado:
+        return no_modificado
+    return await listar(db.proveedores, Proveedor, response, after=after, limit=limit, formato=formato)
 
 @api_router.get("/proveedores/{proveedor_id}", response_model=Proveedor)
-async def obtener_proveedor(proveedor_id: str):
-    proveedor = await db.proveedores.find_one({"id": proveedor_id})
+async def obtener_proveedor(proveedor_id: str, request: Request, response: Response):
+    no_modificado = await respuesta_condicional(request, response, "proveedores")
+    if no_modificado:
+        return no_modificado
+    proveedor = await db.proveedores.find_one({"id": proveedor_id}, proyeccion(Proveedor))
+    if not proveedor:
+        raise HTTPException(status_code=404, detail="Proveedor no encontrado")
+    return RespuestaJSON(proveedor, headers=response.headers)
+
+@api_router.get("/proveedores/{proveedor_id}/resumen")
+async def obtener_resumen_proveedor(
+    proveedor_id: str,
+    request: Request,
+    response: Response,
+    top: int = Query(5, ge=1, le=50)
+):
+    no_modificado = await respuesta_condicional(request, response, "proveedores", "compras")
+    if no_modificado:
+        return no_modificado
+    proveedor = await db.proveedores.find_one({"id": proveedor_id}, {"_id": 0, "id": 1, "nombre_completo": 1})
     if not proveedor:
         raise HTTPException(status_code=404, detail="Proveedor no encontrado")
-    return Proveedor(**parse_from_mongo(proveedor))
+    return RespuestaJSON({**proveedor, **await leer_historial("proveedores", proveedor_id, top)}, headers=response.headers)
 
 @api_router.put("/proveedores/{proveedor_id}", response_model=Proveedor)
 async def actualizar_proveedor(proveedor_id: str, proveedor_update: ProveedorCreate):
     proveedor_dict = proveedor_update.dict()
-    await db.proveedores.update_one({"id": proveedor_id}, {"$set": proveedor_dict})
-    proveedor_actualizado = await db.proveedores.find_one({"id": proveedor_id})
-    if not proveedor_actualizado:
-        raise HTTPException(status_code=404, detail="Proveedor no encontrado")
-    return Proveedor(**parse_from_mongo(proveedor_actualizado))
+    async def actualizar(session):
+        actualizado = await db.proveedores.find_one_and_update(
+            {"id": proveedor_id},
+            {"$set": {**proveedor_dict, "_version": version}},
+            projection=proyeccion(Proveedor),
+            return_document=ReturnDocument.AFTER,
+            session=session
+        )
+        if not actualizado:
+            raise HTTPException(status_code=404, detail="Proveedor no encontrado")
+        await registrar_cambios("proveedores", session=session)
+        return actualizado
+    
+    async with version_sync() as version:
+        try:
+            proveedor_actualizado = await en_transaccion(actualizar)
+        except DuplicateKeyError:
+            raise HTTPException(status_code=409, detail="Ya existe un proveedor con ese RUC")
+    await publicar({"tipo": "proveedor_guardado", "proveedor": Proveedor(**proveedor_actualizado).model_dump()})
+    return Proveedor(**proveedor_actualizado)
 
 @api_router.delete("/proveedores/{proveedor_id}")
 async def eliminar_proveedor(proveedor_id: str):
-    result = await db.proveedores.delete_one({"id": proveedor_id})
-    if result.deleted_count == 0:
-        raise HTTPException(status_code=404, detail="Proveedor no encontrado")
+    async def eliminar(session):
+        result = await db.proveedores.delete_one({"id": proveedor_id}, session=session)
+        if result.deleted_count == 0:
+            raise HTTPException(status_code=404, detail="Proveedor no encontrado")
+        await registrar_eliminacion("proveedores", proveedor_id, version, session)
+        await registrar_cambios("proveedores", session=session)
+    
+    async with version_sync() as version:
+        await en_transaccion(eliminar)
+    await publicar({"tipo": "proveedor_eliminado", "id": proveedor_id})
     return {"message": "Proveedor eliminado correctamente"}
 
 # Routes for Productos
@@ -216,36 +1500,105 @@ async def eliminar_proveedor(proveedor_id: str):
 async def crear_producto(producto: ProductoCreate):
     producto_dict = producto.dict()
     producto_obj = Producto(**producto_dict)
-    producto_mongo = prepare_for_mongo(producto_obj.dict())
-    await db.productos.insert_one(producto_mongo)
+    producto_mongo = producto_obj.dict()
+    async def registrar(session):
+        await db.productos.insert_one({**producto_mongo, "_version": version}, session=session)
+        await registrar_movimientos(
+            [{"producto_id": producto_obj.id, "cantidad": producto_obj.stock}], 1, "alta", producto_obj.id,
+            producto_obj.fecha_creacion, session
+        )
+        await registrar_cambios("productos", session=session)
+    
+    async with version_sync() as version:
+        await en_transaccion(registrar)
+    await publicar({"tipo": "producto_guardado", "producto": producto_obj.model_dump()})
     return producto_obj
 
-@api_router.get("/productos", response_model=List[Producto])
-async def obtener_productos():
-    productos = await db.productos.find().to_list(1000)
-    return [Producto(**parse_from_mongo(producto)) for producto in productos]
+@api_router.get("/productos", response_model=Pagina[Producto])
+async def obtener_productos(
+    request: Request,
+    response: Response,
+    after: Optional[str] = None,
+    limit: int = Query(LIMITE_POR_DEFECTO, ge=1, le=LIMITE_MAXIMO),
+    formato: str = Query("json", pattern="^(json|ndjson)$")
+):
+    no_modificado = await respuesta_condicional(request, response, "productos")
+    if no_modificado:
+        return no_modificado
+    if formato == "ndjson":
+        return transmitir_ndjson(db.productos, Producto, after=after, headers=response.headers)
+    
+    # La caché guarda el cuerpo ya serializado; el ETag lleva la versión de productos,
+    # así una escritura de otro worker no deja un cuerpo viejo bajo el ETag nuevo
+    clave = ("lista", after, limit, response.headers["ETag"])
+    cuerpo = cache_productos.obtener(clave)
+    if cuerpo is None:
+        generacion = cache_productos.generacion
+        cuerpo = a_json(await paginar(db.productos, Producto, after=after, limit=limit))
+        cache_productos.guardar(clave, cuerpo, generacion)
+    return RespuestaJSON(cuerpo, headers=response.headers)
 
 @api_router.get("/productos/{producto_id}", response_model=Producto)
-async def obtener_producto(producto_id: str):
-    producto = await db.productos.find_one({"id": producto_id})
-    if not producto:
-        raise HTTPException(status_code=404, detail="Producto no encontrado")
-    return Producto(**parse_from_mongo(producto))
+async def obtener_producto(producto_id: str, request: Request, response: Response):
+    no_modificado = await respuesta_condicional(request, response, "productos")
+    if no_modificado:
+        return no_modificado
+    clave = ("detalle", producto_id, response.headers["ETag"])
+    cuerpo = cache_productos.obtener(clave)
+    if cuerpo is None:
+        generacion = cache_productos.generacion
+        producto = await db.productos.find_one({"id": producto_id}, proyeccion(Producto))
+        if not producto:
+            raise HTTPException(status_code=404, detail="Producto no encontrado")
+        cuerpo = a_json(producto)
+        cache_productos.guardar(clave, cuerpo, generacion)
+    return RespuestaJSON(cuerpo, headers=response.headers)
 
 @api_router.put("/productos/{producto_id}", response_model=Producto)
 async def actualizar_producto(producto_id: str, producto_update: ProductoCreate):
     producto_dict = producto_update.dict()
-    await db.productos.update_one({"id": producto_id}, {"$set": producto_dict})
-    producto_actualizado = await db.productos.find_one({"id": producto_id})
-    if not producto_actualizado:
-        raise HTTPException(status_code=404, detail="Producto no encontrado")
-    return Producto(**parse_from_mongo(producto_actualizado))
+    
+    async def actualizar(session):
+        # El stock se sobrescribe: el kardex registra la diferencia con el valor anterior
+        anterior = await db.productos.find_one_and_update(
+            {"id": producto_id},
+            {"$set": {**producto_dict, "_version": version}},
+            projection=proyeccion(Producto),
+            session=session
+        )
+        if not anterior:
+            raise HTTPException(status_code=404, detail="Producto no encontrado")
+        if anterior["stock"] != producto_update.stock:
+            await registrar_movimientos(
+                [{"producto_id": producto_id, "cantidad": producto_update.stock - anterior["stock"]}], 1, "ajuste",
+                producto_id, datetime.now(timezone.utc), session
+            )
+        await registrar_cambios("productos", session=session)
+        return {**anterior, **producto_dict}
+    
+    async with version_sync() as version:
+        producto_actualizado = await en_transaccion(actualizar)
+    await publicar({"tipo": "producto_guardado", "producto": Producto(**producto_actualizado).model_dump()})
+    return Producto(**producto_actualizado)
 
 @api_router.delete("/productos/{producto_id}")
 async def eliminar_producto(producto_id: str):
-    result = await db.productos.delete_one({"id": producto_id})
-    if result.deleted_count == 0:
-        raise HTTPException(status_code=404, detail="Producto no encontrado")
+    async def eliminar(session):
+        # El stock que tenía sale del inventario con una baja en el kardex
+        eliminado = await db.productos.find_one_and_delete({"id": producto_id}, {"stock": 1}, session=session)
+        if not eliminado:
+            raise HTTPException(status_code=404, detail="Producto no encontrado")
+        if eliminado.get("stock"):
+            await registrar_movimientos(
+                [{"producto_id": producto_id, "cantidad": eliminado["stock"]}], -1, "baja",
+                producto_id, datetime.now(timezone.utc), session
+            )
+        await registrar_eliminacion("productos", producto_id, version, session)
+        await registrar_cambios("productos", session=session)
+    
+    async with version_sync() as version:
+        await en_transaccion(eliminar)
+    await publicar({"tipo": "producto_eliminado", "id": producto_id})
     return {"message": "Producto eliminado correctamente"}
 
 @api_router.get("/categorias")
@@ -263,47 +1616,102 @@ async def obtener_categorias():
 
 # Routes for Ventas
 @api_router.post("/ventas", response_model=Venta)
-async def crear_venta(venta: VentaCreate):
-    # Obtener datos del cliente
-    cliente = await db.clientes.find_one({"id": venta.cliente_id})
+async def crear_venta(venta: VentaCreate, idempotency_key: Optional[str] = Header(None)):
+    return await con_idempotencia(
+        idempotency_key, "ventas", Venta, venta, lambda venta_id, registro_id: registrar_venta(venta, venta_id, registro_id)
+    )
+
+async def registrar_venta(venta: VentaCreate, venta_id: Optional[str] = None, registro_id: Optional[str] = None):
+    # Obtener datos del cliente y de los productos en paralelo
+    cliente, catalogo = await asyncio.gather(
+        db.clientes.find_one({"id": venta.cliente_id}),
+        cargar_productos(venta.productos)
+    )
     if not cliente:
         raise HTTPException(status_code=404, detail="Cliente no encontrado")
     
-    # Calcular total
-    total = sum([producto.subtotal for producto in venta.productos])
+    # Precios y subtotales desde el catálogo, no desde el cliente
+    lineas = []
+    for linea in venta.productos:
+        producto = catalogo[linea.producto_id]
+        lineas.append(ProductoVenta(
+            producto_id=linea.producto_id,
+            nombre=producto["nombre"],
+            cantidad=linea.cantidad,
+            precio_unitario=producto["precio"],
+            subtotal=round(producto["precio"] * linea.cantidad, 2),
+            costo_unitario=producto.get("costo_promedio")
+        ))
     
     # Crear venta
-    venta_dict = venta.dict()
-    venta_dict["cliente_nombre"] = cliente["nombre_completo"]
-    venta_dict["total"] = total
-    venta_obj = Venta(**venta_dict)
-    venta_mongo = prepare_for_mongo(venta_obj.dict())
-    await db.ventas.insert_one(venta_mongo)
-    
-    # Actualizar contador de ventas del cliente
-    await db.clientes.update_one(
-        {"id": venta.cliente_id},
-        {"$inc": {"contador_ventas": 1}}
+    venta_obj = Venta(
+        **({"id": venta_id} if venta_id else {}),
+        cliente_id=venta.cliente_id,
+        cliente_nombre=cliente["nombre_completo"],
+        productos=lineas,
+        total=round(sum(linea.subtotal for linea in lineas), 2),
+        costo_total=round(sum(linea.cantidad * linea.costo_unitario for linea in lineas if linea.costo_unitario is not None), 2),
+        metodo_pago=venta.metodo_pago
     )
+    venta_mongo = venta_obj.dict()
     
-    # Actualizar stock de productos
-    for producto_venta in venta.productos:
-        await db.productos.update_one(
-            {"id": producto_venta.producto_id},
-            {"$inc": {"stock": -producto_venta.cantidad}}
+    async def registrar(session):
+        # Descontar stock primero: si no alcanza no se escribe nada más
+        await descontar_stock(venta_mongo["productos"], session, version)
+        await registrar_movimientos(venta_mongo["productos"], -1, "venta", venta_obj.id, venta_obj.fecha, session)
+        
+        await db.ventas.insert_one({**venta_mongo, "_version": version}, session=session)
+        
+        # Actualizar contador de ventas del cliente
+        await db.clientes.update_one(
+            {"id": venta.cliente_id},
+            {"$inc": {"contador_ventas": 1}, "$set": {"_version": version}},
+            session=session
+        )
+        await actualizar_resumen(
+            "ventas", venta_obj.total, venta_obj.metodo_pago, session=session,
+            costo=venta_obj.costo_total, costeado=ingresos_costeados(venta_mongo["productos"])
         )
+        await actualizar_historial("clientes", venta_mongo, session=session)
+        await registrar_cambios("ventas", "clientes", "productos", session=session)
+        if registro_id:
+            await completar_idempotencia(registro_id, a_json(venta_obj.model_dump()), session)
+    
+    try:
+        async with version_sync() as version:
+            await en_transaccion(registrar)
+    except StockInsuficiente as error:
+        raise await conflicto_stock(error)
+    await publicar({"tipo": "venta_creada", "venta": venta_obj.model_dump(), "stock": delta_stock(venta_mongo["productos"], -1)})
     
     return venta_obj
 
-@api_router.get("/ventas", response_model=List[Venta])
-async def obtener_ventas():
-    ventas = await db.ventas.find().to_list(1000)
-    return [Venta(**parse_from_mongo(venta)) for venta in ventas]
+@api_router.get("/ventas", response_model=Pagina[Venta])
+async def obtener_ventas(
+    request: Request,
+    response: Response,
+    after: Optional[str] = None,
+    limit: int = Query(LIMITE_POR_DEFECTO, ge=1, le=LIMITE_MAXIMO),
+    formato: str = Query("json", pattern="^(json|ndjson)$")
+):
+    no_modificado = await respuesta_condicional(request, response, "ventas")
+    if no_modificado:
+        return no_modificado
+    return await listar(db.ventas, Venta, response, after=after, limit=limit, formato=formato)
 
-@api_router.get("/ventas/cliente/{cliente_id}", response_model=List[Venta])
-async def obtener_ventas_cliente(cliente_id: str):
-    ventas = await db.ventas.find({"cliente_id": cliente_id}).to_list(1000)
-    return [Venta(**parse_from_mongo(venta)) for venta in ventas]
+@api_router.get("/ventas/cliente/{cliente_id}", response_model=Pagina[Venta])
+async def obtener_ventas_cliente(
+    cliente_id: str,
+    request: Request,
+    response: Response,
+    after: Optional[str] = None,
+    limit: int = Query(LIMITE_POR_DEFECTO, ge=1, le=LIMITE_MAXIMO),
+    formato: str = Query("json", pattern="^(json|ndjson)$")
+):
+    no_modificado = await respuesta_condicional(request, response, "ventas")
+    if no_modificado:
+        return no_modificado
+    return await listar(db.ventas, Venta, response, {"cliente_id": cliente_id}, after, limit, formato)
 
 @api_router.delete("/ventas/{venta_id}")
 async def eliminar_venta(venta_id: str):
@@ -311,65 +1719,135 @@ async def eliminar_venta(venta_id: str):
     if not venta:
         raise HTTPException(status_code=404, detail="Venta no encontrada")
     
-    # Restaurar stock de productos
-    for producto_venta in venta["productos"]:
-        await db.productos.update_one(
-            {"id": producto_venta["producto_id"]},
-            {"$inc": {"stock": producto_venta["cantidad"]}}
+    async def anular(session):
+        # Borrar primero evita restaurar el stock dos veces
+        result = await db.ventas.delete_one({"id": venta_id}, session=session)
+        if result.deleted_count == 0:
+            raise HTTPException(status_code=404, detail="Venta no encontrada")
+        await registrar_eliminacion("ventas", venta_id, version, session)
+        
+        # Restaurar stock: lo que volvió con costo conocido reingresa a ese costo
+        await ingresar_stock([
+            {**linea, "costo": linea["costo_unitario"]}
+            for linea in venta["productos"] if linea.get("costo_unitario") is not None
+        ], session, version)
+        await ajustar_stock([
+            linea for linea in venta["productos"] if linea.get("costo_unitario") is None
+        ], 1, session, version)
+        await registrar_movimientos(
+            venta["productos"], 1, "anulacion_venta", venta_id, datetime.now(timezone.utc), session
         )
+        
+        # Decrementar contador de ventas del cliente
+        await db.clientes.update_one(
+            {"id": venta["cliente_id"]},
+            {"$inc": {"contador_ventas": -1}, "$set": {"_version": version}},
+            session=session
+        )
+        await actualizar_resumen(
+            "ventas", venta["total"], venta["metodo_pago"], signo=-1, session=session,
+            costo=venta.get("costo_total", 0), costeado=ingresos_costeados(venta["productos"])
+        )
+        await actualizar_historial("clientes", venta, signo=-1, session=session)
+        await registrar_cambios("ventas", "clientes", "productos", session=session)
     
-    # Decrementar contador de ventas del cliente
-    await db.clientes.update_one(
-        {"id": venta["cliente_id"]},
-        {"$inc": {"contador_ventas": -1}}
-    )
-    
-    result = await db.ventas.delete_one({"id": venta_id})
+    async with version_sync() as version:
+        await en_transaccion(anular)
+    await publicar({"tipo": "venta_eliminada", "id": venta_id, "cliente_id": venta["cliente_id"], "stock": delta_stock(venta["productos"], 1)})
     return {"message": "Venta eliminada correctamente"}
 
 # Routes for Compras
 @api_router.post("/compras", response_model=Compra)
-async def crear_compra(compra: CompraCreate):
-    # Obtener datos del proveedor
-    proveedor = await db.proveedores.find_one({"id": compra.proveedor_id})
+async def crear_compra(compra: CompraCreate, idempotency_key: Optional[str] = Header(None)):
+    return await con_idempotencia(
+        idempotency_key, "compras", Compra, compra, lambda compra_id, registro_id: registrar_compra(compra, compra_id, registro_id)
+    )
+
+async def registrar_compra(compra: CompraCreate, compra_id: Optional[str] = None, registro_id: Optional[str] = None):
+    # Obtener datos del proveedor y de los productos en paralelo
+    proveedor, catalogo = await asyncio.gather(
+        db.proveedores.find_one({"id": compra.proveedor_id}),
+        cargar_productos(compra.productos)
+    )
     if not proveedor:
         raise HTTPException(status_code=404, detail="Proveedor no encontrado")
     
-    # Calcular total
-    total = sum([producto.subtotal for producto in compra.productos])
+    # El costo unitario lo fija el proveedor; nombre y subtotal los calcula el servidor
+    lineas = [
+        ProductoCompra(
+            producto_id=linea.producto_id,
+            nombre=catalogo[linea.producto_id]["nombre"],
+            cantidad=linea.cantidad,
+            precio_unitario=linea.precio_unitario,
+            subtotal=round(linea.precio_unitario * linea.cantidad, 2)
+        )
+        for linea in compra.productos
+    ]
     
     # Crear compra
-    compra_dict = compra.dict()
-    compra_dict["proveedor_nombre"] = proveedor["nombre_completo"]
-    compra_dict["total"] = total
-    compra_obj = Compra(**compra_dict)
-    compra_mongo = prepare_for_mongo(compra_obj.dict())
-    await db.compras.insert_one(compra_mongo)
-    
-    # Actualizar contador de compras del proveedor
-    await db.proveedores.update_one(
-        {"id": compra.proveedor_id},
-        {"$inc": {"contador_compras": 1}}
+    compra_obj = Compra(
+        **({"id": compra_id} if compra_id else {}),
+        proveedor_id=compra.proveedor_id,
+        proveedor_nombre=proveedor["nombre_completo"],
+        productos=lineas,
+        total=round(sum(linea.subtotal for linea in lineas), 2),
+        metodo_pago=compra.metodo_pago
     )
+    compra_mongo = compra_obj.dict()
     
-    # Actualizar stock de productos
-    for producto_compra in compra.productos:
-        await db.productos.update_one(
-            {"id": producto_compra.producto_id},
-            {"$inc": {"stock": producto_compra.cantidad}}
+    async def registrar(session):
+        await db.compras.insert_one({**compra_mongo, "_version": version}, session=session)
+        
+        # Actualizar contador de compras del proveedor
+        await db.proveedores.update_one(
+            {"id": compra.proveedor_id},
+            {"$inc": {"contador_compras": 1}, "$set": {"_version": version}},
+            session=session
         )
+        
+        # Stock y costo promedio de los productos en una sola operación
+        await ingresar_stock([
+            {**linea, "costo": linea["precio_unitario"]} for linea in compra_mongo["productos"]
+        ], session, version)
+        await registrar_movimientos(compra_mongo["productos"], 1, "compra", compra_obj.id, compra_obj.fecha, session)
+        await actualizar_resumen("compras", compra_obj.total, compra_obj.metodo_pago, session=session)
+        await actualizar_historial("proveedores", compra_mongo, session=session)
+        await registrar_cambios("compras", "proveedores", "productos", session=session)
+        if registro_id:
+            await completar_idempotencia(registro_id, a_json(compra_obj.model_dump()), session)
+    
+    async with version_sync() as version:
+        await en_transaccion(registrar)
+    await publicar({"tipo": "compra_creada", "compra": compra_obj.model_dump(), "stock": delta_stock(compra_mongo["productos"], 1)})
     
     return compra_obj
 
-@api_router.get("/compras", response_model=List[Compra])
-async def obtener_compras():
-    compras = await db.compras.find().to_list(1000)
-    return [Compra(**parse_from_mongo(compra)) for compra in compras]
+@api_router.get("/compras", response_model=Pagina[Compra])
+async def obtener_compras(
+    request: Request,
+    response: Response,
+    after: Optional[str] = None,
+    limit: int = Query(LIMITE_POR_DEFECTO, ge=1, le=LIMITE_MAXIMO),
+    formato: str = Query("json", pattern="^(json|ndjson)$")
+):
+    no_modificado = await respuesta_condicional(request, response, "compras")
+    if no_modificado:
+        return no_modificado
+    return await listar(db.compras, Compra, response, after=after, limit=limit, formato=formato)
 
-@api_router.get("/compras/proveedor/{proveedor_id}", response_model=List[Compra])
-async def obtener_compras_proveedor(proveedor_id: str):
-    compras = await db.compras.find({"proveedor_id": proveedor_id}).to_list(1000)
-    return [Compra(**parse_from_mongo(compra)) for compra in compras]
+@api_router.get("/compras/proveedor/{proveedor_id}", response_model=Pagina[Compra])
+async def obtener_compras_proveedor(
+    proveedor_id: str,
+    request: Request,
+    response: Response,
+    after: Optional[str] = None,
+    limit: int = Query(LIMITE_POR_DEFECTO, ge=1, le=LIMITE_MAXIMO),
+    formato: str = Query("json", pattern="^(json|ndjson)$")
+):
+    no_modificado = await respuesta_condicional(request, response, "compras")
+    if no_modificado:
+        return no_modificado
+    return await listar(db.compras, Compra, response, {"proveedor_id": proveedor_id}, after, limit, formato)
 
 @api_router.delete("/compras/{compra_id}")
 async def eliminar_compra(compra_id: str):
@@ -377,56 +1855,902 @@ async def eliminar_compra(compra_id: str):
     if not compra:
         raise HTTPException(status_code=404, detail="Compra no encontrada")
     
-    # Restaurar stock de productos
-    for producto_compra in compra["productos"]:
-        await db.productos.update_one(
-            {"id": producto_compra["producto_id"]},
-            {"$inc": {"stock": -producto_compra["cantidad"]}}
-        )
+    # Las unidades salen al costo con que entraron
+    lineas = [{**linea, "costo": linea["precio_unitario"]} for linea in compra["productos"]]
     
-    # Decrementar contador de compras del proveedor
-    await db.proveedores.update_one(
-        {"id": compra["proveedor_id"]},
-        {"$inc": {"contador_compras": -1}}
-    )
+    async def anular(session):
+        # Revertir stock y costo promedio de los productos sin dejar el stock negativo
+        await descontar_stock(lineas, session, version, costeado=True)
+        
+        result = await db.compras.delete_one({"id": compra_id}, session=session)
+        if result.deleted_count == 0:
+            # Otra solicitud la eliminó primero: devolver el stock descontado
+            if session is None:
+                await ingresar_stock(lineas, version=version)
+            raise HTTPException(status_code=404, detail="Compra no encontrada")
+        await registrar_eliminacion("compras", compra_id, version, session)
+        await registrar_movimientos(
+            compra["productos"], -1, "anulacion_compra", compra_id, datetime.now(timezone.utc), session
+        )
+        
+        # Decrementar contador de compras del proveedor
+        await db.proveedores.update_one(
+            {"id": compra["proveedor_id"]},
+            {"$inc": {"contador_compras": -1}, "$set": {"_version": version}},
+            session=session
+        )
+        await actualizar_resumen("compras", compra["total"], compra["metodo_pago"], signo=-1, session=session)
+        await actualizar_historial("proveedores", compra, signo=-1, session=session)
+        await registrar_cambios("compras", "proveedores", "productos", session=session)
     
-    result = await db.compras.delete_one({"id": compra_id})
+    try:
+        async with version_sync() as version:
+            await en_transaccion(anular)
+    except StockInsuficiente as error:
+        raise await conflicto_stock(error)
+    await publicar({"tipo": "compra_eliminada", "id": compra_id, "proveedor_id": compra["proveedor_id"], "stock": delta_stock(compra["productos"], -1)})
     return {"message": "Compra eliminada correctamente"}
 
 # Routes for Comparativas
+async def leer_comparativas():
+    # Lectura O(1) del resumen mantenido por ventas y compras
+    resumen = await db.resumenes.find_one({"_id": RESUMEN_COMPARATIVAS_ID})
+    if not resumen:
+        resumen = await reconstruir_comparativas()
+    resumen = {**resumen_vacio(), **resumen}
+    
+    ventas_por_metodo = {"USD": 0, "Transferencia": 0, **resumen.get("ventas_por_metodo", {})}
+    compras_por_metodo = {"USD": 0, "Transferencia": 0, **resumen.get("compras_por_metodo", {})}
+    
+    return {
+        "total_ventas": resumen["total_ventas"],
+        "total_compras": resumen["total_compras"],
+        "costo_ventas": resumen["costo_ventas"],
+        # La ganancia solo cuenta ventas con costo conocido; el resto se informa aparte.
+        # El flujo de caja compara ventas con compras
+        "ganancia_neta": resumen["ingresos_costeados"] - resumen["costo_ventas"],
+        "ventas_sin_costo": resumen["total_ventas"] - resumen["ingresos_costeados"],
+        "flujo_caja": resumen["total_ventas"] - resumen["total_compras"],
+        "ventas_por_metodo": ventas_por_metodo,
+        "compras_por_metodo": compras_por_metodo,
+        "cantidad_ventas": resumen["cantidad_ventas"],
+        "cantidad_compras": resumen["cantidad_compras"]
+    }
+
 @api_router.get("/comparativas")
-async def obtener_comparativas():
-    # Obtener totales de ventas y compras
-    ventas = await db.ventas.find().to_list(1000)
-    compras = await db.compras.find().to_list(1000)
+async def obtener_comparativas(request: Request, response: Response):
+    no_modificado = await respuesta_condicional(request, response, "ventas", "compras")
+    if no_modificado:
+        return no_modificado
+    return await leer_comparativas()
+
+# Routes for Kardex
+@api_router.get("/kardex/{producto_id}")
+async def obtener_kardex(
+    producto_id: str,
+    desde: Optional[datetime] = None,
+    hasta: Optional[datetime] = None,
+    limit: int = Query(LIMITE_MAXIMO, ge=1, le=LIMITE_MAXIMO)
+):
+    hasta = fecha_utc(hasta) if hasta else datetime.now(timezone.utc)
+    rango = {"$lte": hasta}
+    saldo = 0
+    if desde:
+        desde = fecha_utc(desde)
+    else:
+        # Sin desde, el kardex parte del snapshot base
+        base = await db.inventario_snapshots.find_one({}, {"fecha": 1}, sort=[("fecha", 1)])
+        desde = base["fecha"] if base else None
+    if desde:
+        rango["$gt"] = desde
+        saldo = (await stock_a_fecha(desde, producto_id)).get(producto_id, {}).get("stock", 0)
+    saldo_inicial = saldo
+    
+    # Un movimiento extra indica que el rango tiene más de limit
+    movimientos = await db.movimientos.find(
+        {"producto_id": producto_id, "fecha": rango}, {"_id": 0, "producto_id": 0}
+    ).sort("fecha", 1).limit(limit + 1).to_list(None)
+    truncado = len(movimientos) > limit
+    movimientos = movimientos[:limit]
+    for movimiento in movimientos:
+        saldo += movimiento["cantidad"]
+        movimiento["saldo"] = saldo
+    if truncado:
+        # La suma se cortó antes de hasta: el saldo final sale de los snapshots
+        saldo = (await stock_a_fecha(hasta, producto_id)).get(producto_id, {}).get("stock", 0)
+    return RespuestaJSON({
+        "producto_id": producto_id,
+        "saldo_inicial": saldo_inicial,
+        "movimientos": movimientos,
+        "truncado": truncado,
+        "saldo_final": saldo
+    })
+
+@api_router.get("/inventario/historico")
+async def inventario_historico(fecha: Optional[datetime] = None):
+    # Stock y valorización de todo el catálogo a una fecha
+    fecha = fecha_utc(fecha) if fecha else datetime.now(timezone.utc)
+    estado, productos = await asyncio.gather(
+        stock_a_fecha(fecha),
+        db.productos.find({}, {"_id": 0, "id": 1, "nombre": 1}).to_list(None)
+    )
+    nombres = {producto["id"]: producto["nombre"] for producto in productos}
+    detalle = [
+        {
+            "producto_id": producto_id,
+            "nombre": nombres.get(producto_id),
+            "stock": valores["stock"],
+            "costo": valores["costo"],
+            "valor": round(valores["stock"] * valores["costo"], 2) if valores["costo"] is not None else None
+        }
+        for producto_id, valores in estado.items()
+        # Un producto eliminado sin stock a esa fecha ya no forma parte del inventario
+        if valores["stock"] or producto_id in nombres
+    ]
+    return RespuestaJSON({
+        "fecha": fecha,
+        "productos": detalle,
+        "valor_total": round(sum(item["valor"] for item in detalle if item["valor"] is not None), 2),
+        "sin_costo": sum(1 for item in detalle if item["valor"] is None)
+    })
+
+# Routes for Reabastecimiento
+def calcular_reabastecimiento(ventas_diarias, stock, dias, ventana, alfa, plazo, cobertura):
+    # ventas_diarias es una matriz productos x días completos (el último es ayer)
+    media_movil = ventas_diarias[:, -ventana:].mean(axis=1)
+    # Suavizado exponencial en forma cerrada: pesos alfa·(1-alfa)^k desde el día más
+    # reciente, y el resto del peso sobre el primer día como valor inicial
+    pesos = alfa * (1 - alfa) ** np.arange(dias - 1, -1, -1, dtype=float)
+    pesos[0] = (1 - alfa) ** (dias - 1)
+    demanda = ventas_diarias @ pesos
     
-    total_ventas = sum([venta["total"] for venta in ventas])
-    total_compras = sum([compra["total"] for compra in compras])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        dias_cobertura = np.where(demanda > 0, np.maximum(stock, 0) / demanda, np.inf)
+    punto_reorden = demanda * plazo
+    sugerido = np.ceil(np.maximum(demanda * (plazo + cobertura) - stock, 0))
+    # Solo se pide lo que se agota antes de que llegue un pedido hecho hoy; el redondeo
+    # evita que el error de coma flotante deje fuera un stock justo en el punto de reorden
+    sugerido = np.where(stock <= np.round(punto_reorden, 6), sugerido, 0)
+    return media_movil, demanda, dias_cobertura, punto_reorden, sugerido
+
+@api_router.get("/reabastecimiento")
+async def reabastecimiento(
+    dias: int = Query(90, ge=7, le=365),
+    ventana: int = Query(7, ge=1, le=365),
+    alfa: float = Query(0.3, gt=0, le=1),
+    plazo: int = Query(7, ge=0, le=365),
+    cobertura: int = Query(30, ge=1, le=365),
+    solo_sugeridos: bool = False
+):
+    # Demanda diaria por producto a partir de las ventas de los últimos `dias` completos;
+    # el día en curso queda fuera porque su venta parcial subestimaría la demanda
+    ventana = min(ventana, dias)
+    ahora = datetime.now(timezone.utc)
+    fin = ahora.replace(hour=0, minute=0, second=0, microsecond=0)
+    inicio = fin - timedelta(days=dias)
+    # La clave lleva las versiones de las colecciones: una escritura en cualquier worker
+    # cambia la versión, así que ningún proceso sirve un resultado anterior a ella
+    versiones = {
+        version["_id"]: version.get("version", 0)
+        async for version in db.versiones.find({"_id": {"$in": ["ventas", "compras", "productos"]}})
+    }
+    clave = (
+        fin, versiones.get("ventas", 0), versiones.get("compras", 0), versiones.get("productos", 0),
+        dias, ventana, alfa, plazo, cobertura, solo_sugeridos
+    )
+    cuerpo = cache_reabastecimiento.obtener(clave)
+    if cuerpo is not None:
+        return RespuestaJSON(cuerpo)
+    generacion = cache_reabastecimiento.generacion
     
-    ventas_usd = sum([venta["total"] for venta in ventas if venta["metodo_pago"] == "USD"])
-    ventas_transferencia = sum([venta["total"] for venta in ventas if venta["metodo_pago"] == "Transferencia"])
+    pipeline = [
+        {"$match": {"fecha": {"$gte": inicio, "$lt": fin}}},
+        {"$unwind": "$productos"},
+        {"$group": {
+            "_id": {
+                "producto_id": "$productos.producto_id",
+                "dia": {"$dateToString": {"format": FORMATOS_PERIODO["dia"], "date": "$fecha"}}
+            },
+            "unidades": {"$sum": "$productos.cantidad"}
+        }}
+    ]
+    grupos, productos = await asyncio.gather(
+        db.ventas.aggregate(pipeline).to_list(None),
+        db.productos.find({}, {"_id": 0, "id": 1, "nombre": 1, "stock": 1}).to_list(None)
+    )
     
-    compras_usd = sum([compra["total"] for compra in compras if compra["metodo_pago"] == "USD"])
-    compras_transferencia = sum([compra["total"] for compra in compras if compra["metodo_pago"] == "Transferencia"])
+    def calcular():
+        indice = {producto["id"]: posicion for posicion, producto in enumerate(productos)}
+        grupos_validos = [grupo for grupo in grupos if grupo["_id"]["producto_id"] in indice]
+        ventas_diarias = np.zeros((len(productos), dias))
+        if grupos_validos:
+            filas = np.fromiter((indice[grupo["_id"]["producto_id"]] for grupo in grupos_validos), dtype=np.int64)
+            columnas = (
+                np.array([grupo["_id"]["dia"] for grupo in grupos_validos], dtype="datetime64[D]")
+                - np.datetime64(inicio.date(), "D")
+            ).astype(np.int64)
+            unidades = np.fromiter((grupo["unidades"] for grupo in grupos_validos), dtype=float)
+            np.add.at(ventas_diarias, (filas, columnas), unidades)
+        stock = np.fromiter((producto.get("stock", 0) for producto in productos), dtype=float, count=len(productos))
+        return calcular_reabastecimiento(ventas_diarias, stock, dias, ventana, alfa, plazo, cobertura)
     
-    ganancia_neta = total_ventas - total_compras
+    media_movil, suavizado, dias_cobertura, punto_reorden, sugerido = await run_in_threadpool(calcular)
+    detalle = [
+        {
+            "producto_id": producto["id"],
+            "nombre": producto["nombre"],
+            "stock": producto.get("stock", 0),
+            "media_movil": round(float(media_movil[posicion]), 4),
+            "demanda_diaria": round(float(suavizado[posicion]), 4),
+            "dias_cobertura": round(float(dias_cobertura[posicion]), 1) if np.isfinite(dias_cobertura[posicion]) else None,
+            "punto_reorden": round(float(punto_reorden[posicion]), 2),
+            "cantidad_sugerida": int(sugerido[posicion])
+        }
+        for posicion, producto in enumerate(productos)
+        if not solo_sugeridos or sugerido[posicion] > 0
+    ]
+    # Primero lo que se agota antes; sin demanda (cobertura infinita) al final
+    detalle.sort(key=lambda item: item["dias_cobertura"] if item["dias_cobertura"] is not None else float("inf"))
+    cuerpo = a_json({
+        "generado": ahora,
+        "desde": inicio,
+        "hasta": fin,
+        "parametros": {"dias": dias, "ventana": ventana, "alfa": alfa, "plazo": plazo, "cobertura": cobertura},
+        "productos": detalle
+    })
+    cache_reabastecimiento.guardar(clave, cuerpo, generacion)
+    return RespuestaJSON(cuerpo)
+
+# Routes for Reportes
+def filtro_fechas(desde=None, hasta=None):
+    rango = {}
+    if desde:
+        rango["$gte"] = fecha_utc(desde)
+    if hasta:
+        rango["$lte"] = fecha_utc(hasta)
+    return {"fecha": rango} if rango else {}
+
+async def reporte_por_periodo(coleccion, filtro, periodo):
+    pipeline = [
+        {"$match": filtro},
+        {"$group": {
+            "_id": {"$dateToString": {"format": FORMATOS_PERIODO[periodo], "date": "$fecha"}},
+            "total": {"$sum": "$total"},
+            "cantidad": {"$sum": 1}
+        }},
+        {"$sort": {"_id": 1}},
+        {"$project": {"_id": 0, "periodo": "$_id", "total": 1, "cantidad": 1}}
+    ]
+    return await coleccion.aggregate(pipeline).to_list(None)
+
+async def sumar_periodos_archivados(tipo, filas, desde=None, hasta=None):
+    # Los meses archivados se reportan desde sus totales precalculados
+    rango = {}
+    if desde:
+        rango["$gte"] = fecha_utc(desde).strftime(FORMATOS_PERIODO["mes"])
+    if hasta:
+        rango["$lte"] = fecha_utc(hasta).strftime(FORMATOS_PERIODO["mes"])
+    filtro = {"tipo": tipo, **({"periodo": rango} if rango else {})}
+    por_periodo = {fila["periodo"]: dict(fila) for fila in filas}
+    async for archivado in db.periodos.find(filtro):
+        fila = por_periodo.setdefault(archivado["periodo"], {"periodo": archivado["periodo"], "total": 0, "cantidad": 0})
+        fila["total"] += archivado["total"]
+        fila["cantidad"] += archivado["cantidad"]
+    return sorted(por_periodo.values(), key=lambda fila: fila["periodo"])
+
+async def marcar_archivo(response, tipo, desde=None, hasta=None, incluido=False):
+    # X-Incluye-Archivo: false cuando hay meses archivados en el rango que el reporte no cubre;
+    # solo los reportes mensuales de ventas/compras suman los totales archivados
+    rango = {}
+    if desde:
+        rango["$gte"] = fecha_utc(desde).strftime(FORMATOS_PERIODO["mes"])
+    if hasta:
+        rango["$lte"] = fecha_utc(hasta).strftime(FORMATOS_PERIODO["mes"])
+    archivados = incluido or await db.periodos.find_one({"tipo": tipo, **({"periodo": rango} if rango else {})}, {"_id": 1})
+    response.headers["X-Incluye-Archivo"] = "true" if incluido or not archivados else "false"
+
+@api_router.get("/reportes/ventas")
+async def reporte_ventas(
+    response: Response,
+    periodo: str = Query("dia", pattern="^(dia|semana|mes)$"),
+    desde: Optional[datetime] = None,
+    hasta: Optional[datetime] = None,
+    cliente_id: Optional[str] = None
+):
+    filtro = filtro_fechas(desde, hasta)
+    if cliente_id:
+        filtro["cliente_id"] = cliente_id
+    filas = await reporte_por_periodo(db.ventas, filtro, periodo)
+    incluido = periodo == "mes" and not cliente_id
+    if incluido:
+        filas = await sumar_periodos_archivados("ventas", filas, desde, hasta)
+    await marcar_archivo(response, "ventas", desde, hasta, incluido)
+    return filas
+
+@api_router.get("/reportes/compras")
+async def reporte_compras(
+    response: Response,
+    periodo: str = Query("dia", pattern="^(dia|semana|mes)$"),
+    desde: Optional[datetime] = None,
+    hasta: Optional[datetime] = None,
+    proveedor_id: Optional[str] = None
+):
+    filtro = filtro_fechas(desde, hasta)
+    if proveedor_id:
+        filtro["proveedor_id"] = proveedor_id
+    filas = await reporte_por_periodo(db.compras, filtro, periodo)
+    incluido = periodo == "mes" and not proveedor_id
+    if incluido:
+        filas = await sumar_periodos_archivados("compras", filas, desde, hasta)
+    await marcar_archivo(response, "compras", desde, hasta, incluido)
+    return filas
+
+@api_router.get("/reportes/productos-top")
+async def reporte_productos_top(
+    response: Response,
+    orden: str = Query("unidades", pattern="^(unidades|ingresos)$"),
+    limite: int = Query(10, ge=1, le=100),
+    desde: Optional[datetime] = None,
+    hasta: Optional[datetime] = None,
+    cliente_id: Optional[str] = None
+):
+    filtro = filtro_fechas(desde, hasta)
+    if cliente_id:
+        filtro["cliente_id"] = cliente_id
+    pipeline = [
+        {"$match": filtro},
+        {"$unwind": "$productos"},
+        {"$group": {
+            "_id": "$productos.producto_id",
+            "nombre": {"$first": "$productos.nombre"},
+            "unidades": {"$sum": "$productos.cantidad"},
+            "ingresos": {"$sum": "$productos.subtotal"}
+        }},
+        {"$sort": {orden: -1}},
+        {"$limit": limite},
+        {"$project": {"_id": 0, "producto_id": "$_id", "nombre": 1, "unidades": 1, "ingresos": 1}}
+    ]
+    await marcar_archivo(response, "ventas", desde, hasta)
+    return await db.ventas.aggregate(pipeline).to_list(None)
+
+@api_router.get("/reportes/clientes-top")
+async def reporte_clientes_top(
+    response: Response,
+    limite: int = Query(10, ge=1, le=100),
+    desde: Optional[datetime] = None,
+    hasta: Optional[datetime] = None
+):
+    pipeline = [
+        {"$match": filtro_fechas(desde, hasta)},
+        {"$group": {
+            "_id": "$cliente_id",
+            "cliente_nombre": {"$first": "$cliente_nombre"},
+            "total": {"$sum": "$total"},
+            "cantidad_ventas": {"$sum": 1}
+        }},
+        {"$sort": {"total": -1}},
+        {"$limit": limite},
+        {"$project": {"_id": 0, "cliente_id": "$_id", "cliente_nombre": 1, "total": 1, "cantidad_ventas": 1}}
+    ]
+    await marcar_archivo(response, "ventas", desde, hasta)
+    return await db.ventas.aggregate(pipeline).to_list(None)
+
+@api_router.get("/reportes/margenes")
+async def reporte_margenes(
+    response: Response,
+    agrupar: str = Query("producto", pattern="^(producto|dia|semana|mes)$"),
+    desde: Optional[datetime] = None,
+    hasta: Optional[datetime] = None
+):
+    # Margen desde el costo registrado en cada línea de venta; las líneas sin costo
+    # (anteriores al costo promedio) se informan aparte y no entran al margen
+    clave = "$productos.producto_id" if agrupar == "producto" else {
+        "$dateToString": {"format": FORMATOS_PERIODO[agrupar], "date": "$fecha"}
+    }
+    con_costo = {"$ne": [{"$ifNull": ["$productos.costo_unitario", None]}, None]}
+    pipeline = [
+        {"$match": filtro_fechas(desde, hasta)},
+        {"$unwind": "$productos"},
+        {"$group": {
+            "_id": clave,
+            "nombre": {"$first": "$productos.nombre"},
+            "unidades": {"$sum": "$productos.cantidad"},
+            "ingresos": {"$sum": "$productos.subtotal"},
+            "ingresos_costeados": {"$sum": {"$cond": [con_costo, "$productos.subtotal", 0]}},
+            "costo": {"$sum": {"$cond": [
+                con_costo, {"$multiply": ["$productos.cantidad", "$productos.costo_unitario"]}, 0
+            ]}},
+            "unidades_sin_costo": {"$sum": {"$cond": [con_costo, 0, "$productos.cantidad"]}}
+        }}
+    ]
+    margenes = []
+    async for grupo in db.ventas.aggregate(pipeline):
+        unidades_costeadas = grupo["unidades"] - grupo["unidades_sin_costo"]
+        margen = grupo["ingresos_costeados"] - grupo["costo"] if unidades_costeadas else None
+        fila = {"producto_id": grupo["_id"], "nombre": grupo["nombre"]} if agrupar == "producto" else {"periodo": grupo["_id"]}
+        margenes.append({
+            **fila,
+            "unidades": grupo["unidades"],
+            "ingresos": grupo["ingresos"],
+            "costo": grupo["costo"],
+            "costo_promedio": grupo["costo"] / unidades_costeadas if unidades_costeadas else None,
+            "margen": margen,
+            "unidades_sin_costo": grupo["unidades_sin_costo"]
+        })
+    if agrupar == "producto":
+        margenes.sort(key=lambda m: m["margen"] if m["margen"] is not None else float("-inf"), reverse=True)
+    else:
+        margenes.sort(key=lambda m: m["periodo"])
+    await marcar_archivo(response, "ventas", desde, hasta)
+    return margenes
+
+# Routes for Búsqueda
+# Campos con índice ascendente donde se buscan prefijos (códigos, RUC)
+CAMPOS_PREFIJO = {
+    "productos": ["id", "nombre"],
+    "clientes": ["ruc"],
+    "proveedores": ["ruc"]
+}
+
+async def buscar_en(coleccion, q, limite):
+    campos = proyeccion(MODELOS_POR_COLECCION[coleccion])
+    patron = {"$regex": "^" + re.escape(q)}
+    por_prefijo, por_texto = await asyncio.gather(
+        db[coleccion].find({"$or": [{campo: patron} for campo in CAMPOS_PREFIJO[coleccion]]}, campos).limit(limite).to_list(limite),
+        db[coleccion].find(
+            {"$text": {"$search": q}}, {**campos, "puntaje": {"$meta": "textScore"}}
+        ).sort([("puntaje", {"$meta": "textScore"})]).limit(limite).to_list(limite)
+    )
     
+    # Primero las coincidencias exactas de prefijo, luego las de texto por relevancia
+    resultados = {}
+    for documento in por_prefijo + por_texto:
+        documento.pop("puntaje", None)
+        resultados.setdefault(documento["id"], documento)
+    return list(resultados.values())[:limite]
+
+@api_router.get("/buscar")
+async def buscar(
+    q: str = Query(..., min_length=1, max_length=100),
+    tipo: Optional[str] = Query(None, pattern="^(productos|clientes|proveedores)$"),
+    limite: int = Query(10, ge=1, le=50)
+):
+    colecciones = [tipo] if tipo else list(CAMPOS_PREFIJO)
+    resultados = await asyncio.gather(*[buscar_en(coleccion, q.strip(), limite) for coleccion in colecciones])
+    return RespuestaJSON(dict(zip(colecciones, resultados)))
+
+# Routes for Importación / Exportación
+TAMANO_LOTE = 1000
+MAXIMO_ERRORES = 1000
+
+MODELOS_IMPORTACION = {
+    "productos": (ProductoCreate, Producto),
+    "clientes": (ClienteCreate, Cliente),
+    "proveedores": (ProveedorCreate, Proveedor)
+}
+
+async def lotes_csv(archivo):
+    # pandas lee el CSV por bloques en un hilo aparte para no bloquear el event loop
+    lector = await run_in_threadpool(
+        pd.read_csv, archivo, chunksize=TAMANO_LOTE, dtype=str, keep_default_na=False
+    )
+    while True:
+        bloque = await run_in_threadpool(next, lector, None)
+        if bloque is None:
+            break
+        yield bloque.to_dict("records")
+
+async def lotes_ndjson(archivo):
+    while True:
+        lineas = await run_in_threadpool(lambda: list(islice(archivo, TAMANO_LOTE)))
+        if not lineas:
+            break
+        yield lineas
+
+async def insertar_lote(coleccion, filas, primera_fila, reporte):
+    modelo_create, modelo = MODELOS_IMPORTACION[coleccion]
+    documentos, numeros = [], []
+    for desplazamiento, fila in enumerate(filas):
+        numero = primera_fila + desplazamiento
+        try:
+            if isinstance(fila, (bytes, str)):
+                if not fila.strip():
+                    continue
+                fila = orjson.loads(fila)
+            documentos.append(modelo(**modelo_create(**fila).dict()).dict())
+            numeros.append(numero)
+        except ValidationError as error:
+            detalle = "; ".join(f"{'.'.join(map(str, e['loc']))}: {e['msg']}" for e in error.errors())
+            reporte["errores"].append({"fila": numero, "error": detalle})
+        except (orjson.JSONDecodeError, TypeError) as error:
+            reporte["errores"].append({"fila": numero, "error": str(error)})
+    
+    if not documentos:
+        return
+    async with version_sync() as version:
+        for documento in documentos:
+            documento["_version"] = version
+        fallidos = set()
+        try:
+            # Sin orden: un duplicado no detiene el resto del lote
+            resultado = await db[coleccion].insert_many(documentos, ordered=False)
+            reporte["insertados"] += len(resultado.inserted_ids)
+        except BulkWriteError as error:
+            reporte["insertados"] += error.details["nInserted"]
+            for fallo in error.details["writeErrors"]:
+                fallidos.add(fallo["index"])
+                reporte["errores"].append({"fila": numeros[fallo["index"]], "error": fallo["errmsg"]})
+        if coleccion == "productos":
+            # Alta en el kardex de los productos que sí se insertaron
+            await registrar_movimientos([
+                {"producto_id": documento["id"], "cantidad": documento["stock"]}
+                for indice, documento in enumerate(documentos) if indice not in fallidos
+            ], 1, "alta", "importacion", datetime.now(timezone.utc))
+        # Sin transacción en el lote: la versión sube con cada lote y no al final de la importación
+        if len(fallidos) < len(documentos):
+            await registrar_cambios(coleccion)
+
+@api_router.post("/importar/{coleccion}")
+async def importar(
+    coleccion: str,
+    archivo: UploadFile = File(...),
+    formato: Optional[str] = Query(None, pattern="^(csv|ndjson)$")
+):
+    if coleccion not in MODELOS_IMPORTACION:
+        raise HTTPException(status_code=404, detail="Colección no importable")
+    if formato is None:
+        formato = "ndjson" if (archivo.filename or "").endswith((".ndjson", ".jsonl")) else "csv"
+    
+    reporte = {"insertados": 0, "filas": 0, "errores": []}
+    lotes = lotes_csv(archivo.file) if formato == "csv" else lotes_ndjson(archivo.file)
+    try:
+        async for filas in lotes:
+            await insertar_lote(coleccion, filas, reporte["filas"] + 1, reporte)
+            reporte["filas"] += len(filas)
+    except (pd.errors.ParserError, pd.errors.EmptyDataError, UnicodeDecodeError) as error:
+        raise HTTPException(status_code=422, detail=f"Archivo no válido: {error}")
+    finally:
+        if reporte["insertados"]:
+            await publicar({"tipo": "recargar", "colecciones": [coleccion]})
+    
+    reporte["total_errores"] = len(reporte["errores"])
+    reporte["errores"] = sorted(reporte["errores"], key=lambda e: e["fila"])[:MAXIMO_ERRORES]
+    return reporte
+
+def valor_csv(valor):
+    return valor.isoformat() if isinstance(valor, datetime) else valor
+
+def transmitir_csv(coleccion, modelo):
+    campos = list(modelo.model_fields)
+
+    async def generar():
+        buffer = io.StringIO()
+        escritor = csv.writer(buffer)
+        escritor.writerow(campos)
+        async for documento in db[coleccion].find({}, proyeccion(modelo)).sort("id", 1):
+            escritor.writerow([valor_csv(documento.get(campo)) for campo in campos])
+            # Se envía en bloques de ~64KB
+            if buffer.tell() > 65536:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+    return StreamingResponse(generar(), media_type="text/csv")
+
+@api_router.get("/exportar/{coleccion}")
+async def exportar(coleccion: str, formato: str = Query("csv", pattern="^(csv|ndjson)$")):
+    if coleccion not in MODELOS_IMPORTACION:
+        raise HTTPException(status_code=404, detail="Colección no exportable")
+    modelo = MODELOS_IMPORTACION[coleccion][1]
+    if formato == "csv":
+        respuesta = transmitir_csv(coleccion, modelo)
+    else:
+        respuesta = transmitir_ndjson(db[coleccion], modelo)
+    respuesta.headers["Content-Disposition"] = f'attachment; filename="{coleccion}.{formato}"'
+    return respuesta
+
+# Routes for Archivo
+# Ventas y compras de meses cerrados salen de la colección activa hacia
+# archivo_<tipo>_<AAAA_MM> o al directorio <tipo>_<AAAA-MM>/ (un .ndjson.gz por lote),
+# y sus totales quedan en periodos
+ARCHIVO_MESES = int(os.environ.get('ARCHIVO_MESES', 12))
+ARCHIVO_DIR = Path(os.environ.get('ARCHIVO_DIR', ROOT_DIR / 'archivo'))
+
+def inicio_mes(fecha, meses_atras=0):
+    indice = fecha.year * 12 + fecha.month - 1 - meses_atras
+    return datetime(indice // 12, indice % 12 + 1, 1, tzinfo=timezone.utc)
+
+def coleccion_archivo(tipo, periodo):
+    return f"archivo_{tipo}_{periodo.replace('-', '_')}"
+
+async def colecciones_archivo(tipo):
+    return await db.periodos.distinct("coleccion", {"tipo": tipo, "destino": "coleccion"})
+
+def escribir_archivo(directorio, documentos):
+    # Una parte por lote, nombrada por su primer id: si la transacción del lote falla,
+    # el reintento vuelve a leer los mismos documentos y reemplaza la parte en vez de duplicarla
+    directorio.mkdir(parents=True, exist_ok=True)
+    ruta = directorio / f"{documentos[0]['id']}.ndjson.gz"
+    temporal = ruta.with_suffix(".tmp")
+    with gzip.open(temporal, "wb") as archivo:
+        archivo.writelines(a_json(documento) + b"\n" for documento in documentos)
+    os.replace(temporal, ruta)
+
+def partes_archivo(ruta):
+    return sorted(Path(ruta).glob("*.ndjson.gz"))
+
+def leer_parte(ruta):
+    with gzip.open(ruta, "rb") as archivo:
+        return [orjson.loads(linea) for linea in archivo if linea.strip()]
+
+async def documentos_ndjson(tipo):
+    # Lotes de documentos archivados en disco, sin repetir ids entre partes
+    async for periodo in db.periodos.find({"tipo": tipo, "destino": "ndjson"}, {"archivo": 1}):
+        vistos = set()
+        for parte in partes_archivo(periodo["archivo"]):
+            documentos = await run_in_threadpool(leer_parte, parte)
+            lote = [documento for documento in documentos if documento["id"] not in vistos]
+            vistos.update(documento["id"] for documento in lote)
+            for documento in lote:
+                documento["fecha"] = fecha_utc(datetime.fromisoformat(documento["fecha"].replace("Z", "+00:00")))
+            yield lote
+
+async def archivar(tipo, antes_de=None, destino="coleccion"):
+    # Solo meses completos: el corte se lleva al primer día de su mes
+    corte = inicio_mes(fecha_utc(antes_de)) if antes_de else inicio_mes(datetime.now(timezone.utc), ARCHIVO_MESES)
+    meses = await db[tipo].aggregate([
+        {"$match": {"fecha": {"$lt": corte}}},
+        {"$group": {"_id": {"$dateToString": {"format": FORMATOS_PERIODO["mes"], "date": "$fecha"}}}},
+        {"$sort": {"_id": 1}}
+    ]).to_list(None)
+    
+    reporte = []
+    for mes in meses:
+        periodo = mes["_id"]
+        inicio = datetime.strptime(periodo, FORMATOS_PERIODO["mes"]).replace(tzinfo=timezone.utc)
+        fin = inicio_mes(inicio, -1)
+        nombre = coleccion_archivo(tipo, periodo)
+        ruta = ARCHIVO_DIR / f"{tipo}_{periodo}"
+        if destino == "coleccion":
+            await db[nombre].create_index("id", unique=True)
+        archivados = 0
+        
+        while True:
+            lote = await db[tipo].find(
+                {"fecha": {"$gte": inicio, "$lt": fin}}, {"_id": 0}
+            ).sort("id", 1).limit(TAMANO_LOTE).to_list(None)
+            if not lote:
+                break
+            por_metodo = {}
+            for documento in lote:
+                por_metodo[documento["metodo_pago"]] = por_metodo.get(documento["metodo_pago"], 0) + documento["total"]
+            if destino == "ndjson":
+                await run_in_threadpool(escribir_archivo, ruta, lote)
+            
+            async def mover(session):
+                # Copia, borrado y totales del lote en una sola transacción cuando hay réplica
+                if destino == "coleccion":
+                    await db[nombre].bulk_write(
+                        [ReplaceOne({"id": documento["id"]}, documento, upsert=True) for documento in lote],
+                        ordered=False,
+                        session=session
+                    )
+                await db[tipo].delete_many({"id": {"$in": [documento["id"] for documento in lote]}}, session=session)
+                await db.periodos.update_one(
+                    {"_id": f"{tipo}:{periodo}"},
+                    {
+                        "$inc": {
+                            "total": sum(documento["total"] for documento in lote),
+                            "costo": sum(documento.get("costo_total", 0) for documento in lote),
+                            "ingresos_costeados": sum(ingresos_costeados(documento["productos"]) for documento in lote),
+                            "cantidad": len(lote),
+                            **{f"por_metodo.{metodo}": total for metodo, total in por_metodo.items()}
+                        },
+                        "$set": {
+                            "tipo": tipo,
+                            "periodo": periodo,
+                            "destino": destino,
+                            "coleccion" if destino == "coleccion" else "archivo": nombre if destino == "coleccion" else str(ruta),
+                            "archivado_en": datetime.now(timezone.utc)
+                        }
+                    },
+                    upsert=True,
+                    session=session
+                )
+                await registrar_cambios(tipo, session=session)
+            
+            await en_transaccion(mover)
+            archivados += len(lote)
+        reporte.append({"periodo": periodo, "archivados": archivados, "destino": nombre if destino == "coleccion" else str(ruta)})
+    
+    if reporte:
+        await publicar({"tipo": "recargar", "colecciones": [tipo]})
+    return {"tipo": tipo, "corte": corte, "periodos": reporte}
+
+@api_router.post("/archivo/{coleccion}")
+async def archivar_coleccion(
+    coleccion: str,
+    antes_de: Optional[datetime] = None,
+    destino: str = Query("coleccion", pattern="^(coleccion|ndjson)$")
+):
+    if coleccion not in ("ventas", "compras"):
+        raise HTTPException(status_code=404, detail="Colección no archivable")
+    return RespuestaJSON(await archivar(coleccion, antes_de, destino))
+
+@api_router.get("/archivo/periodos")
+async def obtener_periodos_archivados(tipo: Optional[str] = Query(None, pattern="^(ventas|compras)$")):
+    filtro = {"tipo": tipo} if tipo else {}
+    periodos = await db.periodos.find(filtro, {"_id": 0}).sort([("tipo", 1), ("periodo", 1)]).to_list(None)
+    return RespuestaJSON(periodos)
+
+# Routes for Sync
+# Por encima del lote de importación más grande: una página llena siempre abarca más de una
+# versión, salvo que el lote haya crecido, y entonces se devuelve la versión entera
+LIMITE_SYNC = max(LIMITE_MAXIMO, TAMANO_LOTE) + 1
+
+async def podar_eliminados():
+    # La versión más alta podada queda en contadores: un since anterior ya no ve todas las bajas
+    vencida = await db.eliminados.find_one(
+        {"fecha": {"$lt": datetime.now(timezone.utc) - timedelta(seconds=SYNC_ELIMINADOS_TTL)}},
+        {"_version": 1},
+        sort=[("_version", -1)]
+    )
+    if vencida:
+        await db.contadores.update_one({"_id": "sync_poda"}, {"$max": {"valor": vencida["_version"]}}, upsert=True)
+        await db.eliminados.delete_many({"_version": {"$lte": vencida["_version"]}})
+
+@api_router.get("/sync")
+async def sync(since: Optional[int] = Query(None, ge=0)):
+    # Sin since solo devuelve el token: el cliente lo guarda antes de su carga completa.
+    # resync indica que el cliente debe recargar todo: sus bajas pendientes ya se podaron
+    hasta = await token_sync()
+    if since is None or since >= hasta:
+        return RespuestaJSON({
+            "token": hasta if since is None else since, "cambios": {}, "eliminados": [], "hay_mas": False, "resync": False
+        })
+    await podar_eliminados()
+    
+    rango = {"_version": {"$gt": since, "$lte": hasta}}
+    
+    async def leer(coleccion, campos):
+        cursor = db[coleccion].find(rango, campos).sort([("_version", 1), ("id", 1)]).limit(LIMITE_SYNC)
+        documentos = await cursor.to_list(None)
+        if len(documentos) == LIMITE_SYNC and documentos[0]["_version"] == documentos[-1]["_version"]:
+            # Una sola versión llena la página: va completa para no quedar en el mismo token
+            documentos = await db[coleccion].find({"_version": documentos[0]["_version"]}, campos).sort("id", 1).to_list(None)
+        return documentos
+    
+    nombres = list(MODELOS_POR_COLECCION)
+    resultados = await asyncio.gather(
+        *[leer(coleccion, {**proyeccion(modelo), "_version": 1}) for coleccion, modelo in MODELOS_POR_COLECCION.items()],
+        leer("eliminados", {"_id": 0, "coleccion": 1, "id": 1, "_version": 1})
+    )
+    # La poda se consulta después de leer las lápidas: una poda concurrente ya dejó su marca
+    poda = await db.contadores.find_one({"_id": "sync_poda"})
+    if poda and since < poda["valor"]:
+        return RespuestaJSON({"token": hasta, "cambios": {}, "eliminados": [], "hay_mas": False, "resync": True})
+    
+    # Si una colección llenó la página, el token retrocede a antes de su última versión
+    token = hasta
+    for documentos in resultados:
+        if len(documentos) >= LIMITE_SYNC:
+            ultima = documentos[-1]["_version"]
+            token = min(token, ultima if documentos[0]["_version"] == ultima else ultima - 1)
+    cambios = {
+        coleccion: [documento for documento in documentos if documento["_version"] <= token]
+        for coleccion, documentos in zip(nombres, resultados)
+    }
+    eliminados = [eliminado for eliminado in resultados[-1] if eliminado["_version"] <= token]
+    return RespuestaJSON({
+        "token": token, "cambios": cambios, "eliminados": eliminados, "hay_mas": token < hasta, "resync": False
+    })
+
+# Routes for Dashboard
+# Columnas que muestran las vistas de listado del frontend
+CAMPOS_DASHBOARD = {
+    "clientes": ["id", "nombre_completo", "ruc", "direccion", "telefono", "email", "contador_ventas"],
+    "proveedores": ["id", "nombre_completo", "ruc", "direccion", "telefono", "email", "contador_compras"],
+    "productos": ["id", "nombre", "descripcion", "categoria", "precio", "stock", "imagen_url", "costo_promedio"],
+    "ventas": ["id", "cliente_id", "cliente_nombre", "productos.producto_id", "productos.nombre", "productos.cantidad", "productos.subtotal", "total", "metodo_pago", "fecha"],
+    "compras": ["id", "proveedor_id", "proveedor_nombre", "productos.producto_id", "productos.nombre", "productos.cantidad", "productos.subtotal", "total", "metodo_pago", "fecha"]
+}
+
+def campos_dashboard(campos):
+    # campos: "clientes.id,clientes.nombre_completo,ventas.total"; reemplaza las columnas por defecto
+    seleccion = {coleccion: list(columnas) for coleccion, columnas in CAMPOS_DASHBOARD.items()}
+    if campos:
+        pedidos = {}
+        for campo in campos.split(","):
+            coleccion, _, columna = campo.strip().partition(".")
+            if coleccion not in CAMPOS_DASHBOARD or not columna:
+                raise HTTPException(status_code=422, detail=f"Campo no válido: {campo}")
+            # Las columnas del cursor siempre van, para poder seguir paginando
+            pedidos.setdefault(coleccion, campos_cursor(coleccion)).append(columna)
+        seleccion.update(pedidos)
     return {
-        "total_ventas": total_ventas,
-        "total_compras": total_compras,
-        "ganancia_neta": ganancia_neta,
-        "ventas_por_metodo": {
-            "USD": ventas_usd,
-            "Transferencia": ventas_transferencia
-        },
-        "compras_por_metodo": {
-            "USD": compras_usd,
-            "Transferencia": compras_transferencia
-        },
-        "cantidad_ventas": len(ventas),
-        "cantidad_compras": len(compras)
+        coleccion: {"_id": 0, **{columna: 1 for columna in columnas}}
+        for coleccion, columnas in seleccion.items()
     }
 
+@api_router.get("/dashboard")
+async def obtener_dashboard(
+    request: Request,
+    response: Response,
+    limit: int = Query(LIMITE_MAXIMO, ge=1, le=LIMITE_MAXIMO),
+    campos: Optional[str] = None
+):
+    no_modificado = await respuesta_condicional(request, response, "clientes", "proveedores", "productos", "ventas", "compras")
+    if no_modificado:
+        return no_modificado
+    
+    # Todas las consultas de la pantalla principal en paralelo y en una sola respuesta
+    proyecciones = campos_dashboard(campos)
+    colecciones = list(proyecciones)
+    resultados = await asyncio.gather(
+        *[leer_pagina(db[coleccion], limit=limit, proyeccion=proyecciones[coleccion]) for coleccion in colecciones],
+        leer_comparativas(),
+        obtener_categorias()
+    )
+    
+    dashboard = {
+        coleccion: {"items": documentos, "next_cursor": next_cursor}
+        for coleccion, (documentos, next_cursor) in zip(colecciones, resultados)
+    }
+    dashboard["comparativas"], dashboard["categorias"] = resultados[len(colecciones):]
+    return RespuestaJSON(dashboard, headers=response.headers)
+
+# Métricas de monitoreo
+@api_router.get("/metricas")
+async def obtener_metricas():
+    return {
+        "cache_productos": cache_productos.estadisticas(),
+        "cache_reabastecimiento": cache_reabastecimiento.estadisticas(),
+        "pool": {**monitor_pool.estadisticas(), "configuracion": opciones_pool()}
+    }
+
+# Eventos en vivo (Server-Sent Events)
+@api_router.get("/eventos")
+async def eventos(request: Request):
+    cola = canal_eventos.suscribir()
+    
+    async def generar():
+        try:
+            yield b"retry: 3000\n\n"
+            while not await request.is_disconnected():
+                try:
+                    secuencia, evento = await asyncio.wait_for(cola.get(), timeout=EVENTOS_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    # Comentario SSE para que proxies y navegador no corten la conexión
+                    yield b": keepalive\n\n"
+                    continue
+                yield b"id: %d\ndata: %s\n\n" % (secuencia, a_json(evento))
+        finally:
+            canal_eventos.cancelar(cola)
+    
+    return StreamingResponse(
+        generar(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# Health checks
+@api_router.get("/health")
+async def health():
+    # Liveness: el proceso responde, sin tocar la base de datos
+    return {"status": "ok"}
+
+@api_router.get("/ready")
+async def ready():
+    # Readiness: la base responde a un ping dentro del tiempo límite
+    inicio = time.perf_counter()
+    try:
+        await asyncio.wait_for(client.admin.command("ping"), timeout=float(os.environ.get('READY_TIMEOUT', 2)))
+    except Exception as error:
+        logger.warning("Readiness fallida: %s", error)
+        return RespuestaJSON({"status": "unavailable", "error": str(error)}, status_code=503)
+    return {"status": "ready", "ping_ms": round((time.perf_counter() - inicio) * 1000, 2)}
+
 # Root endpoint
 @api_router.get("/")
 async def root():
@@ -435,14 +2759,82 @@ async def root():
 # Include the router in the main app
 app.include_router(api_router)
 
+# Métricas Prometheus (fuera de /api para el scraper)
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    pool = monitor_pool.estadisticas()
+    cache = cache_productos.estadisticas()
+    lineas = [
+        *duracion_http.exponer(),
+        *peticiones_http.exponer(),
+        *metrica_simple("http_requests_in_flight", "gauge", "Peticiones HTTP en curso", MetricasHTTP.en_curso),
+        *duracion_mongo.exponer(),
+        *errores_mongo.exponer(),
+        *metrica_simple("mongodb_pool_connections_open", "gauge", "Conexiones abiertas en el pool", pool["conexiones_abiertas"]),
+        *metrica_simple("mongodb_pool_connections_in_use", "gauge", "Conexiones prestadas", pool["conexiones_en_uso"]),
+        *metrica_simple("mongodb_pool_waiters", "gauge", "Operaciones esperando una conexión", pool["esperando_conexion"]),
+        *metrica_simple("mongodb_pool_checkouts_total", "counter", "Conexiones prestadas desde el inicio", pool["checkouts"]),
+        *metrica_simple("mongodb_pool_checkout_failures_total", "counter", "Préstamos de conexión fallidos", pool["checkouts_fallidos"]),
+        *metrica_simple("cache_productos_entries", "gauge", "Entradas en la caché de productos", cache["entradas"]),
+        *metrica_simple("cache_productos_hits_total", "counter", "Aciertos de la caché de productos", cache["aciertos"]),
+        *metrica_simple("cache_productos_misses_total", "counter", "Fallos de la caché de productos", cache["fallos"]),
+        *metrica_simple("cache_productos_invalidations_total", "counter", "Invalidaciones de la caché de productos", cache["invalidaciones"])
+    ]
+    return Response("\n".join(lineas) + "\n", media_type="text/plain; version=0.0.4; charset=utf-8")
+
+class MetricasHTTP:
+    # Middleware ASGI puro: mide hasta el último byte, también en respuestas en streaming
+    en_curso = 0
+    
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        
+        inicio = time.perf_counter()
+        estado = {"codigo": 500}
+        
+        async def enviar(mensaje):
+            if mensaje["type"] == "http.response.start":
+                estado["codigo"] = mensaje["status"]
+            await send(mensaje)
+        
+        MetricasHTTP.en_curso += 1
+        try:
+            await self.app(scope, receive, enviar)
+        finally:
+            MetricasHTTP.en_curso -= 1
+            # La plantilla de la ruta evita una serie por cada id; lo no enrutado se agrupa
+            ruta = scope.get("route")
+            plantilla = ruta.path if ruta is not None else "sin_ruta"
+            if plantilla != "/metrics":
+                etiquetas = (scope["method"], plantilla, str(estado["codigo"]))
+                duracion_http.observar(etiquetas, time.perf_counter() - inicio)
+                peticiones_http.incrementar(etiquetas)
+
+class GZipSalvoEventos(GZipMiddleware):
+    # GZip retiene los fragmentos pequeños en el compresor y demoraría los eventos SSE
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] == "/api/eventos":
+            return await self.app(scope, receive, send)
+        await super().__call__(scope, receive, send)
+
+app.add_middleware(GZipSalvoEventos, minimum_size=1000)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Incluye-Archivo"],
 )
 
+# Último en agregarse, el más externo: la latencia incluye GZip y CORS
+app.add_middleware(MetricasHTTP)
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -450,6 +2842,119 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def crear_indices():
+    inicio = time.perf_counter()
+    reporte = await asegurar_indices()
+    app.state.reporte_indices = reporte
+    for indice in reporte:
+        if indice["estado"] != "existente":
+            logger.info("Índice %s.%s: %s (%.4fs)", indice["coleccion"], indice["indice"], indice["estado"], indice["segundos"])
+    logger.info("Índices verificados en %.3fs", time.perf_counter() - inicio)
+
+@app.on_event("startup")
+async def verificar_fechas():
+    if await db.ventas.find_one({"fecha": {"$type": "string"}}, {"_id": 1}):
+        logger.warning("Hay fechas guardadas como texto; ejecutar: python server.py migrar-fechas")
+
+@app.on_event("startup")
+async def inicializar_resumenes():
+    # Si el resumen no existe todavía, calcularlo antes de aceptar escrituras
+    if not await db.resumenes.find_one({"_id": RESUMEN_COMPARATIVAS_ID}):
+        await reconstruir_comparativas()
+        logger.info("Resumen de comparativas reconstruido")
+    for tipo, (coleccion, movimientos, _) in HISTORIALES.items():
+        if not await db[coleccion].find_one({}, {"_id": 1}) and await db[movimientos].find_one({}, {"_id": 1}):
+            logger.info("Historiales de %s reconstruidos: %d", tipo, await reconstruir_historiales(tipo))
+
+@app.on_event("startup")
+async def iniciar_eventos():
+    if EVENTOS_FUENTE == "change_stream":
+        app.state.escucha_eventos = asyncio.create_task(escuchar_eventos())
+        logger.info("Eventos distribuidos por change stream")
+
+@app.on_event("startup")
+async def iniciar_snapshots():
+    # Sin snapshot base el kardex no puede reconstruir el stock previo a su despliegue
+    if not await db.inventario_snapshots.find_one({}, {"_id": 1}):
+        resultado = await tomar_snapshot()
+        logger.info("Snapshot base de inventario: %d productos", resultado["productos"])
+    if SNAPSHOT_HORAS > 0:
+        app.state.snapshots = asyncio.create_task(snapshots_periodicos())
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+    for tarea in ("escucha_eventos", "snapshots"):
+        if getattr(app.state, tarea, None):
+            getattr(app.state, tarea).cancel()
+    client.close()
+
+# Comandos de mantenimiento: python server.py --help
+cli = typer.Typer()
+
+@cli.callback()
+def cli_principal():
+    """Tareas de mantenimiento de la base de datos."""
+
+@cli.command("reconstruir-comparativas")
+def cli_reconstruir_comparativas():
+    """Recalcula el resumen de /api/comparativas desde ventas y compras."""
+    resumen = asyncio.run(reconstruir_comparativas())
+    typer.echo(
+        f"Ventas: {resumen['cantidad_ventas']} ({resumen['total_ventas']:.2f}) - "
+        f"Compras: {resumen['cantidad_compras']} ({resumen['total_compras']:.2f})"
+    )
+
+@cli.command("reconstruir-historiales")
+def cli_reconstruir_historiales():
+    """Recalcula los resúmenes por cliente y por proveedor desde ventas y compras."""
+    async def reconstruir_todos():
+        return {tipo: await reconstruir_historiales(tipo) for tipo in HISTORIALES}
+    
+    for tipo, cantidad in asyncio.run(reconstruir_todos()).items():
+        typer.echo(f"{tipo}: {cantidad} resúmenes")
+
+@cli.command("archivar")
+def cli_archivar(
+    tipo: str = typer.Argument(..., help="ventas o compras"),
+    antes_de: Optional[datetime] = typer.Option(None, help="Archivar los meses anteriores a esta fecha"),
+    destino: str = typer.Option("coleccion", help="coleccion o ndjson")
+):
+    """Mueve ventas o compras de meses cerrados al archivo y guarda sus totales por periodo."""
+    if tipo not in ("ventas", "compras") or destino not in ("coleccion", "ndjson"):
+        raise typer.BadParameter("tipo debe ser ventas o compras y destino coleccion o ndjson")
+    resultado = asyncio.run(archivar(tipo, antes_de, destino))
+    typer.echo(f"Corte: {resultado['corte']:%Y-%m-%d}")
+    for periodo in resultado["periodos"]:
+        typer.echo(f"{periodo['periodo']}: {periodo['archivados']} documentos -> {periodo['destino']}")
+
+@cli.command("snapshot-inventario")
+def cli_snapshot_inventario():
+    """Guarda un snapshot del stock de cada producto para el kardex."""
+    resultado = asyncio.run(tomar_snapshot())
+    typer.echo(f"{resultado['productos']} productos al {resultado['fecha']:%Y-%m-%d %H:%M:%S}")
+
+@cli.command("inicializar-costos")
+def cli_inicializar_costos():
+    """Asigna costo promedio a los productos que aún no lo tienen, desde sus compras."""
+    async def inicializar():
+        actualizados = await inicializar_costos()
+        await registrar_cambios("productos")
+        return actualizados
+    
+    typer.echo(f"{asyncio.run(inicializar())} productos con costo promedio inicial")
+
+@cli.command("asegurar-indices")
+def cli_asegurar_indices():
+    """Crea los índices que faltan y muestra cuánto tardó cada uno."""
+    for indice in asyncio.run(asegurar_indices()):
+        typer.echo(f"{indice['coleccion']}.{indice['indice']}: {indice['estado']} ({indice['segundos']:.4f}s)")
+
+@cli.command("migrar-fechas")
+def cli_migrar_fechas():
+    """Convierte las fechas guardadas como texto ISO en fechas nativas de MongoDB."""
+    for campo in asyncio.run(migrar_fechas()):
+        typer.echo(f"{campo['coleccion']}.{campo['campo']}: {campo['migrados']} documentos")
+
+if __name__ == "__main__":
+    cli()
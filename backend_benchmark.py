@@ -0,0 +1,372 @@
+"""Benchmarks de la API de ferretería.
+
+Levanta la app de backend/server.py en el mismo proceso (transporte ASGI de
+httpx) contra el MongoDB de MONGO_URL, en una base temporal que se elimina al
+terminar, o contra mongomock-motor con --mock.
+
+    python backend_benchmark.py concurrencia --ventas 500 --stock 200
+    python backend_benchmark.py serializacion --documentos 1000
+    python backend_benchmark.py carga --mock --ventas 100000 --peticiones 500
+"""
+import asyncio
+import json
+import random
+import statistics
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import httpx
+import typer
+from pydantic import TypeAdapter
+
+sys.path.insert(0, str(Path(__file__).parent / "backend"))
+import server  # noqa: E402
+
+cli = typer.Typer()
+
+
+@cli.callback()
+def principal():
+    """Benchmarks de la API de ferretería."""
+
+
+def percentil(valores, p):
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    indice = min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))
+    return ordenados[indice]
+
+
+async def preparar_base(mock):
+    """Apunta el servidor a una base vacía y crea sus índices."""
+    if mock:
+        from mongomock_motor import AsyncMongoMockClient
+        server.client = AsyncMongoMockClient(tz_aware=True)
+        server._transacciones_disponibles = False
+    nombre = f"benchmark_{uuid.uuid4().hex[:8]}"
+    server.db = server.client[nombre]
+    await server.asegurar_indices()
+    await server.reconstruir_comparativas()
+    return nombre
+
+
+async def limpiar_base(nombre, mock):
+    if not mock:
+        await server.client.drop_database(nombre)
+
+
+def cliente_http():
+    transporte = httpx.ASGITransport(app=server.app)
+    return httpx.AsyncClient(transport=transporte, base_url="http://benchmark", timeout=60)
+
+
+async def _concurrencia(ventas, stock, mock):
+    nombre = await preparar_base(mock)
+    try:
+        async with cliente_http() as http:
+            cliente = (await http.post("/api/clientes", json={
+                "nombre_completo": "Cliente Benchmark",
+                "ruc": "10000000001",
+                "direccion": "Av. Benchmark 1",
+                "telefono": "999999999",
+                "email": "benchmark@ferreteria.com"
+            })).json()
+            producto = (await http.post("/api/productos", json={
+                "nombre": "Martillo Benchmark",
+                "descripcion": "Producto para pruebas de concurrencia",
+                "categoria": "Herramientas manuales",
+                "precio": 10.0,
+                "stock": stock
+            })).json()
+
+            venta = {
+                "cliente_id": cliente["id"],
+                "metodo_pago": "USD",
+                "productos": [{"producto_id": producto["id"], "cantidad": 1}]
+            }
+
+            async def vender():
+                inicio = time.perf_counter()
+                respuesta = await http.post("/api/ventas", json=venta)
+                return respuesta.status_code, time.perf_counter() - inicio
+
+            inicio = time.perf_counter()
+            resultados = await asyncio.gather(*[vender() for _ in range(ventas)])
+            duracion = time.perf_counter() - inicio
+
+            final = (await http.get(f"/api/productos/{producto['id']}")).json()
+    finally:
+        await limpiar_base(nombre, mock)
+
+    exitosas = sum(1 for estado, _ in resultados if estado == 200)
+    rechazadas = sum(1 for estado, _ in resultados if estado == 409)
+    latencias = [latencia * 1000 for _, latencia in resultados]
+
+    print(f"\n🛒 {ventas} ventas simultáneas de 1 unidad sobre stock {stock}")
+    print(f"   Exitosas: {exitosas} - Rechazadas (409): {rechazadas} - Otras: {ventas - exitosas - rechazadas}")
+    print(f"   Stock final: {final['stock']}")
+    print(f"   Throughput: {ventas / duracion:.1f} ventas/s en {duracion:.2f}s")
+    print(f"   Latencia p50: {percentil(latencias, 50):.1f}ms - p99: {percentil(latencias, 99):.1f}ms")
+
+    esperadas = min(ventas, stock)
+    if exitosas == esperadas and final["stock"] == stock - esperadas and final["stock"] >= 0:
+        print("✅ Sin sobreventa")
+        return True
+    print("❌ Sobreventa o ventas perdidas")
+    return False
+
+
+@cli.command()
+def concurrencia(
+    ventas: int = typer.Option(300, help="Ventas simultáneas a disparar"),
+    stock: int = typer.Option(100, help="Stock inicial del producto"),
+    mock: bool = typer.Option(False, help="Usar mongomock-motor en lugar de MONGO_URL")
+):
+    """Dispara ventas simultáneas al mismo producto y verifica que no haya sobreventa."""
+    if not asyncio.run(_concurrencia(ventas, stock, mock)):
+        raise typer.Exit(1)
+
+
+def documentos_venta(cantidad, lineas):
+    """Ventas como las devuelve Motor, con lineas productos cada una."""
+    return [
+        {
+            "id": str(uuid.uuid4()),
+            "cliente_id": str(uuid.uuid4()),
+            "cliente_nombre": f"Cliente {numero}",
+            "productos": [
+                {
+                    "producto_id": str(uuid.uuid4()),
+                    "nombre": f"Producto {linea}",
+                    "cantidad": linea + 1,
+                    "precio_unitario": 12.5,
+                    "subtotal": 12.5 * (linea + 1)
+                }
+                for linea in range(lineas)
+            ],
+            "total": 12.5 * sum(range(1, lineas + 1)),
+            "metodo_pago": "USD",
+            "fecha": datetime.now(timezone.utc)
+        }
+        for numero in range(cantidad)
+    ]
+
+
+def cronometrar(funcion, repeticiones):
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        funcion()
+        tiempos.append(time.perf_counter() - inicio)
+    return statistics.median(tiempos)
+
+
+@cli.command()
+def serializacion(
+    documentos: int = typer.Option(1000, help="Ventas por respuesta"),
+    lineas: int = typer.Option(5, help="Productos por venta"),
+    repeticiones: int = typer.Option(20, help="Repeticiones por variante")
+):
+    """Compara el costo de serializar una página de ventas con modelos Pydantic y con orjson."""
+    ventas = documentos_venta(documentos, lineas)
+    adaptador = TypeAdapter(server.Pagina[server.Venta])
+
+    def con_modelos():
+        # Camino anterior, como lo hace FastAPI: modelos por documento, model_dump,
+        # validación contra response_model, serialización y json.dumps
+        pagina = server.Pagina[server.Venta](items=[server.Venta(**venta) for venta in ventas])
+        validada = adaptador.validate_python(pagina.model_dump())
+        json.dumps(adaptador.dump_python(validada, mode="json"), ensure_ascii=False).encode()
+
+    def con_orjson():
+        server.RespuestaJSON({"items": ventas, "next_cursor": None}).body
+
+    antes = cronometrar(con_modelos, repeticiones)
+    despues = cronometrar(con_orjson, repeticiones)
+    por_mil = 1000 / documentos
+
+    print(f"\n📄 Página de {documentos} ventas con {lineas} productos cada una (mediana de {repeticiones})")
+    print(f"   Pydantic + response_model: {antes * 1000:.2f}ms ({antes * 1000 * por_mil:.2f}ms por 1000 documentos)")
+    print(f"   orjson directo:            {despues * 1000:.2f}ms ({despues * 1000 * por_mil:.2f}ms por 1000 documentos)")
+    print(f"   Aceleración: {antes / despues:.1f}x")
+
+
+async def sembrar(clientes, productos, ventas, compras, lote=5000):
+    """Inserta el volumen pedido directamente en la base, sin pasar por la API."""
+    ahora = datetime.now(timezone.utc)
+    docs_clientes = [
+        server.Cliente(
+            nombre_completo=f"Cliente {numero}",
+            ruc=f"2{numero:010d}",
+            direccion=f"Calle {numero}",
+            telefono="999999999",
+            email=f"cliente{numero}@ferreteria.com"
+        ).model_dump()
+        for numero in range(clientes)
+    ]
+    docs_productos = [
+        server.Producto(
+            nombre=f"Producto {numero}",
+            descripcion="Producto sembrado para benchmark",
+            categoria=f"Categoria {numero % 20}",
+            precio=round(random.uniform(1, 200), 2),
+            stock=10**9
+        ).model_dump()
+        for numero in range(productos)
+    ]
+    await server.db.clientes.insert_many(docs_clientes)
+    await server.db.productos.insert_many(docs_productos)
+
+    def venta(_):
+        cliente = random.choice(docs_clientes)
+        lineas = [
+            {
+                "producto_id": producto["id"],
+                "nombre": producto["nombre"],
+                "cantidad": cantidad,
+                "precio_unitario": producto["precio"],
+                "subtotal": round(producto["precio"] * cantidad, 2)
+            }
+            for producto, cantidad in ((random.choice(docs_productos), random.randint(1, 5)) for _ in range(random.randint(1, 4)))
+        ]
+        return {
+            "id": str(uuid.uuid4()),
+            "cliente_id": cliente["id"],
+            "cliente_nombre": cliente["nombre_completo"],
+            "productos": lineas,
+            "total": round(sum(linea["subtotal"] for linea in lineas), 2),
+            "metodo_pago": random.choice(["USD", "Transferencia"]),
+            "fecha": ahora - timedelta(minutes=random.randint(0, 525600))
+        }
+
+    def compra(_):
+        producto = random.choice(docs_productos)
+        cantidad = random.randint(10, 100)
+        precio = round(producto["precio"] * 0.6, 2)
+        return {
+            "id": str(uuid.uuid4()),
+            "proveedor_id": str(uuid.uuid4()),
+            "proveedor_nombre": "Proveedor Benchmark",
+            "productos": [{
+                "producto_id": producto["id"],
+                "nombre": producto["nombre"],
+                "cantidad": cantidad,
+                "precio_unitario": precio,
+                "subtotal": round(precio * cantidad, 2)
+            }],
+            "total": round(precio * cantidad, 2),
+            "metodo_pago": random.choice(["USD", "Transferencia"]),
+            "fecha": ahora - timedelta(minutes=random.randint(0, 525600))
+        }
+
+    for coleccion, generar, total in ((server.db.ventas, venta, ventas), (server.db.compras, compra, compras)):
+        for inicio in range(0, total, lote):
+            await coleccion.insert_many([generar(numero) for numero in range(inicio, min(total, inicio + lote))])
+
+    await server.reconstruir_comparativas()
+    return docs_clientes, docs_productos
+
+
+async def medir(nombre, peticiones, concurrencia, hacer):
+    """Lanza peticiones con a lo sumo concurrencia en vuelo y resume latencias."""
+    semaforo = asyncio.Semaphore(concurrencia)
+    latencias = []
+    errores = 0
+
+    async def una():
+        nonlocal errores
+        async with semaforo:
+            inicio = time.perf_counter()
+            respuesta = await hacer()
+            latencias.append((time.perf_counter() - inicio) * 1000)
+            if respuesta.status_code >= 400:
+                errores += 1
+
+    inicio = time.perf_counter()
+    await asyncio.gather(*[una() for _ in range(peticiones)])
+    duracion = time.perf_counter() - inicio
+    return {
+        "escenario": nombre,
+        "throughput": peticiones / duracion,
+        "p50": percentil(latencias, 50),
+        "p99": percentil(latencias, 99),
+        "errores": errores
+    }
+
+
+async def _carga(clientes, productos, ventas, compras, peticiones, concurrencia, mock, semilla, cache):
+    random.seed(semilla)
+    # Sin escrituras entre escenarios, los GET de productos solo medirían aciertos de caché:
+    # con TTL 0 cada entrada nace vencida y todas las lecturas llegan a MongoDB
+    if not cache:
+        server.cache_productos.ttl = 0
+    nombre = await preparar_base(mock)
+    try:
+        inicio = time.perf_counter()
+        docs_clientes, docs_productos = await sembrar(clientes, productos, ventas, compras)
+        print(f"\n🌱 Sembrados {clientes} clientes, {productos} productos, {ventas} ventas y {compras} compras en {time.perf_counter() - inicio:.1f}s")
+
+        async with cliente_http() as http:
+            def nueva_venta():
+                return http.post("/api/ventas", json={
+                    "cliente_id": random.choice(docs_clientes)["id"],
+                    "metodo_pago": "USD",
+                    "productos": [
+                        {"producto_id": random.choice(docs_productos)["id"], "cantidad": random.randint(1, 3)}
+                        for _ in range(random.randint(1, 4))
+                    ]
+                })
+
+            escenarios = [
+                ("GET /api/ventas", lambda: http.get("/api/ventas", params={"limit": server.LIMITE_POR_DEFECTO})),
+                ("GET /api/productos", lambda: http.get("/api/productos", params={"limit": server.LIMITE_POR_DEFECTO})),
+                ("GET /api/productos/{id}", lambda: http.get(f"/api/productos/{random.choice(docs_productos)['id']}")),
+                ("GET /api/clientes/{id}", lambda: http.get(f"/api/clientes/{random.choice(docs_clientes)['id']}")),
+                ("POST /api/ventas", nueva_venta),
+                ("GET /api/comparativas", lambda: http.get("/api/comparativas"))
+            ]
+            resultados = [
+                await medir(escenario, peticiones, concurrencia, hacer)
+                for escenario, hacer in escenarios
+            ]
+    finally:
+        await limpiar_base(nombre, mock)
+
+    print(f"\n⏱️  {peticiones} peticiones por escenario, {concurrencia} en vuelo, caché de productos {'activa' if cache else 'desactivada'}")
+    print(f"   {'Escenario':<26}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'errores':>9}")
+    for resultado in resultados:
+        print(
+            f"   {resultado['escenario']:<26}{resultado['throughput']:>10.1f}"
+            f"{resultado['p50']:>10.2f}{resultado['p99']:>10.2f}{resultado['errores']:>9}"
+        )
+
+    if any(resultado["errores"] for resultado in resultados):
+        print("❌ Hubo respuestas con error")
+        return False
+    print("✅ Todos los escenarios respondieron sin errores")
+    return True
+
+
+@cli.command()
+def carga(
+    clientes: int = typer.Option(1000, help="Clientes a sembrar"),
+    productos: int = typer.Option(2000, help="Productos a sembrar"),
+    ventas: int = typer.Option(100000, help="Ventas a sembrar"),
+    compras: int = typer.Option(10000, help="Compras a sembrar"),
+    peticiones: int = typer.Option(500, help="Peticiones por escenario"),
+    concurrencia: int = typer.Option(20, help="Peticiones simultáneas en vuelo"),
+    mock: bool = typer.Option(False, help="Usar mongomock-motor en lugar de MONGO_URL"),
+    semilla: int = typer.Option(42, help="Semilla aleatoria para datos y peticiones reproducibles"),
+    cache: bool = typer.Option(False, help="Mantener la caché de productos (por defecto se mide el camino a MongoDB)")
+):
+    """Siembra un volumen de datos y mide throughput y latencias p50/p99 de los endpoints críticos."""
+    if not asyncio.run(_carga(clientes, productos, ventas, compras, peticiones, concurrencia, mock, semilla, cache)):
+        raise typer.Exit(1)
+
+
+if __name__ == "__main__":
+    cli()
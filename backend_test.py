@@ -127,7 +127,7 @@ class FerreteriaTester:
 
         # Test GET all clients
         success, response = self.run_test("Get All Clients", "GET", "clientes", 200)
-        if not success or len(response) == 0:
+        if not success or len(response.get('items', [])) == 0:
             return False
 
         print("✅ CLIENTES CRUD completed successfully")
@@ -172,7 +172,7 @@ class FerreteriaTester:
 
         # Test GET all suppliers
         success, response = self.run_test("Get All Suppliers", "GET", "proveedores", 200)
-        if not success or len(response) == 0:
+        if not success or len(response.get('items', [])) == 0:
             return False
 
         print("✅ PROVEEDORES CRUD completed successfully")
@@ -224,7 +224,7 @@ class FerreteriaTester:
 
         # Test GET all products
         success, response = self.run_test("Get All Products", "GET", "productos", 200)
-        if not success or len(response) == 0:
+        if not success or len(response.get('items', [])) == 0:
             return False
 
         print("✅ PRODUCTOS CRUD completed successfully")
@@ -313,7 +313,7 @@ class FerreteriaTester:
 
         # Test GET all sales
         success, response = self.run_test("Get All Sales", "GET", "ventas", 200)
-        if not success or len(response) == 0:
+        if not success or len(response.get('items', [])) == 0:
             return False
 
         print("✅ VENTAS FLOW completed successfully")
@@ -402,7 +402,7 @@ class FerreteriaTester:
 
         # Test GET all purchases
         success, response = self.run_test("Get All Purchases", "GET", "compras", 200)
-        if not success or len(response) == 0:
+        if not success or len(response.get('items', [])) == 0:
             return False
 
         print("✅ COMPRAS FLOW completed successfully")
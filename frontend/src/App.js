@@ -1,4 +1,4 @@
-import React, { useState, useEffect } from "react";
+import React, { useState, useEffect, useRef } from "react";
 import "./App.css";
 import axios from "axios";
 import { Button } from "./components/ui/button";
@@ -27,6 +27,18 @@ import { Toaster } from "./components/ui/toaster";
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
 
+// Completa un listado paginado siguiendo next_cursor
+const completarListado = async (url, pagina) => {
+  let items = pagina.items;
+  let cursor = pagina.next_cursor;
+  while (cursor) {
+    const res = await axios.get(url, { params: { limit: 1000, after: cursor } });
+    items = items.concat(res.data.items);
+    cursor = res.data.next_cursor;
+  }
+  return items;
+};
+
 function App() {
   const { toast } = useToast();
   
@@ -77,6 +89,17 @@ function App() {
     metodo_pago: 'USD'
   });
 
+  // Idempotency-Key por envío: se conserva en los reintentos del mismo formulario
+  const claveVenta = useRef(null);
+  const claveCompra = useRef(null);
+
+  // Token de /api/sync: versión hasta la que el estado local está al día
+  const tokenSync = useRef(null);
+
+  // Ventas y compras ya reflejadas en el estado: la respuesta propia, el evento SSE y
+  // /sync pueden traer el mismo cambio y los deltas de stock no deben aplicarse dos veces
+  const aplicados = useRef(new Set());
+
   // Estados para edición
   const [editingCliente, setEditingCliente] = useState(null);
   const [editingProveedor, setEditingProveedor] = useState(null);
@@ -87,25 +110,45 @@ function App() {
     cargarDatos();
   }, []);
 
+  // Cambios en vivo: cada evento parchea el estado local en lugar de recargar todo
+  useEffect(() => {
+    const fuente = new EventSource(`${API}/eventos`);
+    let reconectando = false;
+    fuente.onopen = () => {
+      // Tras un corte pudieron perderse eventos: pedir solo lo que cambió
+      if (reconectando) {
+        reconectando = false;
+        sincronizar();
+      }
+    };
+    fuente.onerror = () => {
+      reconectando = true;
+    };
+    fuente.onmessage = (mensaje) => aplicarEvento(JSON.parse(mensaje.data));
+    return () => fuente.close();
+  }, []);
+
   const cargarDatos = async () => {
     try {
-      const [clientesRes, proveedoresRes, productosRes, ventasRes, comprasRes, comparativasRes, categoriasRes] = await Promise.all([
-        axios.get(`${API}/clientes`),
-        axios.get(`${API}/proveedores`),
-        axios.get(`${API}/productos`),
-        axios.get(`${API}/ventas`),
-        axios.get(`${API}/compras`),
-        axios.get(`${API}/comparativas`),
-        axios.get(`${API}/categorias`)
+      // El token se pide antes de leer: lo que cambie durante la carga llega en la próxima sincronización
+      const { data: sync } = await axios.get(`${API}/sync`);
+      const { data } = await axios.get(`${API}/dashboard`);
+      const [clientesData, proveedoresData, productosData, ventasData, comprasData] = await Promise.all([
+        completarListado(`${API}/clientes`, data.clientes),
+        completarListado(`${API}/proveedores`, data.proveedores),
+        completarListado(`${API}/productos`, data.productos),
+        completarListado(`${API}/ventas`, data.ventas),
+        completarListado(`${API}/compras`, data.compras)
       ]);
       
-      setClientes(clientesRes.data);
-      setProveedores(proveedoresRes.data);
-      setProductos(productosRes.data);
-      setVentas(ventasRes.data);
-      setCompras(comprasRes.data);
-      setComparativas(comparativasRes.data);
-      setCategorias(categoriasRes.data);
+      setClientes(clientesData);
+      setProveedores(proveedoresData);
+      setProductos(productosData);
+      setVentas(ventasData);
+      setCompras(comprasData);
+      setComparativas(data.comparativas);
+      setCategorias(data.categorias);
+      tokenSync.current = sync.token;
     } catch (error) {
       toast({
         title: "Error",
@@ -115,20 +158,157 @@ function App() {
     }
   };
 
+  const sincronizar = async () => {
+    if (tokenSync.current === null) {
+      return cargarDatos();
+    }
+    const setters = {
+      clientes: setClientes,
+      proveedores: setProveedores,
+      productos: setProductos,
+      ventas: setVentas,
+      compras: setCompras
+    };
+    try {
+      let hayMas = true;
+      while (hayMas) {
+        const { data } = await axios.get(`${API}/sync`, { params: { since: tokenSync.current } });
+        if (data.resync) {
+          // Bajas más viejas que la retención de /sync: solo una carga completa es confiable
+          return cargarDatos();
+        }
+        Object.entries(data.cambios).forEach(([coleccion, documentos]) => {
+          setters[coleccion]((lista) => documentos.reduce(guardarEn, lista));
+        });
+        data.eliminados.forEach(({ coleccion, id }) => {
+          setters[coleccion]((lista) => quitarDe(lista, id));
+        });
+        // Los productos llegan con su stock final: los eventos de estos cambios ya no suman
+        ["ventas", "compras"].forEach((coleccion) => {
+          const tipo = coleccion === "ventas" ? "venta" : "compra";
+          (data.cambios[coleccion] || []).forEach(({ id }) => aplicados.current.add(`${tipo}_creada:${id}`));
+          data.eliminados
+            .filter((eliminado) => eliminado.coleccion === coleccion)
+            .forEach(({ id }) => aplicados.current.add(`${tipo}_eliminada:${id}`));
+        });
+        tokenSync.current = data.token;
+        hayMas = data.hay_mas;
+      }
+      actualizarComparativas();
+    } catch (error) {
+      cargarDatos();
+    }
+  };
+
+  const guardarEn = (lista, documento) =>
+    lista.some((item) => item.id === documento.id)
+      ? lista.map((item) => (item.id === documento.id ? documento : item))
+      : [...lista, documento];
+
+  const quitarDe = (lista, id) => lista.filter((item) => item.id !== id);
+
+  const aplicarStock = (stock) => {
+    setProductos((lista) =>
+      lista.map((producto) =>
+        stock[producto.id] ? { ...producto, stock: producto.stock + stock[producto.id] } : producto
+      )
+    );
+  };
+
+  const deltaStock = (lineas, signo) =>
+    lineas.reduce(
+      (stock, linea) => ({ ...stock, [linea.producto_id]: (stock[linea.producto_id] || 0) + signo * linea.cantidad }),
+      {}
+    );
+
+  const yaAplicado = (clave) => {
+    if (aplicados.current.has(clave)) {
+      return true;
+    }
+    aplicados.current.add(clave);
+    return false;
+  };
+
+  const sumarContador = (setLista, campo, id, cantidad) => {
+    setLista((lista) =>
+      lista.map((item) => (item.id === id ? { ...item, [campo]: item[campo] + cantidad } : item))
+    );
+  };
+
+  const actualizarComparativas = async () => {
+    const { data } = await axios.get(`${API}/comparativas`);
+    setComparativas(data);
+  };
+
+  const aplicarEvento = (evento) => {
+    switch (evento.tipo) {
+      case "cliente_guardado":
+        setClientes((lista) => guardarEn(lista, evento.cliente));
+        break;
+      case "cliente_eliminado":
+        setClientes((lista) => quitarDe(lista, evento.id));
+        break;
+      case "proveedor_guardado":
+        setProveedores((lista) => guardarEn(lista, evento.proveedor));
+        break;
+      case "proveedor_eliminado":
+        setProveedores((lista) => quitarDe(lista, evento.id));
+        break;
+      case "producto_guardado":
+        setProductos((lista) => guardarEn(lista, evento.producto));
+        break;
+      case "producto_eliminado":
+        setProductos((lista) => quitarDe(lista, evento.id));
+        break;
+      case "venta_creada":
+        if (yaAplicado(`venta_creada:${evento.venta.id}`)) break;
+        setVentas((lista) => guardarEn(lista, evento.venta));
+        sumarContador(setClientes, "contador_ventas", evento.venta.cliente_id, 1);
+        aplicarStock(evento.stock);
+        actualizarComparativas();
+        break;
+      case "venta_eliminada":
+        if (yaAplicado(`venta_eliminada:${evento.id}`)) break;
+        setVentas((lista) => quitarDe(lista, evento.id));
+        sumarContador(setClientes, "contador_ventas", evento.cliente_id, -1);
+        aplicarStock(evento.stock);
+        actualizarComparativas();
+        break;
+      case "compra_creada":
+        if (yaAplicado(`compra_creada:${evento.compra.id}`)) break;
+        setCompras((lista) => guardarEn(lista, evento.compra));
+        sumarContador(setProveedores, "contador_compras", evento.compra.proveedor_id, 1);
+        aplicarStock(evento.stock);
+        actualizarComparativas();
+        break;
+      case "compra_eliminada":
+        if (yaAplicado(`compra_eliminada:${evento.id}`)) break;
+        setCompras((lista) => quitarDe(lista, evento.id));
+        sumarContador(setProveedores, "contador_compras", evento.proveedor_id, -1);
+        aplicarStock(evento.stock);
+        actualizarComparativas();
+        break;
+      default:
+        // recargar, desbordado o eventos desconocidos
+        cargarDatos();
+    }
+  };
+
   // Funciones CRUD para Clientes
   const crearCliente = async (e) => {
     e.preventDefault();
     try {
       if (editingCliente) {
-        await axios.put(`${API}/clientes/${editingCliente.id}`, clienteForm);
+        const { data } = await axios.put(`${API}/clientes/${editingCliente.id}`, clienteForm);
+        aplicarEvento({ tipo: "cliente_guardado", cliente: data });
         toast({ title: "Cliente actualizado correctamente" });
         setEditingCliente(null);
       } else {
-        await axios.post(`${API}/clientes`, clienteForm);
+        const { data } = await axios.post(`${API}/clientes`, clienteForm);
+        aplicarEvento({ tipo: "cliente_guardado", cliente: data });
         toast({ title: "Cliente creado correctamente" });
       }
       setClienteForm({ nombre_completo: '', ruc: '', direccion: '', telefono: '', email: '' });
-      cargarDatos();
     } catch (error) {
       toast({
         title: "Error",
@@ -152,8 +332,8 @@ function App() {
   const eliminarCliente = async (id) => {
     try {
       await axios.delete(`${API}/clientes/${id}`);
+      aplicarEvento({ tipo: "cliente_eliminado", id });
       toast({ title: "Cliente eliminado correctamente" });
-      cargarDatos();
     } catch (error) {
       toast({
         title: "Error",
@@ -168,15 +348,16 @@ function App() {
     e.preventDefault();
     try {
       if (editingProveedor) {
-        await axios.put(`${API}/proveedores/${editingProveedor.id}`, proveedorForm);
+        const { data } = await axios.put(`${API}/proveedores/${editingProveedor.id}`, proveedorForm);
+        aplicarEvento({ tipo: "proveedor_guardado", proveedor: data });
         toast({ title: "Proveedor actualizado correctamente" });
         setEditingProveedor(null);
       } else {
-        await axios.post(`${API}/proveedores`, proveedorForm);
+        const { data } = await axios.post(`${API}/proveedores`, proveedorForm);
+        aplicarEvento({ tipo: "proveedor_guardado", proveedor: data });
         toast({ title: "Proveedor creado correctamente" });
       }
       setProveedorForm({ nombre_completo: '', ruc: '', direccion: '', telefono: '', email: '' });
-      cargarDatos();
     } catch (error) {
       toast({
         title: "Error",
@@ -200,8 +381,8 @@ function App() {
   const eliminarProveedor = async (id) => {
     try {
       await axios.delete(`${API}/proveedores/${id}`);
+      aplicarEvento({ tipo: "proveedor_eliminado", id });
       toast({ title: "Proveedor eliminado correctamente" });
-      cargarDatos();
     } catch (error) {
       toast({
         title: "Error",
@@ -222,15 +403,16 @@ function App() {
       };
       
       if (editingProducto) {
-        await axios.put(`${API}/productos/${editingProducto.id}`, productoData);
+        const { data } = await axios.put(`${API}/productos/${editingProducto.id}`, productoData);
+        aplicarEvento({ tipo: "producto_guardado", producto: data });
         toast({ title: "Producto actualizado correctamente" });
         setEditingProducto(null);
       } else {
-        await axios.post(`${API}/productos`, productoData);
+        const { data } = await axios.post(`${API}/productos`, productoData);
+        aplicarEvento({ tipo: "producto_guardado", producto: data });
         toast({ title: "Producto creado correctamente" });
       }
       setProductoForm({ nombre: '', descripcion: '', categoria: '', precio: '', stock: '', imagen_url: '' });
-      cargarDatos();
     } catch (error) {
       toast({
         title: "Error",
@@ -255,8 +437,8 @@ function App() {
   const eliminarProducto = async (id) => {
     try {
       await axios.delete(`${API}/productos/${id}`);
+      aplicarEvento({ tipo: "producto_eliminado", id });
       toast({ title: "Producto eliminado correctamente" });
-      cargarDatos();
     } catch (error) {
       toast({
         title: "Error",
@@ -278,15 +460,25 @@ function App() {
       return;
     }
     
+    claveVenta.current = claveVenta.current || crypto.randomUUID();
     try {
-      await axios.post(`${API}/ventas`, ventaForm);
+      const { data } = await axios.post(`${API}/ventas`, ventaForm, {
+        headers: { "Idempotency-Key": claveVenta.current }
+      });
+      claveVenta.current = null;
+      aplicarEvento({ tipo: "venta_creada", venta: data, stock: deltaStock(data.productos, -1) });
       toast({ title: "Venta registrada correctamente" });
       setVentaForm({ cliente_id: '', productos: [], metodo_pago: 'USD' });
-      cargarDatos();
     } catch (error) {
+      // Con respuesta del servidor la venta no se registró y el próximo envío usa otra clave;
+      // sin respuesta (timeout) o con el envío anterior aún en curso se reintenta con la misma
+      const enCurso = error.response?.status === 409 && typeof error.response.data?.detail === "string";
+      if (error.response && !enCurso) {
+        claveVenta.current = null;
+      }
       toast({
         title: "Error",
-        description: "Error al registrar venta",
+        description: error.response?.data?.detail?.mensaje || "Error al registrar venta",
         variant: "destructive"
       });
     }
@@ -294,9 +486,15 @@ function App() {
 
   const eliminarVenta = async (id) => {
     try {
+      const venta = ventas.find((item) => item.id === id);
       await axios.delete(`${API}/ventas/${id}`);
+      // El listado inicial puede venir sin las columnas necesarias para el delta
+      if (venta?.cliente_id && venta.productos.every((linea) => linea.producto_id)) {
+        aplicarEvento({ tipo: "venta_eliminada", id, cliente_id: venta.cliente_id, stock: deltaStock(venta.productos, 1) });
+      } else {
+        sincronizar();
+      }
       toast({ title: "Venta eliminada correctamente" });
-      cargarDatos();
     } catch (error) {
       toast({
         title: "Error",
@@ -317,13 +515,33 @@ function App() {
       });
       return;
     }
+    if (compraForm.productos.some((producto) => producto.precio_unitario === '' || Number.isNaN(producto.precio_unitario))) {
+      toast({
+        title: "Error",
+        description: "Ingrese el costo unitario de cada producto",
+        variant: "destructive"
+      });
+      return;
+    }
     
+    claveCompra.current = claveCompra.current || crypto.randomUUID();
     try {
-      await axios.post(`${API}/compras`, compraForm);
+      const { data } = await axios.post(`${API}/compras`, compraForm, {
+        headers: { "Idempotency-Key": claveCompra.current }
+      });
+      claveCompra.current = null;
+      aplicarEvento({ tipo: "compra_creada", compra: data, stock: deltaStock(data.productos, 1) });
+      // La compra recalcula el costo promedio de sus productos
+      sincronizar();
       toast({ title: "Compra registrada correctamente" });
       setCompraForm({ proveedor_id: '', productos: [], metodo_pago: 'USD' });
-      cargarDatos();
     } catch (error) {
+      // Con respuesta del servidor la compra no se registró y el próximo envío usa otra clave;
+      // sin respuesta (timeout) o con el envío anterior aún en curso se reintenta con la misma
+      const enCurso = error.response?.status === 409 && typeof error.response.data?.detail === "string";
+      if (error.response && !enCurso) {
+        claveCompra.current = null;
+      }
       toast({
         title: "Error",
         description: "Error al registrar compra",
@@ -334,9 +552,15 @@ function App() {
 
   const eliminarCompra = async (id) => {
     try {
+      const compra = compras.find((item) => item.id === id);
       await axios.delete(`${API}/compras/${id}`);
+      // El listado inicial puede venir sin las columnas necesarias para el delta
+      if (compra?.proveedor_id && compra.productos.every((linea) => linea.producto_id)) {
+        aplicarEvento({ tipo: "compra_eliminada", id, proveedor_id: compra.proveedor_id, stock: deltaStock(compra.productos, -1) });
+      } else {
+        sincronizar();
+      }
       toast({ title: "Compra eliminada correctamente" });
-      cargarDatos();
     } catch (error) {
       toast({
         title: "Error",
@@ -382,12 +606,14 @@ function App() {
       return;
     }
     
+    // El costo de compra parte del costo promedio, no del precio de venta
+    const costo = producto.costo_promedio ?? '';
     const nuevoProducto = {
       producto_id: producto.id,
       nombre: producto.nombre,
       cantidad: 1,
-      precio_unitario: producto.precio,
-      subtotal: producto.precio
+      precio_unitario: costo,
+      subtotal: costo || 0
     };
     
     setCompraForm({
@@ -406,7 +632,14 @@ function App() {
   const actualizarCantidadCompra = (index, cantidad) => {
     const nuevosProductos = [...compraForm.productos];
     nuevosProductos[index].cantidad = parseInt(cantidad);
-    nuevosProductos[index].subtotal = nuevosProductos[index].precio_unitario * parseInt(cantidad);
+    nuevosProductos[index].subtotal = (nuevosProductos[index].precio_unitario || 0) * parseInt(cantidad);
+    setCompraForm({ ...compraForm, productos: nuevosProductos });
+  };
+
+  const actualizarCostoCompra = (index, costo) => {
+    const nuevosProductos = [...compraForm.productos];
+    nuevosProductos[index].precio_unitario = costo === '' ? '' : parseFloat(costo);
+    nuevosProductos[index].subtotal = (parseFloat(costo) || 0) * nuevosProductos[index].cantidad;
     setCompraForm({ ...compraForm, productos: nuevosProductos });
   };
 
@@ -1185,6 +1418,15 @@ function App() {
                             <div key={index} className="flex justify-between items-center p-2 bg-orange-50 rounded">
                               <span className="font-medium">{producto.nombre}</span>
                               <div className="flex items-center space-x-2">
+                                <Input
+                                  type="number"
+                                  min="0"
+                                  step="0.01"
+                                  placeholder="Costo"
+                                  value={producto.precio_unitario}
+                                  onChange={(e) => actualizarCostoCompra(index, e.target.value)}
+                                  className="w-24 h-8 border-orange-200"
+                                />
                                 <Input
                                   type="number"
                                   min="1"
@@ -1290,7 +1532,27 @@ function App() {
                       ${comparativas.total_compras?.toFixed(2) || '0.00'}
                     </span>
                   </div>
+                  <div className="flex justify-between">
+                    <span className="text-gray-600">Costo de Ventas:</span>
+                    <span className="font-bold text-red-600">
+                      ${comparativas.costo_ventas?.toFixed(2) || '0.00'}
+                    </span>
+                  </div>
+                  {comparativas.ventas_sin_costo > 0 && (
+                    <div className="flex justify-between">
+                      <span className="text-gray-600">Ventas sin costo (fuera de la ganancia):</span>
+                      <span className="font-bold text-gray-600">
+                        ${comparativas.ventas_sin_costo.toFixed(2)}
+                      </span>
+                    </div>
+                  )}
                   <Separator className="bg-orange-200" />
+                  <div className="flex justify-between">
+                    <span className="text-gray-600">Flujo de Caja:</span>
+                    <span className={`font-bold ${comparativas.flujo_caja >= 0 ? 'text-green-600' : 'text-red-600'}`}>
+                      ${comparativas.flujo_caja?.toFixed(2) || '0.00'}
+                    </span>
+                  </div>
                   <div className="flex justify-between">
                     <span className="text-gray-600">Ganancia Neta:</span>
                     <span className={`font-bold ${comparativas.ganancia_neta >= 0 ? 'text-green-600' : 'text-red-600'}`}>
@@ -0,0 +1,76 @@
+import os
+import sys
+from pathlib import Path
+
+import httpx
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "ferreteria_test")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+def db(monkeypatch):
+    # Base en memoria por test; mongomock no tiene réplica, así que sin transacciones
+    cliente = AsyncMongoMockClient(tz_aware=True)
+    monkeypatch.setattr(server, "client", cliente)
+    monkeypatch.setattr(server, "db", cliente["ferreteria_test"])
+    monkeypatch.setattr(server, "_transacciones_disponibles", False)
+    server.cache_productos.invalidar()
+    server.cache_reabastecimiento.invalidar()
+    return server.db
+
+
+@pytest.fixture
+async def api(db):
+    transporte = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transporte, base_url="http://test") as http:
+        yield http
+
+
+@pytest.fixture
+async def cliente(api):
+    respuesta = await api.post("/api/clientes", json={
+        "nombre_completo": "Cliente Prueba",
+        "ruc": "20000000001",
+        "direccion": "Calle 1",
+        "telefono": "999999999",
+        "email": "cliente@ferreteria.com"
+    })
+    return respuesta.json()
+
+
+@pytest.fixture
+async def proveedor(api):
+    respuesta = await api.post("/api/proveedores", json={
+        "nombre_completo": "Proveedor Prueba",
+        "ruc": "20000000002",
+        "direccion": "Calle 2",
+        "telefono": "999999998",
+        "email": "proveedor@ferreteria.com"
+    })
+    return respuesta.json()
+
+
+@pytest.fixture
+def crear_producto(api):
+    async def crear(nombre="Martillo", precio=10, stock=5):
+        respuesta = await api.post("/api/productos", json={
+            "nombre": nombre,
+            "descripcion": "Producto de prueba",
+            "categoria": "Herramientas manuales",
+            "precio": precio,
+            "stock": stock
+        })
+        assert respuesta.status_code == 200
+        return respuesta.json()
+    return crear
@@ -0,0 +1,76 @@
+from datetime import datetime, timezone
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def lotes_chicos(monkeypatch, tmp_path):
+    # Lotes de dos documentos para que un mes se archive en varias transacciones
+    monkeypatch.setattr(server, "TAMANO_LOTE", 2)
+    monkeypatch.setattr(server, "ARCHIVO_DIR", tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+async def ventas_antiguas(api, db, cliente, crear_producto):
+    producto = await crear_producto(precio=10, stock=100)
+    fechas = [datetime(2024, 1, dia, tzinfo=timezone.utc) for dia in (3, 5, 8, 13, 21)]
+    fechas.append(datetime(2024, 2, 2, tzinfo=timezone.utc))
+    ventas = []
+    for indice, fecha in enumerate(fechas):
+        respuesta = await api.post("/api/ventas", json={
+            "cliente_id": cliente["id"],
+            "metodo_pago": "USD" if indice % 2 else "Transferencia",
+            "productos": [{"producto_id": producto["id"], "cantidad": indice + 1}]
+        })
+        venta = respuesta.json()
+        await db.ventas.update_one({"id": venta["id"]}, {"$set": {"fecha": fecha}})
+        ventas.append({**venta, "fecha": fecha})
+    return ventas
+
+
+async def test_archivar_mueve_por_lotes_y_guarda_totales(db, lotes_chicos, ventas_antiguas):
+    resultado = await server.archivar("ventas", datetime(2024, 3, 1, tzinfo=timezone.utc))
+    assert [(periodo["periodo"], periodo["archivados"]) for periodo in resultado["periodos"]] == [("2024-01", 5), ("2024-02", 1)]
+    assert await db.ventas.count_documents({}) == 0
+    assert await db.archivo_ventas_2024_01.count_documents({}) == 5
+    
+    enero = [venta for venta in ventas_antiguas if venta["fecha"].month == 1]
+    periodo = await db.periodos.find_one({"_id": "ventas:2024-01"})
+    assert periodo["cantidad"] == 5
+    assert periodo["total"] == pytest.approx(sum(venta["total"] for venta in enero))
+    for metodo in ("USD", "Transferencia"):
+        esperado = sum(venta["total"] for venta in enero if venta["metodo_pago"] == metodo)
+        assert periodo["por_metodo"][metodo] == pytest.approx(esperado)
+    
+    # Los totales archivados siguen contando al recalcular las comparativas
+    resumen = await server.reconstruir_comparativas()
+    assert resumen["cantidad_ventas"] == len(ventas_antiguas)
+    assert resumen["total_ventas"] == pytest.approx(sum(venta["total"] for venta in ventas_antiguas))
+
+
+async def test_archivar_a_ndjson_escribe_una_parte_por_lote(db, lotes_chicos, ventas_antiguas):
+    await server.archivar("ventas", datetime(2024, 2, 1, tzinfo=timezone.utc), "ndjson")
+    partes = server.partes_archivo(lotes_chicos / "ventas_2024-01")
+    assert len(partes) == 3
+    archivadas = [documento["id"] for parte in partes for documento in server.leer_parte(parte)]
+    assert sorted(archivadas) == sorted(venta["id"] for venta in ventas_antiguas[:5])
+    assert await db.ventas.count_documents({}) == 1
+
+
+async def test_reconstruir_historiales_suma_las_partes_ndjson(db, cliente, lotes_chicos, ventas_antiguas):
+    await server.archivar("ventas", datetime(2024, 2, 1, tzinfo=timezone.utc), "ndjson")
+    # Una parte con documentos que ya están en otra (nombrada por otro id) no se cuenta dos veces
+    repetidos = server.leer_parte(server.partes_archivo(lotes_chicos / "ventas_2024-01")[0])
+    server.escribir_archivo(lotes_chicos / "ventas_2024-01", repetidos[::-1])
+    
+    assert await server.reconstruir_historiales("clientes") == 1
+    historial = await server.leer_historial("clientes", cliente["id"], 5)
+    assert historial["cantidad"] == len(ventas_antiguas)
+    assert historial["total"] == pytest.approx(sum(venta["total"] for venta in ventas_antiguas))
+    assert historial["ultima_fecha"] == ventas_antiguas[-1]["fecha"]
+    assert historial["productos_top"][0]["unidades"] == sum(range(1, len(ventas_antiguas) + 1))
@@ -0,0 +1,79 @@
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def comprar(api, proveedor):
+    async def comprar(producto, cantidad, costo):
+        respuesta = await api.post("/api/compras", json={
+            "proveedor_id": proveedor["id"],
+            "metodo_pago": "Transferencia",
+            "productos": [{"producto_id": producto["id"], "cantidad": cantidad, "precio_unitario": costo}]
+        })
+        assert respuesta.status_code == 200
+        return respuesta.json()
+    return comprar
+
+
+async def leer(db, producto):
+    return await db.productos.find_one({"id": producto["id"]}, {"_id": 0, "stock": 1, "costo_promedio": 1})
+
+
+async def test_compras_ponderan_el_costo_promedio(db, crear_producto, comprar):
+    producto = await crear_producto(stock=5)
+    await comprar(producto, 5, 4)
+    assert await leer(db, producto) == {"stock": 10, "costo_promedio": 4}
+    await comprar(producto, 10, 100)
+    assert await leer(db, producto) == {"stock": 20, "costo_promedio": 52}
+
+
+async def test_eliminar_compra_deshace_su_aporte_al_costo(api, db, crear_producto, comprar):
+    producto = await crear_producto(stock=5)
+    await comprar(producto, 5, 4)
+    compra = await comprar(producto, 10, 100)
+    assert (await api.delete(f"/api/compras/{compra['id']}")).status_code == 200
+    assert await leer(db, producto) == {"stock": 10, "costo_promedio": 4}
+
+
+async def test_eliminar_compra_sin_stock_suficiente_no_toca_el_costo(api, db, cliente, crear_producto, comprar):
+    producto = await crear_producto(stock=0)
+    compra = await comprar(producto, 10, 8)
+    await api.post("/api/ventas", json={
+        "cliente_id": cliente["id"],
+        "metodo_pago": "USD",
+        "productos": [{"producto_id": producto["id"], "cantidad": 4}]
+    })
+    assert (await api.delete(f"/api/compras/{compra['id']}")).status_code == 409
+    assert await leer(db, producto) == {"stock": 6, "costo_promedio": 8}
+
+
+async def test_eliminar_compra_tras_ventas_a_otro_costo_conserva_el_promedio(api, db, cliente, crear_producto, comprar):
+    # 5 a 4 y 10 a 100 promedian 68; tras vender 2 quedan 13 a 68, que valen menos que los 10 a 100
+    producto = await crear_producto(stock=0)
+    await comprar(producto, 5, 4)
+    compra = await comprar(producto, 10, 100)
+    await api.post("/api/ventas", json={
+        "cliente_id": cliente["id"],
+        "metodo_pago": "USD",
+        "productos": [{"producto_id": producto["id"], "cantidad": 2}]
+    })
+    assert (await api.delete(f"/api/compras/{compra['id']}")).status_code == 200
+    assert await leer(db, producto) == {"stock": 3, "costo_promedio": 68}
+
+
+async def test_venta_guarda_el_costo_promedio_y_al_anularse_lo_reingresa(api, db, cliente, crear_producto, comprar):
+    producto = await crear_producto(stock=0)
+    await comprar(producto, 4, 10)
+    await comprar(producto, 4, 20)
+    venta = (await api.post("/api/ventas", json={
+        "cliente_id": cliente["id"],
+        "metodo_pago": "USD",
+        "productos": [{"producto_id": producto["id"], "cantidad": 2}]
+    })).json()
+    assert venta["productos"][0]["costo_unitario"] == 15
+    assert venta["costo_total"] == 30
+    await comprar(producto, 6, 25)
+    assert await leer(db, producto) == {"stock": 12, "costo_promedio": 20}
+    assert (await api.delete(f"/api/ventas/{venta['id']}")).status_code == 200
+    assert (await leer(db, producto))["costo_promedio"] == pytest.approx((12 * 20 + 2 * 15) / 14)
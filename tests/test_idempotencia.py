@@ -0,0 +1,94 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def venta(cliente, crear_producto):
+    producto = await crear_producto(stock=10)
+    return {"cliente_id": cliente["id"], "metodo_pago": "USD", "productos": [{"producto_id": producto["id"], "cantidad": 2}]}
+
+
+async def test_reintento_devuelve_la_misma_venta(api, db, venta):
+    primera = await api.post("/api/ventas", json=venta, headers={"Idempotency-Key": "clave-1"})
+    segunda = await api.post("/api/ventas", json=venta, headers={"Idempotency-Key": "clave-1"})
+    assert primera.status_code == segunda.status_code == 200
+    assert segunda.headers["Idempotent-Replayed"] == "true"
+    assert segunda.json() == primera.json()
+    assert await db.ventas.count_documents({}) == 1
+
+
+async def test_misma_clave_con_otro_cuerpo(api, venta):
+    await api.post("/api/ventas", json=venta, headers={"Idempotency-Key": "clave-1"})
+    otra = {**venta, "metodo_pago": "Transferencia"}
+    respuesta = await api.post("/api/ventas", json=otra, headers={"Idempotency-Key": "clave-1"})
+    assert respuesta.status_code == 422
+
+
+async def test_reserva_vigente_responde_409(api, db, venta):
+    await api.post("/api/ventas", json=venta, headers={"Idempotency-Key": "clave-1"})
+    await db.idempotencia.update_one({"_id": "ventas:clave-1"}, {"$set": {"estado": "en_curso"}})
+    respuesta = await api.post("/api/ventas", json=venta, headers={"Idempotency-Key": "clave-1"})
+    assert respuesta.status_code == 409
+
+
+async def test_reserva_vencida_con_venta_escrita_la_devuelve(api, db, venta):
+    # El proceso cayó después de escribir la venta y antes de completar la clave
+    primera = (await api.post("/api/ventas", json=venta, headers={"Idempotency-Key": "clave-1"})).json()
+    await db.idempotencia.update_one(
+        {"_id": "ventas:clave-1"},
+        {"$set": {"estado": "en_curso", "vence": datetime.now(timezone.utc) - timedelta(seconds=1)}, "$unset": {"respuesta": 1}}
+    )
+    respuesta = await api.post("/api/ventas", json=venta, headers={"Idempotency-Key": "clave-1"})
+    assert respuesta.status_code == 200
+    assert respuesta.headers["Idempotent-Replayed"] == "true"
+    assert respuesta.json()["id"] == primera["id"]
+    assert await db.ventas.count_documents({}) == 1
+    assert (await db.idempotencia.find_one({"_id": "ventas:clave-1"}))["estado"] == "completado"
+
+
+async def test_reserva_vencida_sin_venta_la_ejecuta_con_el_id_reservado(api, db, venta):
+    # El proceso cayó antes de escribir: el reintento ejecuta una sola vez
+    primera = await api.post("/api/ventas", json=venta, headers={"Idempotency-Key": "clave-1"})
+    registro = await db.idempotencia.find_one({"_id": "ventas:clave-1"})
+    await db.ventas.delete_many({})
+    await db.idempotencia.update_one(
+        {"_id": "ventas:clave-1"},
+        {"$set": {"estado": "en_curso", "vence": datetime.now(timezone.utc) - timedelta(seconds=1)}}
+    )
+    respuesta = await api.post("/api/ventas", json=venta, headers={"Idempotency-Key": "clave-1"})
+    assert respuesta.status_code == 200
+    assert "Idempotent-Replayed" not in respuesta.headers
+    assert respuesta.json()["id"] == registro["documento_id"] == primera.json()["id"]
+    assert await db.ventas.count_documents({}) == 1
+
+
+async def test_falla_libera_la_clave(api, cliente, crear_producto):
+    producto = await crear_producto(stock=1)
+    venta = {"cliente_id": cliente["id"], "metodo_pago": "USD", "productos": [{"producto_id": producto["id"], "cantidad": 5}]}
+    assert (await api.post("/api/ventas", json=venta, headers={"Idempotency-Key": "clave-1"})).status_code == 409
+    assert await server.db.idempotencia.count_documents({}) == 0
+
+
+async def test_falla_despues_de_escribir_no_libera_la_clave(api, db, venta, monkeypatch):
+    publicar = server.publicar
+    
+    async def publicar_roto(evento):
+        raise RuntimeError("sin conexión con los workers")
+    
+    monkeypatch.setattr(server, "publicar", publicar_roto)
+    primera = await api.post("/api/ventas", json=venta, headers={"Idempotency-Key": "clave-1"})
+    assert primera.status_code == 200
+    assert (await db.idempotencia.find_one({"_id": "ventas:clave-1"}))["estado"] == "completado"
+    
+    monkeypatch.setattr(server, "publicar", publicar)
+    segunda = await api.post("/api/ventas", json=venta, headers={"Idempotency-Key": "clave-1"})
+    assert segunda.headers["Idempotent-Replayed"] == "true"
+    assert segunda.json()["id"] == primera.json()["id"]
+    assert await db.ventas.count_documents({}) == 1
+    producto_id = venta["productos"][0]["producto_id"]
+    assert (await db.productos.find_one({"id": producto_id}))["stock"] == 8
@@ -0,0 +1,23 @@
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+def archivo_csv(contenido):
+    return {"archivo": ("productos.csv", contenido, "text/csv")}
+
+
+async def test_csv_vacio_responde_422(api, db):
+    respuesta = await api.post("/api/importar/productos", files=archivo_csv(""))
+    assert respuesta.status_code == 422
+    assert await db.productos.count_documents({}) == 0
+
+
+async def test_filas_no_validas_se_reportan_sin_detener_el_lote(api, db):
+    contenido = "nombre,descripcion,categoria,precio,stock\nMartillo,,Herramientas,10,5\nAlicate,,Herramientas,caro,5\n"
+    respuesta = await api.post("/api/importar/productos", files=archivo_csv(contenido))
+    assert respuesta.status_code == 200
+    reporte = respuesta.json()
+    assert (reporte["insertados"], reporte["filas"], reporte["total_errores"]) == (1, 2, 1)
+    assert reporte["errores"][0]["fila"] == 2
+    assert (await db.versiones.find_one({"_id": "productos"}))["version"] == 1
@@ -0,0 +1,59 @@
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def vender(api, cliente, producto, cantidad):
+    respuesta = await api.post("/api/ventas", json={
+        "cliente_id": cliente["id"],
+        "metodo_pago": "USD",
+        "productos": [{"producto_id": producto["id"], "cantidad": cantidad}]
+    })
+    assert respuesta.status_code == 200
+    return respuesta.json()
+
+
+async def comprar(api, proveedor, producto, cantidad, costo):
+    respuesta = await api.post("/api/compras", json={
+        "proveedor_id": proveedor["id"],
+        "metodo_pago": "USD",
+        "productos": [{"producto_id": producto["id"], "cantidad": cantidad, "precio_unitario": costo}]
+    })
+    assert respuesta.status_code == 200
+
+
+async def test_kardex_acumula_el_saldo(api, cliente, crear_producto):
+    producto = await crear_producto(stock=5)
+    for _ in range(3):
+        await vender(api, cliente, producto, 1)
+    kardex = (await api.get(f"/api/kardex/{producto['id']}")).json()
+    assert [movimiento["saldo"] for movimiento in kardex["movimientos"]] == [5, 4, 3, 2]
+    assert (kardex["saldo_inicial"], kardex["saldo_final"], kardex["truncado"]) == (0, 2, False)
+
+
+async def test_kardex_truncado_por_limit_da_el_saldo_a_hasta(api, cliente, crear_producto):
+    producto = await crear_producto(stock=5)
+    for _ in range(3):
+        await vender(api, cliente, producto, 1)
+    kardex = (await api.get(f"/api/kardex/{producto['id']}", params={"limit": 2})).json()
+    assert [movimiento["saldo"] for movimiento in kardex["movimientos"]] == [5, 4]
+    assert kardex["truncado"] is True
+    assert kardex["saldo_final"] == 2
+
+
+async def test_inventario_historico_se_valoriza_al_costo_promedio(api, cliente, proveedor, crear_producto):
+    producto = await crear_producto(stock=0)
+    await comprar(api, proveedor, producto, 5, 4)
+    await comprar(api, proveedor, producto, 5, 10)
+    inventario = (await api.get("/api/inventario/historico")).json()
+    assert [(item["stock"], item["costo"], item["valor"]) for item in inventario["productos"]] == [(10, 7, 70)]
+    
+    # Un snapshot guarda el mismo costo, y las ventas posteriores no lo cambian
+    await server.tomar_snapshot()
+    await vender(api, cliente, producto, 2)
+    inventario = (await api.get("/api/inventario/historico")).json()
+    assert [(item["stock"], item["costo"], item["valor"]) for item in inventario["productos"]] == [(8, 7, 56)]
+    kardex = (await api.get(f"/api/kardex/{producto['id']}", params={"desde": "2000-01-01T00:00:00Z"})).json()
+    assert [movimiento["costo_promedio"] for movimiento in kardex["movimientos"]] == [None, 4, 7, 7]
@@ -0,0 +1,25 @@
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_ventas_se_paginan_por_fecha_e_id(api, cliente, crear_producto):
+    producto = await crear_producto(stock=10)
+    creadas = []
+    for _ in range(3):
+        respuesta = await api.post("/api/ventas", json={
+            "cliente_id": cliente["id"],
+            "metodo_pago": "USD",
+            "productos": [{"producto_id": producto["id"], "cantidad": 1}]
+        })
+        creadas.append(respuesta.json()["id"])
+    primera = (await api.get("/api/ventas", params={"limit": 2})).json()
+    segunda = (await api.get("/api/ventas", params={"limit": 2, "after": primera["next_cursor"]})).json()
+    assert [venta["id"] for venta in primera["items"] + segunda["items"]] == creadas
+    assert segunda["next_cursor"] is None
+
+
+@pytest.mark.parametrize("cursor", ["x_1", "1700000000000", "100000000000000000_x", "-100000000000000000_x"])
+async def test_cursor_no_valido_responde_400(api, db, cursor):
+    respuesta = await api.get("/api/ventas", params={"after": cursor})
+    assert respuesta.status_code == 400
@@ -0,0 +1,19 @@
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_cache_no_sirve_un_cuerpo_viejo_con_el_etag_nuevo(api, db, crear_producto):
+    producto = await crear_producto(stock=5)
+    ruta = f"/api/productos/{producto['id']}"
+    anterior = await api.get(ruta)
+    assert anterior.json()["stock"] == 5
+    assert [item["stock"] for item in (await api.get("/api/productos")).json()["items"]] == [5]
+    # Escritura de otro worker: sube la versión sin pasar por la caché de este proceso
+    await db.productos.update_one({"id": producto["id"]}, {"$set": {"stock": 2}})
+    await db.versiones.update_one({"_id": "productos"}, {"$inc": {"version": 1}})
+    actual = await api.get(ruta, headers={"If-None-Match": anterior.headers["ETag"]})
+    assert actual.status_code == 200
+    assert actual.json()["stock"] == 2
+    assert (await api.get(ruta, headers={"If-None-Match": actual.headers["ETag"]})).status_code == 304
+    assert [item["stock"] for item in (await api.get("/api/productos")).json()["items"]] == [2]
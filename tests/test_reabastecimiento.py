@@ -0,0 +1,66 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def vender(db, cliente, producto, cantidad, fecha):
+    await db.ventas.insert_one({
+        "id": f"v-{fecha.isoformat()}-{producto['id']}",
+        "cliente_id": cliente["id"],
+        "fecha": fecha,
+        "total": cantidad * producto["precio"],
+        "metodo_pago": "USD",
+        "productos": [{"producto_id": producto["id"], "cantidad": cantidad, "subtotal": cantidad * producto["precio"]}]
+    })
+
+
+def por_nombre(datos):
+    return {producto["nombre"]: producto for producto in datos["productos"]}
+
+
+async def test_el_dia_en_curso_no_cuenta(api, db, cliente, crear_producto):
+    producto = await crear_producto(stock=100)
+    hoy = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    for dias_atras in range(1, 15):
+        await vender(db, cliente, producto, 2, hoy - timedelta(days=dias_atras) + timedelta(hours=12))
+    # Una venta grande de hoy no mueve la demanda hasta que el día termine
+    await vender(db, cliente, producto, 50, hoy + timedelta(minutes=1))
+    
+    datos = (await api.get("/api/reabastecimiento", params={"dias": 14, "ventana": 7, "alfa": 0.5})).json()
+    fila = por_nombre(datos)["Martillo"]
+    assert fila["media_movil"] == 2
+    assert fila["demanda_diaria"] == pytest.approx(2)
+    assert fila["dias_cobertura"] == 50
+
+
+async def test_sugiere_reponer_lo_que_se_agota_antes_del_plazo(api, db, cliente, crear_producto):
+    escaso = await crear_producto("Serrucho", stock=5)
+    await crear_producto("Alicate", stock=5)
+    hoy = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    for dias_atras in range(1, 31):
+        await vender(db, cliente, escaso, 1, hoy - timedelta(days=dias_atras))
+    
+    datos = (await api.get("/api/reabastecimiento", params={"dias": 30, "plazo": 7, "cobertura": 30, "alfa": 1})).json()
+    filas = por_nombre(datos)
+    assert filas["Serrucho"]["cantidad_sugerida"] == 7 + 30 - 5
+    assert filas["Alicate"]["cantidad_sugerida"] == 0
+    assert filas["Alicate"]["dias_cobertura"] is None
+    assert [fila["nombre"] for fila in datos["productos"]] == ["Serrucho", "Alicate"]
+
+
+async def test_cache_sigue_las_versiones_de_otros_workers(api, db, cliente, crear_producto):
+    producto = await crear_producto(stock=5)
+    primera = (await api.get("/api/reabastecimiento")).json()
+    assert (await api.get("/api/reabastecimiento")).json() == primera
+    
+    # Otro worker registra una venta: esta caché local no se invalidó, pero la versión cambió
+    await vender(db, cliente, producto, 3, datetime.now(timezone.utc) - timedelta(days=1))
+    await db.versiones.update_one({"_id": "ventas"}, {"$inc": {"version": 1}}, upsert=True)
+    generacion = server.cache_reabastecimiento.generacion
+    segunda = (await api.get("/api/reabastecimiento")).json()
+    assert server.cache_reabastecimiento.generacion == generacion
+    assert por_nombre(segunda)["Martillo"]["media_movil"] > 0
@@ -0,0 +1,65 @@
+import asyncio
+
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+def venta_de(cliente, producto, cantidad):
+    return {"cliente_id": cliente["id"], "metodo_pago": "USD", "productos": [{"producto_id": producto["id"], "cantidad": cantidad}]}
+
+
+async def test_stock_insuficiente_responde_409_sin_descontar(api, db, cliente, crear_producto):
+    producto = await crear_producto(stock=3)
+    respuesta = await api.post("/api/ventas", json=venta_de(cliente, producto, 5))
+    assert respuesta.status_code == 409
+    detalle = respuesta.json()["detail"]
+    assert detalle["mensaje"] == "Stock insuficiente"
+    assert [(item["producto_id"], item["disponible"]) for item in detalle["productos"]] == [(producto["id"], 3)]
+    assert (await db.productos.find_one({"id": producto["id"]}))["stock"] == 3
+    assert await db.ventas.count_documents({}) == 0
+
+
+async def test_linea_fallida_revierte_las_demas(api, db, cliente, crear_producto):
+    suficiente = await crear_producto("Alicate", stock=10)
+    escaso = await crear_producto("Serrucho", stock=1)
+    venta = {
+        "cliente_id": cliente["id"],
+        "metodo_pago": "USD",
+        "productos": [{"producto_id": suficiente["id"], "cantidad": 4}, {"producto_id": escaso["id"], "cantidad": 2}]
+    }
+    assert (await api.post("/api/ventas", json=venta)).status_code == 409
+    assert (await db.productos.find_one({"id": suficiente["id"]}))["stock"] == 10
+    assert (await db.productos.find_one({"id": escaso["id"]}))["stock"] == 1
+
+
+async def test_ventas_concurrentes_no_sobrevenden(api, db, cliente, crear_producto):
+    producto = await crear_producto(stock=5)
+    respuestas = await asyncio.gather(*[api.post("/api/ventas", json=venta_de(cliente, producto, 2)) for _ in range(4)])
+    assert sorted(respuesta.status_code for respuesta in respuestas) == [200, 200, 409, 409]
+    assert (await db.productos.find_one({"id": producto["id"]}))["stock"] == 1
+
+
+async def test_eliminar_venta_restaura_stock(api, db, cliente, crear_producto):
+    producto = await crear_producto(stock=5)
+    venta = (await api.post("/api/ventas", json=venta_de(cliente, producto, 2))).json()
+    assert (await api.delete(f"/api/ventas/{venta['id']}")).status_code == 200
+    assert (await db.productos.find_one({"id": producto["id"]}))["stock"] == 5
+
+
+async def test_eliminar_producto_registra_baja(api, db, crear_producto):
+    producto = await crear_producto(stock=5)
+    assert (await api.delete(f"/api/productos/{producto['id']}")).status_code == 200
+    kardex = (await api.get(f"/api/kardex/{producto['id']}")).json()
+    assert [(movimiento["tipo"], movimiento["cantidad"]) for movimiento in kardex["movimientos"]] == [("alta", 5), ("baja", -5)]
+    inventario = (await api.get("/api/inventario/historico")).json()
+    assert inventario["productos"] == []
+
+
+@pytest.mark.parametrize("metodo", ["$x", "a.b", ""])
+async def test_metodo_de_pago_desconocido_responde_422_sin_descontar(api, db, cliente, crear_producto, metodo):
+    producto = await crear_producto(stock=5)
+    venta = {**venta_de(cliente, producto, 2), "metodo_pago": metodo}
+    assert (await api.post("/api/ventas", json=venta)).status_code == 422
+    assert (await db.productos.find_one({"id": producto["id"]}))["stock"] == 5
+    assert await db.resumenes.count_documents({}) == 0
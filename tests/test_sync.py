@@ -0,0 +1,90 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def sincronizar(api, since):
+    # Sigue hay_mas hasta el final, como hace el frontend
+    vistos = []
+    for _ in range(100):
+        datos = (await api.get("/api/sync", params={"since": since})).json()
+        assert not datos["resync"]
+        assert datos["token"] > since or not datos["hay_mas"]
+        vistos.extend(documento["id"] for documento in datos["cambios"].get("productos", []))
+        since = datos["token"]
+        if not datos["hay_mas"]:
+            return since, vistos
+    pytest.fail("/sync no avanza")
+
+
+async def test_sync_sin_since_devuelve_token(api, crear_producto):
+    await crear_producto()
+    datos = (await api.get("/api/sync")).json()
+    assert datos["token"] == await server.token_sync()
+    assert datos["cambios"] == {}
+
+
+async def test_version_que_llena_la_pagina_se_entrega_completa(api, db):
+    # Un lote de importación comparte una sola _version y puede superar la página
+    async with server.version_sync() as version:
+        await db.productos.insert_many([
+            {**server.Producto(nombre=f"P{numero}", descripcion="", categoria="c", precio=1, stock=1).model_dump(), "_version": version}
+            for numero in range(server.LIMITE_SYNC + 5)
+        ])
+    token, vistos = await sincronizar(api, 0)
+    assert token == version
+    assert len(vistos) == len(set(vistos)) == server.LIMITE_SYNC + 5
+
+
+async def test_importacion_de_un_lote_completo_avanza(api):
+    filas = "".join(f"P{numero},Producto importado,Herramientas manuales,1.5,3\n" for numero in range(server.TAMANO_LOTE))
+    respuesta = await api.post(
+        "/api/importar/productos",
+        files={"archivo": ("productos.csv", "nombre,descripcion,categoria,precio,stock\n" + filas, "text/csv")}
+    )
+    assert respuesta.status_code == 200
+    _, vistos = await sincronizar(api, 0)
+    assert len(set(vistos)) == server.TAMANO_LOTE
+
+
+async def test_paginas_con_varias_versiones_no_pierden_ni_repiten(api, db):
+    total = server.LIMITE_SYNC + 20
+    for inicio in range(0, total, 7):
+        async with server.version_sync() as version:
+            await db.productos.insert_many([
+                {**server.Producto(nombre=f"P{numero}", descripcion="", categoria="c", precio=1, stock=1).model_dump(), "_version": version}
+                for numero in range(inicio, min(total, inicio + 7))
+            ])
+    _, vistos = await sincronizar(api, 0)
+    assert len(vistos) == len(set(vistos)) == total
+
+
+async def test_eliminados_en_sync(api, crear_producto):
+    producto = await crear_producto()
+    token = (await api.get("/api/sync")).json()["token"]
+    await api.delete(f"/api/productos/{producto['id']}")
+    datos = (await api.get("/api/sync", params={"since": token})).json()
+    assert datos["eliminados"] == [{"coleccion": "productos", "id": producto["id"], "_version": datos["token"]}]
+
+
+async def test_since_anterior_a_la_poda_pide_resync(api, db, crear_producto):
+    producto = await crear_producto()
+    otro = await crear_producto("Alicate")
+    token = (await api.get("/api/sync")).json()["token"]
+    await api.delete(f"/api/productos/{producto['id']}")
+    # La baja ya superó la retención
+    await db.eliminados.update_many({}, {"$set": {"fecha": datetime.now(timezone.utc) - timedelta(seconds=server.SYNC_ELIMINADOS_TTL + 1)}})
+    await api.delete(f"/api/productos/{otro['id']}")
+    
+    datos = (await api.get("/api/sync", params={"since": token})).json()
+    assert datos["resync"]
+    assert await db.eliminados.count_documents({}) == 1
+    
+    # Un cliente al día después de la poda sigue sincronizando normal
+    datos = (await api.get("/api/sync", params={"since": datos["token"] - 1})).json()
+    assert not datos["resync"]
+    assert [eliminado["id"] for eliminado in datos["eliminados"]] == [otro["id"]]